@@ -0,0 +1,207 @@
+"""
+ASGI entry point next to the Flask app in main.py, serving the same routes from
+one event loop:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Events of the invoice actions and get_invoice run through the async pipeline
+(src/async_pipeline.py); the other actions and the PDF route run their
+synchronous code in its thread pool. Idempotency, single-flight coalescing,
+admission control and deadlines apply exactly as in main.py.
+
+An event no longer ties up a thread here, so admission control admits more
+events at once than under Flask: ADMISSION_MAX_INFLIGHT defaults to
+ASGI_MAX_INFLIGHT (default 256) when it is not set.
+"""
+
+import asyncio
+import json
+import os
+from urllib.parse import parse_qs
+from src import admission, async_pipeline, audit, deadline, health, idempotency, invoice_pdf, log, profiling, singleflight, tenants, tracing, verbosity
+from src.circuit_breaker import breaker_status
+from src.event_model import parse_event
+import main
+
+logger = log.get_logger(__name__)
+
+if "ADMISSION_MAX_INFLIGHT" not in os.environ:
+    admission.controller.max_inflight = int(os.environ.get("ASGI_MAX_INFLIGHT", "256"))
+
+
+async def run_action(action, event, model):
+    handler = async_pipeline.handler_for(action, model)
+    if handler is None:
+        return await async_pipeline.run_blocking(main.run_action, action, event, model)
+    return await handler(event, model)
+
+
+async def run_admitted(action, event, model, budget, idempotency_key):
+    # Waiting for an admission slot blocks, so it happens in the thread pool
+    slot = await async_pipeline.run_blocking(admission.admit, action)
+    with slot, deadline.scope(budget):
+        result = await run_action(action, event, model)
+    await async_pipeline.run_blocking(idempotency.remember, idempotency_key, result)
+    return result
+
+
+async def handle_event(body, headers):
+    try:
+        event = json.loads(body) if body else None
+    except ValueError:
+        event = None
+    if not event:
+        return {"error": "No JSON data received"}, 400, {}
+
+    with log.correlation(event), tracing.trace("handle_event", headers.get(tracing.TRACEPARENT_HEADER),
+                                               action=event.get("Action__c"), invoice_number=log.current_correlation_id()) as span, \
+            profiling.profile(event.get("Action__c"), log.current_correlation_id(), headers.get(profiling.PROFILE_HEADER.lower())):
+        body, status, response_headers = await process_event(event, headers)
+        span.set(status=status)
+    return body, status, response_headers
+
+
+async def process_event(event, headers):
+    action = event.get("Action__c", "")
+    if action not in main.ACTIONS:
+        return {"error": f"Invalid action: {action}"}, 400, {}
+
+    try:
+        resolved = tenants.resolve(event)
+        model = parse_event(action, resolved)
+        level = verbosity.level_for(headers.get(verbosity.VERBOSITY_HEADER.lower()))
+
+        idempotency_key = idempotency.key_for(action, event, headers.get(idempotency.IDEMPOTENCY_HEADER.lower()), model)
+        replayed = await async_pipeline.run_blocking(idempotency.lookup, idempotency_key)
+        if replayed is not None:
+            return {
+                "action": action,
+                "result": verbosity.shape(action, replayed, level),
+                "replayed": True
+            }, 200, {}
+
+        budget = deadline.budget_for(action, headers.get(deadline.DEADLINE_HEADER.lower()))
+        result = await singleflight.do_async(action, event, lambda: run_admitted(action, resolved, model, budget, idempotency_key), wait_timeout=budget)
+        return main.event_response(action, result, level)
+
+    except Exception as e:
+        logger.warning("Event failed", action=action, error=str(e), error_type=type(e).__name__)
+        return main.event_error(e)
+
+
+def _render_pdf(invoice_number, copies, annexure, bucket_name, invoice_date, budget):
+    with admission.admit("get_invoice_pdf"), deadline.scope(budget):
+        return invoice_pdf.render_invoice_pdf(invoice_number, copies, annexure, bucket_name, invoice_date)
+
+
+async def handle_pdf(invoice_number, query, headers):
+    try:
+        copies = main.pdf_copies(query.get("copies"))
+    except ValueError:
+        return {"error": f"copies must be a number from 1 to {invoice_pdf.MAX_COPIES}"}, 400, {}
+    annexure = query.get("annexure", "1").lower() not in ("0", "false", "no")
+
+    bucket_name = main.pdf_bucket(invoice_number, query)
+    if bucket_name is None:
+        return {"error": "Not found"}, 404, {}
+
+    try:
+        budget = deadline.budget_for("get_invoice_pdf", headers.get(deadline.DEADLINE_HEADER.lower()))
+        content = await async_pipeline.run_blocking(_render_pdf, invoice_number, copies, annexure, bucket_name, query.get("date"), budget)
+        return content, 200, {
+            "Content-Type": "application/pdf",
+            "Content-Disposition": f'inline; filename="{invoice_number}.pdf"'
+        }
+    except Exception as e:
+        return main.pdf_error(e)
+
+
+def handle_profiles(parts, headers):
+    if not profiling.authorized(headers.get(profiling.PROFILE_HEADER.lower())):
+        return {"error": "Not found"}, 404, {}
+    if len(parts) == 1:
+        return {"profiles": profiling.list_profiles()}, 200, {}
+    artifact = profiling.read_artifact(parts[1])
+    if artifact is None:
+        return {"error": "Not found"}, 404, {}
+    content, content_type = artifact
+    return content, 200, {"Content-Type": content_type}
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _send(send, body, status, headers):
+    if isinstance(body, bytes):
+        content = body
+    else:
+        content = json.dumps(body, default=str).encode()
+        headers = dict(headers, **{"Content-Type": "application/json"})
+    headers = dict(headers, **{"Content-Length": str(len(content))})
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode(), str(value).encode()) for name, value in headers.items()]
+    })
+    await send({"type": "http.response.body", "body": content})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await async_pipeline.startup()
+            # Warm the synchronous clients and start the /health/deep probe (src/health.py)
+            # while the async pipeline warms its own
+            steps = [async_pipeline.run_blocking(health.start)]
+            if health.WARMUP:
+                steps.append(async_pipeline.warm_up())
+            await asyncio.gather(*steps)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_pipeline.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+    query = {name: values[0] for name, values in parse_qs(scope.get("query_string", b"").decode()).items()}
+    body = await _read_body(receive)
+
+    parts = path.strip("/").split("/")
+    if path == "/event":
+        response = await handle_event(body, headers) if method == "POST" else ({"error": "Method not allowed"}, 405, {})
+    elif len(parts) == 3 and parts[0] == "invoice" and parts[2] == "pdf":
+        response = await handle_pdf(parts[1], query, headers) if method == "GET" else ({"error": "Method not allowed"}, 405, {})
+    elif parts[0] == "profiles" and len(parts) <= 2 and method == "GET":
+        response = handle_profiles(parts, headers)
+    elif path == "/health" and method == "GET":
+        response = {"action": "healthy", "circuit_breakers": breaker_status()}, 200, {}
+    elif path == "/health/deep" and method == "GET":
+        body, status = health.deep_report()
+        response = dict(body, circuit_breakers=breaker_status()), status, {}
+    elif path == "/metrics" and method == "GET":
+        response = dict(admission.metrics(), log_lines_dropped=log.dropped_lines(), trace_spans_dropped=tracing.dropped_spans(),
+                                audit_entries_dropped=audit.dropped_entries()), 200, {}
+    else:
+        response = {"error": "Not found"}, 404, {}
+    await _send(send, *response)
+
+
+# `python asgi.py` serves the app with uvicorn, like `python main.py` serves Flask
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8080)
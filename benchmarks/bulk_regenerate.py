@@ -0,0 +1,237 @@
+"""
+Bulk PDF regeneration against a local Zoho Books stand-in.
+
+Starts an HTTP server that answers the Zoho calls the regeneration makes (token,
+single-invoice PDF, multi-invoice PDF export) after a fixed latency, points the
+shared Zoho connection pool at it and regenerates the same invoices three ways:
+
+    per-invoice  get_invoice_function for every invoice, --concurrency at a time
+                 (a token and a PDF download per invoice, as reconcile repairs them)
+    single       src.bulk_regenerate --mode single (one token, parallel downloads)
+    combined     src.bulk_regenerate --mode combined (one export per batch)
+
+Masters go to the local storage backend in a temporary directory; half of the
+invoices start with a stored master that has an annexure page, which the bulk
+modes must keep. After each bulk run every master is checked for its page count
+and its invoice number. A Zoho call counts against the organization's rate limit
+only in the bulk modes, so the limit is raised here (ZOHO_RATE_LIMIT_PER_MINUTE)
+to compare latency; the request counts show what the limit would cost.
+
+Usage (from the repository root):
+    python -m benchmarks.bulk_regenerate [--invoices 100] [--batch-size 25] [--concurrency 4] [--latency 0.2]
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-south-1")
+os.environ.setdefault("PDF_STORAGE", "local")
+os.environ.setdefault("PDF_STORAGE_DIR", tempfile.mkdtemp(prefix="bulk-regenerate-"))
+os.environ.setdefault("INVOICE_PDF_BASE_URL", "https://example.invalid")
+os.environ.setdefault("INVOICE_URL_SECRET", "bulk-benchmark")
+os.environ.setdefault("ZOHO_RATE_LIMIT_PER_MINUTE", "100000")
+os.environ.setdefault("ZOHO_RATE_LIMIT_BURST", "1000")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import argparse
+import io
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlsplit, urlunsplit
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+from requests.adapters import HTTPAdapter
+from src.bulk_regenerate import Job, Regenerator
+from src.dependencies import zoho_http
+from src.get_invoice import create_annexure_pdf, get_invoice_function
+from src.invoice_pdf import storage, store_master, locate_master
+from src.reconcile import ZohoClient
+
+BUCKET = "bulk-benchmark"
+ORG_ID = "60000000001"
+CREDENTIALS = {"client_id": "standin", "client_secret": "standin", "refresh_token": "standin"}
+
+
+def invoice_number(i):
+    return f"INV-{i:05d}"
+
+
+# 1 to 3 pages; only the first shows the invoice number, as on Zoho's templates
+def invoice_pages(i):
+    return 1 + i % 3
+
+
+def render_invoices(numbers):
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=A4)
+    for i in numbers:
+        for page in range(invoice_pages(i)):
+            can.setFont("Helvetica", 14)
+            if page == 0:
+                can.drawString(40, 800, "TAX INVOICE")
+                can.drawString(40, 780, f"Invoice# {invoice_number(i)}")
+            else:
+                can.drawString(40, 800, f"Continued, page {page + 1}")
+            can.setFont("Helvetica", 9)
+            for row in range(40):
+                can.drawString(40, 740 - row * 14, f"{row + 1:>3}  Item {row} HSN 9983 GST 18%  {(row + i) * 137.5:>12.2f}")
+            can.showPage()
+    can.save()
+    return packet.getvalue()
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.count("token")
+        time.sleep(self.server.latency)
+        self._send(200, json.dumps({"access_token": "standin-token", "expires_in": 3600}).encode(), "application/json")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.rstrip("/").split("/")
+        if url.path.endswith("/invoices/pdf"):
+            ids = query.get("invoice_ids", [""])[0].split(",")
+            self.server.count("export")
+            # Zoho takes longer to render a larger export
+            time.sleep(self.server.latency + self.server.per_invoice * len(ids))
+            self._send(200, render_invoices(int(i) for i in ids), "application/pdf")
+        elif len(parts) == 5 and parts[3] == "invoices" and query.get("accept") == ["pdf"]:
+            self.server.count("pdf")
+            time.sleep(self.server.latency + self.server.per_invoice)
+            self._send(200, render_invoices([int(parts[4])]), "application/pdf")
+        else:
+            self._send(404, b'{"message": "not found"}', "application/json")
+
+
+class Standin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, per_invoice):
+        super().__init__(("127.0.0.1", 0), StandinHandler)
+        self.latency = latency
+        self.per_invoice = per_invoice
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandinAdapter(HTTPAdapter):
+    """Sends the Zoho pool's requests to the stand-in instead of the Zoho hosts."""
+
+    def __init__(self, base_url):
+        super().__init__(pool_maxsize=64)
+        self.base_url = urlsplit(base_url)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = urlunsplit((self.base_url.scheme, self.base_url.netloc, url.path, url.query, url.fragment))
+        return super().send(request, **kwargs)
+
+
+def seed_masters(count):
+    annexure = create_annexure_pdf([{"shipmentName": "seed", "amount": 100, "orderSellerTechFee": 0, "techFeeAmount": 0}])
+    for i in range(0, count, 2):
+        writer = PdfWriter()
+        writer.append_pages_from_reader(PdfReader(io.BytesIO(render_invoices([i]))))
+        writer.add_page(annexure)
+        pdf = io.BytesIO()
+        writer.write(pdf)
+        store_master(BUCKET, invoice_number(i), pdf.getvalue(), invoice_pages(i), 3, sf_invoice_id=f"a0X{i}", annexure_pages=1)
+
+
+def per_invoice(count, concurrency):
+    def regenerate(i):
+        event = dict(CREDENTIALS, org_id=ORG_ID, invoice_number=invoice_number(i), invoice_id=str(i), bucket_name=BUCKET,
+                     invoice_url_prefix="https://example.invalid", copies=1)
+        return get_invoice_function(event)[1] == 200
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(1 for ok in executor.map(regenerate, range(count)) if not ok)
+
+
+def bulk(count, mode, batch_size, concurrency):
+    zoho = ZohoClient(CREDENTIALS["client_id"], CREDENTIALS["client_secret"], CREDENTIALS["refresh_token"], ORG_ID)
+    jobs = [Job(invoice_number(i), str(i), None, None, None, None) for i in range(count)]
+    results = Regenerator(zoho, BUCKET, mode, concurrency).run(jobs, batch_size)
+    return sum(1 for result in results if result["error"])
+
+
+# Problems of the stored masters: wrong page counts, lost annexures, pages of another invoice
+def check_masters(count):
+    problems = []
+    for i in range(count):
+        key, metadata = locate_master(BUCKET, invoice_number(i))
+        annexure = 1 if i % 2 == 0 else 0
+        pages = PdfReader(io.BytesIO(storage.get(BUCKET, key)["body"])).pages
+        if metadata.get("invoice-pages") != str(invoice_pages(i)) or metadata.get("annexure-pages") != str(annexure):
+            problems.append(f"{invoice_number(i)}: metadata {metadata}")
+        elif len(pages) != invoice_pages(i) + annexure or invoice_number(i) not in pages[0].extract_text():
+            problems.append(f"{invoice_number(i)}: {len(pages)} pages")
+        elif annexure and metadata.get("copies") != "3":
+            problems.append(f"{invoice_number(i)}: copies {metadata.get('copies')}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoices", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds the stand-in takes per request (default 0.2)")
+    parser.add_argument("--per-invoice-latency", type=float, default=0.01, help="extra seconds per rendered invoice (default 0.01)")
+    options = parser.parse_args()
+
+    standin = Standin(options.latency, options.per_invoice_latency)
+    threading.Thread(target=standin.serve_forever, daemon=True).start()
+    adapter = StandinAdapter(standin.base_url)
+    zoho_http.mount("https://accounts.zoho.in", adapter)
+    zoho_http.mount("https://www.zohoapis.in", adapter)
+
+    print(f"{options.invoices} invoices, batches of {options.batch_size}, concurrency {options.concurrency}, "
+          f"stand-in latency {options.latency}s + {options.per_invoice_latency}s per invoice")
+    print(f"{'mode':<12} {'seconds':>8} {'failed':>7}  zoho requests")
+    for mode in ("per-invoice", "single", "combined"):
+        seed_masters(options.invoices)
+        standin.requests.clear()
+        start = time.perf_counter()
+        if mode == "per-invoice":
+            failed = per_invoice(options.invoices, options.concurrency)
+        else:
+            failed = bulk(options.invoices, mode, options.batch_size, options.concurrency)
+        seconds = time.perf_counter() - start
+        # get_invoice_function is not given the annexures, so only the bulk modes keep them
+        problems = check_masters(options.invoices) if mode != "per-invoice" else None
+        print(f"{mode:<12} {seconds:>8.2f} {failed:>7}  {dict(standin.requests)}")
+        if problems:
+            print(f"  {len(problems)} bad masters, first: {problems[0]}")
+    standin.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Size and time benchmark of the multi-copy invoice PDF builder.
+
+Compares `build_invoice_copies` (shared fonts, images and content streams) with
+the previous builder, which re-parsed the Zoho PDF and merged a reportlab header
+page into every page of every copy.
+
+Usage (from the repository root):
+    python -m benchmarks.pdf_copies [invoice.pdf] [--copies 1,2,4,6] [--runs 5]
+
+Without a PDF a sample invoice with an embedded TrueType font is generated. Real
+Zoho invoices (embedded fonts and a logo) show a larger difference. Importing
+src.get_invoice creates a boto3 client, so AWS_DEFAULT_REGION must be set.
+"""
+
+import argparse
+import io
+import os
+import time
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+# Only the copy builder is used: no PDF endpoint to configure
+os.environ.setdefault("INVOICE_URL_MODE", "copies")
+
+from src.invoice_pdf import build_invoice_copies, copy_label
+
+
+def sample_invoice(pages=2):
+    pdfmetrics.registerFont(TTFont("Vera", "Vera.ttf"))
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=A4)
+    for page in range(pages):
+        can.setFont("Vera", 18)
+        can.drawString(40, 800, f"TAX INVOICE - page {page + 1}")
+        can.setFont("Vera", 9)
+        for row in range(60):
+            can.drawString(40, 760 - row * 12, f"{row + 1:>3}  Item description {row} with HSN 9983 and GST 18%  {row * 137.5:>12.2f}")
+        can.showPage()
+    can.save()
+    return packet.getvalue()
+
+
+# The builder used before shared-object copies, kept here as the baseline
+def legacy_invoice_copies(pdf_content, copies):
+    reader = PdfReader(io.BytesIO(pdf_content))
+    writer = PdfWriter()
+    pages = list(reader.pages)
+    for copy_num in range(copies):
+        label = copy_label(copy_num)
+        for page in pages:
+            reader_copy = PdfReader(io.BytesIO(pdf_content))
+            current_page = reader_copy.pages[pages.index(page)]
+            width = float(current_page.mediabox.width)
+            height = float(current_page.mediabox.height)
+            packet = io.BytesIO()
+            can = canvas.Canvas(packet, pagesize=(width, height))
+            can.setFont("Helvetica", 16)
+            can.drawString(30, height - 30, label)
+            can.save()
+            packet.seek(0)
+            current_page.merge_page(PdfReader(packet).pages[0])
+            writer.add_page(current_page)
+    output_pdf = io.BytesIO()
+    writer.write(output_pdf)
+    return output_pdf.getvalue()
+
+
+def measure(builder, pdf_content, copies, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = builder(pdf_content, copies)
+        timings.append(time.perf_counter() - start)
+    return len(output), min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdf", nargs="?", help="invoice PDF to copy (default: generated sample)")
+    parser.add_argument("--copies", default="1,2,4,6", help="comma separated copy counts")
+    parser.add_argument("--runs", type=int, default=5, help="runs per measurement, the fastest is reported")
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_content = f.read()
+    else:
+        pdf_content = sample_invoice()
+
+    print(f"Input: {len(pdf_content)} bytes, {len(PdfReader(io.BytesIO(pdf_content)).pages)} page(s)")
+    print(f"{'copies':>6} {'legacy bytes':>13} {'shared bytes':>13} {'size':>6} {'legacy ms':>10} {'shared ms':>10}")
+    for copies in (int(value) for value in args.copies.split(",")):
+        legacy_size, legacy_time = measure(legacy_invoice_copies, pdf_content, copies, args.runs)
+        shared_size, shared_time = measure(build_invoice_copies, pdf_content, copies, args.runs)
+        print(f"{copies:>6} {legacy_size:>13} {shared_size:>13} {shared_size / legacy_size:>6.0%} {legacy_time * 1000:>10.1f} {shared_time * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
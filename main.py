@@ -1,15 +1,116 @@
-from flask import Flask, request, jsonify
-import json
+from flask import Flask, Response, request, jsonify
 from src.create_invoice import create_invoice_function as run_invoice_create
 from src.seller_tech_invoice import seller_tech_invoice_function as run_seller_tech_invoice_create
 from src.create_account import create_account_function as run_customer_create
+from src.bulk_accounts import bulk_create_account_function as run_bulk_customer_create
 from src.get_invoice import get_invoice_function as run_get_invoice
 from src.subscription import subscription_function as run_x1vp_subscription
 from src.update_invoice_address import update_invoice_address_function as run_update_address
+from src import admission, audit, deadline, health, idempotency, invoice_pdf, log, profiling, singleflight, tenants, tracing, verbosity
+from src.circuit_breaker import CircuitOpenError, breaker_status
+from src.dependencies import TIMEOUT_ERRORS
+from src.event_model import parse_event, EventValidationError
+
+ACTIONS = ("CreateZohoAccount", "BulkCreateZohoAccount", "Buyer", "Seller_Technology_Fee", "X1VP_Subscription", "get_invoice")
+
+logger = log.get_logger(__name__)
 
 # Flask application setup
 app = Flask(__name__)
 
+# Route a parsed event to its action handler
+def run_action(action, event, model):
+    if action == "CreateZohoAccount":
+        return run_customer_create(event)
+
+    elif action == "BulkCreateZohoAccount":
+        return run_bulk_customer_create(event, model)
+
+    elif action == "Buyer":
+        if model.is_address_update:
+            return run_update_address(event, model)
+        else:
+            return run_invoice_create(event, model)
+
+    elif action == "Seller_Technology_Fee":
+        return run_seller_tech_invoice_create(event, model)
+
+    elif action == "X1VP_Subscription":
+        return run_x1vp_subscription(event, model)
+
+    elif action == "get_invoice":
+        # Answered from the stored PDF unless it is missing or the event sets `force`
+        return run_get_invoice(event, read_through=True)
+
+# Run an event under admission control and its deadline budget, remembering its result for replays
+def run_admitted(action, event, model, budget, idempotency_key):
+    with admission.admit(action), deadline.scope(budget):
+        result = run_action(action, event, model)
+    idempotency.remember(idempotency_key, result)
+    return result
+
+# (body, status, headers) of a handled event, its result cut down to `level`
+# (see src/verbosity.py); shared with the ASGI app in asgi.py
+def event_response(action, result, level=verbosity.DEFAULT_LEVEL):
+    if action == "get_invoice":
+        body, status_code = result
+        if body.get("retryable"):
+            return {
+                "error": body.get("error"),
+                "message": "Dependency unavailable, retry later",
+                "retryable": True
+            }, 503, {"Retry-After": "1"}
+
+    return {
+        "action": action,
+        "result": verbosity.shape(action, result, level)
+    }, 200, {}
+
+# (body, status, headers) of an event that failed with `e`
+def event_error(e):
+    # Malformed event: rejected before touching Zoho or AWS
+    if isinstance(e, EventValidationError):
+        return {
+            "error": str(e),
+            "message": "Invalid event"
+        }, 400, {}
+
+    # Admission control: the event was shed because it cannot be finished in budget
+    if isinstance(e, admission.LoadShed):
+        return {
+            "error": f"Service overloaded: {e.reason}",
+            "message": "Event rejected, retry later"
+        }, e.status, {"Retry-After": str(e.retry_after)}
+
+    # The same event is still being processed elsewhere
+    if isinstance(e, singleflight.DuplicateInFlight):
+        return {
+            "error": str(e),
+            "message": "Duplicate event in progress, retry later",
+            "retryable": True
+        }, 409, {"Retry-After": str(e.retry_after)}
+
+    # The event ran out of budget: safe to retry
+    if isinstance(e, (deadline.DeadlineExceeded,) + TIMEOUT_ERRORS):
+        return {
+            "error": str(e),
+            "message": "Deadline exceeded, retry later",
+            "retryable": True
+        }, 504, {}
+
+    # A dependency's circuit breaker is open: fail fast with a retryable response
+    if isinstance(e, CircuitOpenError):
+        return {
+            "error": str(e),
+            "message": "Dependency unavailable, retry later",
+            "retryable": True
+        }, 503, {"Retry-After": str(e.retry_after)}
+
+    return {
+        "error": str(e),
+        "message": "Operation failed"
+    }, 500, {}
+
 # Define route for handling events
 @app.route('/event', methods=['POST'])
 
@@ -20,47 +121,164 @@ def handle_event():
         if not event:
             return jsonify({"error": "No JSON data received"}), 400
 
-        action = event.get("Action__c", "")
-        
-        if action == "CreateZohoAccount":
-            result = run_customer_create(event)
-
-        elif action == "Buyer":
-            inside_payload = json.loads(event.get("Payload__c"))
-            if inside_payload.get("invoice").get("ZohoInvoiceId"):
-                result = run_update_address(event)
-            else:
-                result = run_invoice_create(event)
-    
-        elif action == "Seller_Technology_Fee":
-            result = run_seller_tech_invoice_create(event)
-    
-        elif action == "X1VP_Subscription":
-            result = run_x1vp_subscription(event)
-
-        elif action == "get_invoice":
-            result = run_get_invoice(event)
+        body, status, headers = handle(event, request.headers)
 
-        else:
-            return jsonify({"error": f"Invalid action: {action}"}), 400
-        
-        return jsonify({
-            "action": action,
-            "result": result
-        }), 200
+    except Exception as e:
+        body, status, headers = event_error(e)
+
+    return jsonify(body), status, headers
+
+# (body, status, headers) of an event; shared with the queue consumer in src/consumer.py
+def handle(event, request_headers):
+    # Every log line of the event carries its invoice number / record id, and
+    # every external call is a span of the event's trace. Profiled on request (X-Profile)
+    with log.correlation(event), tracing.trace("handle_event", request_headers.get(tracing.TRACEPARENT_HEADER),
+                                               action=event.get("Action__c"), invoice_number=log.current_correlation_id()) as span, \
+            profiling.profile(event.get("Action__c"), log.current_correlation_id(), request_headers.get(profiling.PROFILE_HEADER)):
+        body, status, headers = process_event(event, request_headers)
+        span.set(status=status)
+    return body, status, headers
+
+def process_event(event, request_headers):
+    action = event.get("Action__c", "")
+    if action not in ACTIONS:
+        return {"error": f"Invalid action: {action}"}, 400, {}
+
+    try:
+        # Events naming a tenant get its credentials and configuration from the registry
+        resolved = tenants.resolve(event)
+
+        # Parse Payload__c once and validate the event before any network call
+        model = parse_event(action, resolved)
+
+        # How much of the result goes back to the caller
+        level = verbosity.level_for(request_headers.get(verbosity.VERBOSITY_HEADER))
+
+        # Replays of an event that already completed are answered from the result cache.
+        # Keyed on the event as sent, so a registry reload does not change its key
+        idempotency_key = idempotency.key_for(action, event, request_headers.get(idempotency.IDEMPOTENCY_HEADER), model)
+        replayed = idempotency.lookup(idempotency_key)
+        if replayed is not None:
+            return {
+                "action": action,
+                "result": verbosity.shape(action, replayed, level),
+                "replayed": True
+            }, 200, {}
+
+        # Deadline budget for the whole event, propagated to every external call
+        budget = deadline.budget_for(action, request_headers.get(deadline.DEADLINE_HEADER))
+
+        # Duplicates of an event already in flight wait for it and share its result
+        result = singleflight.do(action, event, lambda: run_admitted(action, resolved, model, budget, idempotency_key), wait_timeout=budget)
+        return event_response(action, result, level)
 
     except Exception as e:
-        return jsonify({
+        logger.warning("Event failed", action=action, error=str(e), error_type=type(e).__name__)
+        return event_error(e)
+
+# Copies requested from the PDF route, or raises ValueError
+def pdf_copies(value):
+    if value is None:
+        return None
+    copies = int(value)
+    if not 1 <= copies <= invoice_pdf.MAX_COPIES:
+        raise ValueError
+    return copies
+
+# Bucket a PDF request reads: the one its signed URL names, INVOICE_BUCKET when it names none;
+# None when the URL was not handed out by invoice_pdf.invoice_url
+def pdf_bucket(invoice_number, args):
+    bucket_name = args.get("bucket") or invoice_pdf.INVOICE_BUCKET
+    if not bucket_name or not invoice_pdf.verify_url_token(bucket_name, invoice_number, args.get("date"), args.get("token")):
+        return None
+    return bucket_name
+
+# (body, status, headers) of a PDF request that failed with `e`
+def pdf_error(e):
+    if isinstance(e, invoice_pdf.InvoicePdfNotFound):
+        return {"error": str(e)}, 404, {}
+
+    if isinstance(e, admission.LoadShed):
+        return {
+            "error": f"Service overloaded: {e.reason}",
+            "message": "Request rejected, retry later"
+        }, e.status, {"Retry-After": str(e.retry_after)}
+
+    if isinstance(e, (deadline.DeadlineExceeded, CircuitOpenError)):
+        return {
             "error": str(e),
-            "message": "Operation failed"
-        }), 500
+            "message": "Dependency unavailable, retry later",
+            "retryable": True
+        }, 503, {"Retry-After": str(getattr(e, "retry_after", 1))}
+
+    return {
+        "error": str(e),
+        "message": "Operation failed"
+    }, 500, {}
+
+# Invoice PDF route: assembles the requested copies from the stored master PDF. Serves only
+# the signed URLs given to Salesforce (`date` is the invoice date, which locates masters
+# stored under the date key layout)
+@app.route('/invoice/<invoice_number>/pdf', methods=['GET'])
+def invoice_pdf_route(invoice_number):
+    try:
+        copies = pdf_copies(request.args.get("copies"))
+    except ValueError:
+        return jsonify({"error": f"copies must be a number from 1 to {invoice_pdf.MAX_COPIES}"}), 400
+    annexure = request.args.get("annexure", "1").lower() not in ("0", "false", "no")
+
+    bucket_name = pdf_bucket(invoice_number, request.args)
+    if bucket_name is None:
+        return jsonify({"error": "Not found"}), 404
+
+    try:
+        budget = deadline.budget_for("get_invoice_pdf", request.headers.get(deadline.DEADLINE_HEADER))
+        with admission.admit("get_invoice_pdf"), deadline.scope(budget):
+            content = invoice_pdf.render_invoice_pdf(invoice_number, copies, annexure, bucket_name, request.args.get("date"))
+        return Response(content, mimetype="application/pdf", headers={
+            "Content-Disposition": f'inline; filename="{invoice_number}.pdf"'
+        })
+
+    except Exception as e:
+        body, status, headers = pdf_error(e)
+        return jsonify(body), status, headers
+
+# Profiles written by the profiling hook (src/profiling.py)
+@app.route('/profiles', methods=['GET'])
+def profiles_route():
+    if not profiling.authorized(request.headers.get(profiling.PROFILE_HEADER)):
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({"profiles": profiling.list_profiles()}), 200
+
+@app.route('/profiles/<name>', methods=['GET'])
+def profile_route(name):
+    artifact = profiling.read_artifact(name) if profiling.authorized(request.headers.get(profiling.PROFILE_HEADER)) else None
+    if artifact is None:
+        return jsonify({"error": "Not found"}), 404
+    content, content_type = artifact
+    return Response(content, mimetype=content_type)
 
 # Health check route
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"action": "healthy"}), 200
+    return jsonify({"action": "healthy", "circuit_breakers": breaker_status()}), 200
+
+# Dependency reachability and latency from the last background probe
+@app.route('/health/deep', methods=['GET'])
+def deep_health_check():
+    body, status = health.deep_report()
+    return jsonify(dict(body, circuit_breakers=breaker_status())), status
+
+# Admission control metrics route
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify(dict(admission.metrics(), log_lines_dropped=log.dropped_lines(), trace_spans_dropped=tracing.dropped_spans(),
+                                audit_entries_dropped=audit.dropped_entries())), 200
 
 
 # Run the Flask application
 if __name__ == '__main__':
+    # Open connections and load the PDF libraries before the first event, then probe
+    # the dependencies in the background for /health/deep (src/health.py)
+    health.start()
     app.run(debug=True, host='0.0.0.0', port=8080)
@@ -0,0 +1,192 @@
+"""
+Admission control and load shedding for the /event endpoint.
+
+Tracks in-flight and queued events together with a moving average of the latency
+of every external dependency (Zoho, S3, DynamoDB, EventBridge, SES). A new event is
+only admitted when it can be started within the queue budget and its estimated
+completion time fits inside the latency budget; otherwise it is rejected early with
+a 429 (too many events) or 503 (dependencies too slow) and a Retry-After hint.
+
+Configuration (environment variables):
+    ADMISSION_MAX_INFLIGHT     events allowed to run at the same time (default 8)
+    ADMISSION_MAX_QUEUED       events allowed to wait for a free slot (default 16)
+    ADMISSION_QUEUE_TIMEOUT    seconds a queued event may wait for a slot (default 5)
+    ADMISSION_LATENCY_BUDGET   seconds an admitted event may take end to end (default 30)
+    ADMISSION_LATENCY_WINDOW   seconds after which a latency sample is considered stale, so a
+                               shedding dependency is probed again (default 30)
+"""
+
+import math
+import os
+import threading
+import time
+
+# Smoothing factor for the latency moving averages
+EWMA_ALPHA = 0.2
+
+# Expected number of calls per dependency for each action, used to estimate how long
+# an event will take from the observed per-dependency latency.
+ACTION_DEPENDENCIES = {
+    "CreateZohoAccount": {"dynamodb": 2, "zoho": 3, "eventbridge": 1},
+    "BulkCreateZohoAccount": {"dynamodb": 2, "zoho": 3, "eventbridge": 1},
+    "Buyer": {"dynamodb": 2, "zoho": 4, "s3": 1, "eventbridge": 1},
+    "Seller_Technology_Fee": {"dynamodb": 2, "zoho": 4, "s3": 1, "eventbridge": 1},
+    "X1VP_Subscription": {"dynamodb": 2, "zoho": 4, "s3": 1, "eventbridge": 1},
+    "get_invoice": {"zoho": 2, "s3": 1},
+    "get_invoice_pdf": {"s3": 2},
+}
+
+
+class LoadShed(Exception):
+    """Raised when an event is rejected by admission control."""
+
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    def __init__(self, max_inflight, max_queued, queue_timeout, latency_budget, latency_window):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.latency_budget = latency_budget
+        self.latency_window = latency_window
+
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._queued = 0
+        self._latency = {}
+        self._event_latency = {}
+        self._admitted = 0
+        self._shed = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_inflight=int(os.environ.get("ADMISSION_MAX_INFLIGHT", "8")),
+            max_queued=int(os.environ.get("ADMISSION_MAX_QUEUED", "16")),
+            queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "5")),
+            latency_budget=float(os.environ.get("ADMISSION_LATENCY_BUDGET", "30")),
+            latency_window=float(os.environ.get("ADMISSION_LATENCY_WINDOW", "30")),
+        )
+
+    # Record the latency of one external call
+    def record_latency(self, dependency, seconds):
+        with self._cond:
+            previous, _ = self._latency.get(dependency, (None, None))
+            average = seconds if previous is None else previous + EWMA_ALPHA * (seconds - previous)
+            self._latency[dependency] = (average, time.monotonic())
+
+    # Estimated seconds for one event of the given action, from recent dependency latency
+    def estimate(self, action):
+        now = time.monotonic()
+        total = 0.0
+        for dependency, calls in ACTION_DEPENDENCIES.get(action, {}).items():
+            average, sampled_at = self._latency.get(dependency, (0.0, now))
+            if now - sampled_at <= self.latency_window:
+                total += average * calls
+        return total
+
+    # Seconds until the oldest latency sample for the action goes stale
+    def _latency_retry_after(self, action):
+        now = time.monotonic()
+        ages = [now - self._latency[dependency][1] for dependency in ACTION_DEPENDENCIES.get(action, {}) if dependency in self._latency]
+        return self.latency_window - max(ages, default=0.0)
+
+    # Estimated seconds an event would wait in the queue before getting a slot
+    def _queue_wait(self):
+        if self._inflight < self.max_inflight:
+            return 0.0
+        average_event = max(self._event_latency.values(), default=0.0)
+        return (self._queued + 1) * average_event / self.max_inflight
+
+    def _reject(self, status, retry_after, reason):
+        self._shed[reason] = self._shed.get(reason, 0) + 1
+        raise LoadShed(status, max(1, int(math.ceil(retry_after))), reason)
+
+    def admit(self, action):
+        """Admit an event or raise LoadShed. Returns a slot to be used as a context manager."""
+        with self._cond:
+            estimate = self.estimate(action)
+            if estimate > self.latency_budget:
+                self._reject(503, self._latency_retry_after(action), "dependency_latency")
+
+            if self._inflight >= self.max_inflight:
+                if self._queued >= self.max_queued:
+                    self._reject(429, self._queue_wait() or self.queue_timeout, "queue_full")
+                if self._queue_wait() + estimate > self.latency_budget:
+                    self._reject(503, self._queue_wait(), "latency_budget")
+
+                # Wait for a free slot
+                self._queued += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self._inflight >= self.max_inflight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject(503, self.queue_timeout, "queue_timeout")
+                        self._cond.wait(remaining)
+                finally:
+                    self._queued -= 1
+
+            self._inflight += 1
+            self._admitted += 1
+        return AdmissionSlot(self, action)
+
+    def _release(self, action, seconds):
+        with self._cond:
+            self._inflight -= 1
+            previous = self._event_latency.get(action)
+            self._event_latency[action] = seconds if previous is None else previous + EWMA_ALPHA * (seconds - previous)
+            self._cond.notify()
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "inflight": self._inflight,
+                "queued": self._queued,
+                "admitted": self._admitted,
+                "shed": dict(self._shed),
+                "shed_total": sum(self._shed.values()),
+                "dependency_latency_seconds": {k: round(v[0], 4) for k, v in self._latency.items()},
+                "event_latency_seconds": {k: round(v, 4) for k, v in self._event_latency.items()},
+                "limits": {
+                    "max_inflight": self.max_inflight,
+                    "max_queued": self.max_queued,
+                    "queue_timeout": self.queue_timeout,
+                    "latency_budget": self.latency_budget,
+                    "latency_window": self.latency_window,
+                },
+            }
+
+
+class AdmissionSlot:
+    def __init__(self, controller, action):
+        self._controller = controller
+        self._action = action
+        self._start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._controller._release(self._action, time.monotonic() - self._start)
+        return False
+
+
+controller = AdmissionController.from_env()
+
+
+def admit(action):
+    return controller.admit(action)
+
+
+def record_latency(dependency, seconds):
+    controller.record_latency(dependency, seconds)
+
+
+def metrics():
+    return controller.metrics()
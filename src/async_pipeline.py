@@ -0,0 +1,275 @@
+"""
+Async variant of the event pipeline, served by the ASGI app in asgi.py.
+
+The synchronous handlers hold one thread per event for all of its Zoho and AWS
+round trips. Here the invoice actions (Buyer, Seller_Technology_Fee,
+X1VP_Subscription) and get_invoice run as coroutines instead: Zoho is called
+through one shared httpx.AsyncClient and DynamoDB and EventBridge through
+aiobotocore, so a single event loop keeps hundreds of events in flight. They send
+the same Zoho payloads and Salesforce events as the synchronous handlers.
+
+Building the master PDF (PyPDF2, reportlab) is CPU-bound and runs in a process
+pool, whose workers import only src/pdf_build.py. The PDF storage backends, SES failure emails and the actions without an
+async handler (account creation, address updates) run their synchronous code in
+a thread pool.
+
+Configuration (environment variables):
+    ASYNC_ZOHO_MAX_CONNECTIONS   pooled connections of the Zoho HTTP client (default 100)
+    ASYNC_PDF_WORKERS            processes building PDFs (default: CPU count)
+    ASYNC_BLOCKING_WORKERS       threads for synchronous calls (default 32)
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import httpx
+from aiobotocore.session import get_session
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from src import deadline, health, pdf_build, taxes, tracing
+from src.circuit_breaker import CircuitOpenError
+from src.create_invoice import build_invoice_payload as build_buyer_payload, invoice_created_entry
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency_async, ZOHO, DYNAMODB, EVENTBRIDGE
+from src.email import send_failure_email
+from src.get_invoice import (TOKEN_URL, copies_of, missing_fields, forced, stored_invoice, token_request_data, access_token_of, pdf_request,
+                             pdf_response_error, master_error, store_invoice, pdf_stage_event, pdf_stage_fits, skipped_pdf_stage,
+                             record_pdf_stage)
+from src.records import compact_invoice
+from src.seller_tech_invoice import build_invoice_payload as build_seller_tech_payload
+from src.subscription import build_invoice_payload as build_subscription_payload
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+ZOHO_MAX_CONNECTIONS = int(os.environ.get("ASYNC_ZOHO_MAX_CONNECTIONS", "100"))
+PDF_WORKERS = int(os.environ.get("ASYNC_PDF_WORKERS", "0")) or os.cpu_count()
+BLOCKING_WORKERS = int(os.environ.get("ASYNC_BLOCKING_WORKERS", "32"))
+
+# Zoho payload, annexure and wording of each invoice action
+INVOICE_ACTIONS = {
+    "Buyer": (build_buyer_payload, lambda event, model: event.get("annexure_data"), "buyer invoice"),
+    "Seller_Technology_Fee": (build_seller_tech_payload, lambda event, model: model.payload.shipments, "seller tech invoice"),
+    "X1VP_Subscription": (build_subscription_payload, lambda event, model: event.get("annexure_data"), "subscription invoice"),
+}
+
+_serializer = TypeSerializer()
+
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+# Set up by startup(); until then PDFs are built in the default thread pool
+pdf_executor = None
+zoho = None
+dynamodb = None
+eventbridge = None
+_clients = None
+
+
+# Open the shared clients and the PDF process pool, once per event loop
+async def startup():
+    global pdf_executor, zoho, dynamodb, eventbridge, _clients
+    _clients = contextlib.AsyncExitStack()
+    zoho = await _clients.enter_async_context(httpx.AsyncClient(limits=httpx.Limits(max_connections=ZOHO_MAX_CONNECTIONS)))
+    session = get_session()
+    dynamodb = await _clients.enter_async_context(session.create_client("dynamodb", config=AWS_CLIENT_CONFIG))
+    eventbridge = await _clients.enter_async_context(session.create_client("events", config=AWS_CLIENT_CONFIG))
+    # Spawned rather than forked: the parent already runs threads (write-behind uploads, executors)
+    pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+# Open the shared clients' connections and start every PDF worker process, so the
+# first events do not pay for them. The synchronous clients are warmed by src/health.py
+async def warm_up():
+    async def quietly(name, call):
+        try:
+            await call
+        except Exception as e:
+            # Any answer opened the connection; only failing to connect is worth a line
+            if not isinstance(e, ClientError):
+                logger.warning("Warm-up call failed", call=name, error=str(e))
+
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    await asyncio.gather(
+        *(quietly(name, zoho.head(url, timeout=health.PROBE_TIMEOUT))
+          for name, url in health.ZOHO_HOSTS.items() for _ in range(health.WARMUP_ZOHO_CONNECTIONS)),
+        quietly("dynamodb", dynamodb.describe_limits()),
+        quietly("eventbridge", eventbridge.list_event_buses(Limit=1)),
+        # Concurrent submissions make the pool spawn all of its workers now
+        *(loop.run_in_executor(pdf_executor, pdf_build.warm_worker) for _ in range(PDF_WORKERS)))
+    logger.info("Async pipeline warmed up", seconds=round(time.monotonic() - start, 3), pdf_workers=PDF_WORKERS)
+
+
+async def shutdown():
+    global pdf_executor
+    await _clients.aclose()
+    pdf_executor.shutdown()
+    pdf_executor = None
+
+
+# Run a synchronous call in the thread pool, under the caller's deadline, correlation id and span
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Copied here, on the loop thread: inside the pool it would copy the worker's empty context
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, functools.partial(context.run, fn, *args, **kwargs))
+
+
+def _marshal(item):
+    return {key: _serializer.serialize(value) for key, value in item.items()}
+
+
+async def _zoho_token(event):
+    return await call_dependency_async(ZOHO, zoho.post, TOKEN_URL, data=token_request_data(event))
+
+
+async def _email(subject, message, event):
+    await run_blocking(send_failure_email, subject, message, event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
+
+
+# Async get_invoice_function: the same steps (src/get_invoice.py), awaited or offloaded
+async def get_invoice_async(event, read_through=False):
+    invoice_number = event.get("invoice_number")
+    copies = copies_of(event)
+
+    error = missing_fields(event)
+    if error:
+        return error
+
+    try:
+        if read_through and not forced(event):
+            result = await run_blocking(stored_invoice, event, copies)
+            if result is not None:
+                return result
+        token_response = await _zoho_token(event)
+        access_token, error = access_token_of(token_response)
+        if error:
+            return error
+        invoice_pdf_url, headers = pdf_request(event, access_token)
+        response = await call_dependency_async(ZOHO, zoho.get, invoice_pdf_url, headers=headers)
+    except CircuitOpenError as e:
+        return {"error": str(e), "retryable": True}, 503
+    error = pdf_response_error(response)
+    if error:
+        return error
+
+    try:
+        loop = asyncio.get_running_loop()
+        # Annexure and merge, in the process pool
+        with tracing.span("pdf merge", invoice_number=invoice_number, bytes=len(response.content)) as span:
+            pdf_content, invoice_pages, annexure_pages, annexure_error = await loop.run_in_executor(
+                pdf_executor, pdf_build.build_master, response.content, event.get("annexure_data"))
+            span.set(output_bytes=len(pdf_content), pages=invoice_pages, annexure_pages=annexure_pages)
+    except Exception as pdf_error:
+        return {"error": f"Failed to read PDF from Zoho: {str(pdf_error)}"}, 400
+    error = master_error(invoice_number, invoice_pages, annexure_error)
+    if error:
+        return error
+
+    return await run_blocking(store_invoice, event, copies, pdf_content, invoice_pages, annexure_pages)
+
+
+# Async create_invoice_function / seller_tech_invoice_function / subscription_function
+async def create_invoice_async(action, event, model):
+    build_payload, annexure_of, label = INVOICE_ACTIONS[action]
+    org_id = event.get("org_id")
+    invoice_table = event.get("invoice_table")
+    invoice_number = event.get("InvoiceNumber__c")
+    payload_model = model.payload
+    account = payload_model.account
+
+    cloudwatch_payload = {}
+
+    if not all([event.get("client_id"), event.get("client_secret"), event.get("refresh_token"), org_id]):
+        return {"error": "Missing required fields: client_id, client_secret, refresh_token, org_id"}
+
+    if event.get("overseas_flag") == "0" and account.gst_treatment == "Overseas":
+        await _email(f"Invalid GST Treatment for {label.title()}", f"Cannot create invoice for Overseas GST Treatment when overseas_flag is 0 for Invoice_Number {invoice_number}.", event)
+        return {"error": "Cannot create invoice for Overseas GST Treatment when overseas_flag is 0"}
+
+    dynamodb_payload = {
+        "Invoice_Number": invoice_number,
+        "Customer_ID": account.zoho_account_id,
+    }
+
+    existing = await call_dependency_async(DYNAMODB, dynamodb.get_item, TableName=invoice_table, Key=_marshal({"Invoice_Number": invoice_number}),
+                                           ProjectionExpression="Invoice_Number")
+    if "Item" in existing:
+        await _email("Duplicate Invoice Creation Attempt", f"Invoice with Invoice_Number {invoice_number} already exists in Zoho, and Salesforce is sending playload with null Zoho invoice ID.", event)
+        return {"error": "Invoice with this Invoice_Number already exists in Zoho, and Salesforce is sending playload with null Zoho invoice ID."}
+
+    token_response = await _zoho_token(event)
+    if token_response.status_code != 200:
+        await _email("Zoho Token Generation Failed", "Failed to generate access token for Zoho Books API.", event)
+        return {"error": "Failed to generate access token"}
+    access_token = token_response.json().get("access_token")
+
+    create_invoice_url = f"https://www.zohoapis.in/books/v3/invoices?organization_id={org_id}"
+    headers = {
+        "Authorization": f"Zoho-oauthtoken {access_token}",
+        "Content-Type": "application/json"
+    }
+    if event.get("prod_flag") == "1":
+        # Reading the organization's Zoho taxes blocks: done here, not in build_payload on the event loop
+        await run_blocking(taxes.table_for, event)
+    payload = build_payload(event, model)
+    cloudwatch_payload["zoho_payload"] = payload
+    response = await call_dependency_async(ZOHO, zoho.post, create_invoice_url, headers=headers, json=payload)
+
+    create_invoice_response = {
+        "API_Status": response.status_code,
+        "API_Timestamp": str(datetime.now())
+    }
+
+    if response.status_code != 201:
+        await _email("Zoho Invoice Creation Failed", f"Failed to create {label} for Id {invoice_number} in Zoho Books: {response.text}", event)
+        return {"error": "Failed to create invoice", "details": response.json()}
+
+    # The invoice exists in Zoho now, the bookkeeping below must run to completion
+    deadline.commit()
+    invoice = response.json().get("invoice", {})
+    dynamodb_payload["Zoho_Invoice_ID"] = invoice.get("invoice_id")
+    dynamodb_payload["Invoice_Date"] = invoice.get("date")
+
+    get_event = pdf_stage_event(event, payload_model.invoice.sf_invoice_id, account.invoice_copies, invoice, annexure_of(event, model))
+    body, status_code = await get_invoice_async(get_event) if pdf_stage_fits() else skipped_pdf_stage()
+    get_invoice_response, failed = record_pdf_stage(get_event, body, status_code, dynamodb_payload, cloudwatch_payload)
+    if failed:
+        await _email("Get Invoice Function Failed", f"Either Failed to get {label} of Id {invoice_number} or failed to store in S3. No Invoice URL on Salesforce. Error: {body.get('error')}", event)
+
+    dynamodb_payload["Create_Invoice"] = {
+        "CREATE_Invoice_Response": create_invoice_response,
+        "GET_Invoice_Response": get_invoice_response
+    }
+
+    try:
+        await call_dependency_async(EVENTBRIDGE, eventbridge.put_events,
+                                    Entries=[invoice_created_entry(event, dynamodb_payload, payload_model.invoice.sf_invoice_id)])
+        dynamodb_payload["Salesforce"] = "Published"
+    except Exception as e:
+        await _email("AWS Salesforce EventBridge Failed", f"Failed to send event to Salesforce via EventBridge for {label}: {invoice_number}. Error: {str(e)}", event)
+        cloudwatch_payload["Salesforce_EventBridge_Error"] = str(e)
+        dynamodb_payload["Salesforce"] = "Failed"
+
+    try:
+        await call_dependency_async(DYNAMODB, dynamodb.put_item, TableName=invoice_table, Item=_marshal(compact_invoice(dynamodb_payload)))
+        cloudwatch_payload["DynamoDB_Insertion"] = "Success"
+    except Exception as e:
+        await _email("DynamoDB Insertion Failed", f"Failed to store {label}: {invoice_number} details in DynamoDB. Error: {str(e)}", event)
+        cloudwatch_payload["DynamoDB_Insertion_Error"] = str(e)
+    return cloudwatch_payload
+
+
+# Coroutine handling the action, or None when it only has a synchronous handler
+def handler_for(action, model):
+    if action in INVOICE_ACTIONS and not (action == "Buyer" and model.is_address_update):
+        return lambda event, model: create_invoice_async(action, event, model)
+    if action == "get_invoice":
+        # Answered from the stored PDF unless it is missing or the event sets `force`
+        return lambda event, model: get_invoice_async(event, read_through=True)
+    return None
@@ -0,0 +1,261 @@
+"""
+Append-only audit store for the per-call history of invoices and accounts.
+
+The Zoho API statuses, timestamps and error details that used to be nested maps
+on the DynamoDB items (see src/records.py) are recorded here instead:
+
+    audit.record("invoice", invoice_number, {"Create_Invoice": {...}})
+
+`record` only queues the entry. A background thread appends the queue in
+batches to a local file, one gzip member per batch (`zcat` reads the whole
+file), and rotates it by size and age. Rotated files are shipped to
+AUDIT_BUCKET in one upload each, under <AUDIT_PREFIX><yyyy>/<mm>/<dd>/, and
+deleted once uploaded. Each process writes its
+own file; files left open by a process that has exited are rotated and shipped
+by the next one to start. Every entry is one JSON line:
+
+    {"ts": 1718000000.123, "table": "invoice", "key": "INV-1", "correlation_id": "INV-1", "fields": {...}}
+
+When the queue is full entries are dropped and counted rather than delaying the
+request (batch jobs wait instead).
+
+Files kept only in AUDIT_DIR would be lost with the container on the next
+deploy, so the file store needs AUDIT_BUCKET: without it no store is started and
+`durable()` is false. Until it is true (or AUDIT_STORE is none, which discards
+the history on purpose) the table items keep their legacy shape (src/records.py)
+and migrate_records refuses to apply.
+
+Configuration (environment variables):
+    AUDIT_STORE           file or none (default file)
+    AUDIT_DIR             directory of the audit files (default /tmp/audit)
+    AUDIT_BUCKET          S3 bucket the rotated files are shipped to (default unset: no audit store)
+    AUDIT_PREFIX          key prefix of the shipped files (default audit/)
+    AUDIT_ROTATE_BYTES    compressed size at which a file is rotated (default 33554432)
+    AUDIT_ROTATE_SECONDS  age at which a file is rotated (default 3600)
+    AUDIT_FLUSH_SECONDS   longest time an entry waits in the queue (default 5)
+    AUDIT_QUEUE_SIZE      entries buffered before dropping (default 10000)
+"""
+
+import atexit
+import gzip
+import json
+import os
+import queue
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+import boto3
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, S3
+from src.log import current_correlation_id, get_logger
+
+logger = get_logger(__name__)
+
+AUDIT_STORE = os.environ.get("AUDIT_STORE", "file")
+AUDIT_DIR = os.environ.get("AUDIT_DIR", "/tmp/audit")
+AUDIT_BUCKET = os.environ.get("AUDIT_BUCKET")
+AUDIT_PREFIX = os.environ.get("AUDIT_PREFIX", "audit/")
+ROTATE_BYTES = int(os.environ.get("AUDIT_ROTATE_BYTES", str(32 * 1024 * 1024)))
+ROTATE_SECONDS = float(os.environ.get("AUDIT_ROTATE_SECONDS", "3600"))
+FLUSH_SECONDS = float(os.environ.get("AUDIT_FLUSH_SECONDS", "5"))
+QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", "10000"))
+BATCH_SIZE = 1000
+
+# Queued by flush: the writer thread writes what it holds and exits
+_STOP = object()
+
+OPEN_SUFFIX = ".jsonl.gz.open"
+CLOSED_SUFFIX = ".jsonl.gz"
+_OPEN_NAME = re.compile(r"^audit-(?P<host>.+)-(?P<pid>\d+)-\d{8}T\d{6}" + re.escape(OPEN_SUFFIX) + "$")
+
+
+# Numbers read back from DynamoDB are Decimals
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class FileAuditStore:
+    def __init__(self, directory, bucket=None, prefix=AUDIT_PREFIX):
+        self.directory = directory
+        self.bucket = bucket
+        self.prefix = prefix
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._s3 = boto3.client("s3", config=AWS_CLIENT_CONFIG) if bucket else None
+        self._path = None
+        self._opened_at = 0
+        os.makedirs(directory, exist_ok=True)
+        self._close_abandoned()
+        self._start()
+        atexit.register(self.flush)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def record(self, table, key, fields, block=False):
+        entry = {"ts": round(time.time(), 3), "table": table, "key": key, "correlation_id": current_correlation_id(), "fields": fields}
+        try:
+            self._queue.put(entry, block=block)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _drain(self):
+        batch = []
+        while len(batch) < BATCH_SIZE:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(entry)
+            if entry is _STOP:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=FLUSH_SECONDS)]
+            except queue.Empty:
+                batch = []
+            # Let a batch build up: one gzip member per batch compresses far better than one per entry
+            if batch and batch[-1] is not _STOP and self._queue.qsize() < BATCH_SIZE:
+                time.sleep(min(FLUSH_SECONDS, 1.0))
+            if not batch or batch[-1] is not _STOP:
+                batch.extend(self._drain())
+            stop = _STOP in batch
+            if stop:
+                batch = batch[:batch.index(_STOP)]
+            try:
+                if batch:
+                    self._append(batch)
+                if self._path and time.time() - self._opened_at >= ROTATE_SECONDS:
+                    self._rotate()
+                if not stop:
+                    self._ship()
+            except Exception as e:
+                logger.error("Failed to write audit entries", count=len(batch), error=str(e))
+            if stop:
+                return
+
+    def _append(self, batch):
+        if self._path is None:
+            name = f"audit-{socket.gethostname()}-{os.getpid()}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}"
+            self._path = os.path.join(self.directory, name + OPEN_SUFFIX)
+            self._opened_at = time.time()
+        data = "".join(json.dumps(entry, default=_json_default) + "\n" for entry in batch).encode()
+        with open(self._path, "ab") as f:
+            f.write(gzip.compress(data))
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.getsize(self._path) >= ROTATE_BYTES:
+            self._rotate()
+
+    def _rotate(self):
+        os.replace(self._path, self._path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+        self._path = None
+
+    # Rotate the files of processes that exited without rotating theirs
+    def _close_abandoned(self):
+        for name in os.listdir(self.directory):
+            match = _OPEN_NAME.match(name)
+            if not match or match.group("host") != socket.gethostname():
+                continue
+            pid = int(match.group("pid"))
+            if pid != os.getpid() and not _pid_alive(pid):
+                path = os.path.join(self.directory, name)
+                os.replace(path, path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+
+    # Upload the rotated files, one object per file
+    def _ship(self):
+        if not self.bucket:
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(CLOSED_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "rb") as f:
+                    body = f.read()
+                key = f"{self.prefix}{datetime.fromtimestamp(os.path.getmtime(path), timezone.utc).strftime('%Y/%m/%d')}/{name}"
+            except FileNotFoundError:
+                # Shipped by another process sharing the directory
+                continue
+            call_dependency(S3, self._s3.put_object, Bucket=self.bucket, Key=key, Body=body,
+                            ContentType="application/x-ndjson", ContentEncoding="gzip")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logger.info("Audit file shipped", key=key, bytes=len(body))
+
+    # Write what is still queued and stop the writer thread, at exit
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    # Write, rotate and ship everything recorded so far (batch jobs, before they exit)
+    def close(self):
+        self.flush()
+        if self._path:
+            self._rotate()
+        self._ship()
+        self._start()
+
+
+class NullAuditStore:
+    dropped = 0
+
+    def record(self, table, key, fields, block=False):
+        pass
+
+    def close(self):
+        pass
+
+
+def create_store(kind=AUDIT_STORE):
+    if kind == "none":
+        return NullAuditStore()
+    if kind == "file":
+        # Without a bucket the history stays on the table items: nothing to write
+        if not AUDIT_BUCKET:
+            return NullAuditStore()
+        return FileAuditStore(AUDIT_DIR, AUDIT_BUCKET)
+    raise ValueError(f"Unknown AUDIT_STORE: {kind}")
+
+
+store = create_store()
+
+
+# Queue an entry; batch jobs pass block=True to wait for room instead of dropping it
+def record(table, key, fields, block=False):
+    if fields:
+        store.record(table, key, fields, block)
+
+
+# Whether recorded history outlives this host: shipped to S3, or deliberately not kept
+def durable():
+    return AUDIT_STORE == "none" or bool(getattr(store, "bucket", None))
+
+
+# Entries dropped because the writer thread fell behind
+def dropped_entries():
+    return store.dropped
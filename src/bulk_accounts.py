@@ -0,0 +1,253 @@
+"""
+Bulk account onboarding: creates the Zoho Books contacts of many Salesforce
+accounts in one event instead of one /event call per account.
+
+The BulkCreateZohoAccount event carries the shared credentials and table names
+of a CreateZohoAccount event, plus `Accounts__c`: a list (or JSON string) of
+account objects with the per-account fields (RecordID__c, TradeName__c,
+AccountType__c, addresses, GST and MSME details). Fields of an account override
+the shared ones.
+
+The pipeline fetches one access token, prefetches the existing account records
+with batch_get_item, creates the missing customer/vendor contacts concurrently
+under the organization's Zoho rate limit, then publishes the Salesforce events
+in groups of 10 and writes the account records with batch_write_item in groups
+of 25. A single failure email lists every account that failed. Accounts that are
+complete already are republished to Salesforce, like CreateZohoAccount does.
+
+Configuration (environment variables):
+    BULK_ACCOUNT_CONCURRENCY   contacts created at the same time (default 8)
+    BULK_CONTACT_MIN_SECONDS   deadline budget needed to start a contact creation (default 5)
+"""
+
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import boto3
+from src import deadline
+from src.create_account import build_contact_payload, build_vendor_payload, create_zoho_contact, salesforce_account_entry
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, ZOHO, zoho_http, DYNAMODB, EVENTBRIDGE
+from src.email import send_failure_email
+from src.rate_limit import zoho_limiter
+from src.records import compact_account
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+dynamodb = boto3.resource('dynamodb', config=AWS_CLIENT_CONFIG)
+eventbridge = boto3.client('events', config=AWS_CLIENT_CONFIG)
+
+CONCURRENCY = int(os.environ.get("BULK_ACCOUNT_CONCURRENCY", "8"))
+CONTACT_MIN_SECONDS = float(os.environ.get("BULK_CONTACT_MIN_SECONDS", "5"))
+
+# Service limits of the batched AWS calls
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+EVENTBRIDGE_BATCH_SIZE = 10
+BATCH_RETRIES = 5
+BATCH_RETRY_BACKOFF = 0.1
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# Existing account records by Account_ID, read with batch_get_item
+def prefetch_accounts(table_name, account_ids):
+    existing = {}
+    for chunk in _chunks(account_ids, BATCH_GET_SIZE):
+        request_items = {table_name: {"Keys": [{"Account_ID": account_id} for account_id in chunk]}}
+        for attempt in range(BATCH_RETRIES + 1):
+            response = call_dependency(DYNAMODB, dynamodb.batch_get_item, RequestItems=request_items)
+            for item in response.get("Responses", {}).get(table_name, []):
+                existing[item["Account_ID"]] = item
+            request_items = response.get("UnprocessedKeys")
+            if not request_items:
+                break
+            time.sleep(BATCH_RETRY_BACKOFF * (2 ** attempt))
+        else:
+            raise RuntimeError(f"DynamoDB did not return {len(request_items[table_name]['Keys'])} account records after {BATCH_RETRIES} retries")
+    return existing
+
+
+# Write account records with batch_write_item; returns the Account_IDs that could not be written
+def write_accounts(table_name, items):
+    failed = []
+    for chunk in _chunks(items, BATCH_WRITE_SIZE):
+        request_items = {table_name: [{"PutRequest": {"Item": compact_account(item)}} for item in chunk]}
+        try:
+            for attempt in range(BATCH_RETRIES + 1):
+                response = call_dependency(DYNAMODB, dynamodb.batch_write_item, RequestItems=request_items)
+                request_items = response.get("UnprocessedItems")
+                if not request_items:
+                    break
+                time.sleep(BATCH_RETRY_BACKOFF * (2 ** attempt))
+            else:
+                failed.extend(request["PutRequest"]["Item"]["Account_ID"] for request in request_items[table_name])
+        except Exception as e:
+            logger.error("Failed to write account records", count=len(chunk), error=str(e))
+            failed.extend(item["Account_ID"] for item in chunk)
+    return failed
+
+
+# Publish EventBridge entries in groups of 10; returns the error of each entry (None when published)
+def publish_entries(entries):
+    errors = []
+    for chunk in _chunks(entries, EVENTBRIDGE_BATCH_SIZE):
+        try:
+            response = call_dependency(EVENTBRIDGE, eventbridge.put_events, Entries=chunk)
+            results = response.get("Entries") or [{}] * len(chunk)
+            errors.extend(result.get("ErrorMessage") or result.get("ErrorCode") for result in results)
+        except Exception as e:
+            errors.extend([str(e)] * len(chunk))
+    return errors
+
+
+# Create one contact under the organization's rate limit and the event deadline
+def _create_contact(limiter, create_account_url, headers, payload):
+    if not deadline.has_budget(CONTACT_MIN_SECONDS):
+        return {"status": 504, "contact_id": None, "body": {"error": "Skipped, not enough deadline budget left"}, "text": "Skipped, not enough deadline budget left", "timestamp": str(datetime.now())}
+    if not limiter.acquire(timeout=deadline.remaining()):
+        return {"status": 429, "contact_id": None, "body": {"error": "Zoho rate limit wait exceeds the deadline"}, "text": "Zoho rate limit wait exceeds the deadline", "timestamp": str(datetime.now())}
+    return create_zoho_contact(create_account_url, headers, payload)
+
+
+def bulk_create_account_function(event, model=None):
+    client_id = event.get("client_id")
+    client_secret = event.get("client_secret")
+    refresh_token = event.get("refresh_token")
+    org_id = event.get("org_id")
+    account_table = event.get("account_table")
+    sender, reciever = event.get("failure_mail_sender"), event.get("failure_mail_reciever")
+
+    # Every account inherits the shared fields of the event
+    shared = {k: v for k, v in event.items() if k != "Accounts__c"}
+    accounts = [dict(shared, **account) for account in model.accounts]
+    account_ids = [account["RecordID__c"] for account in accounts]
+
+    existing = prefetch_accounts(account_table, account_ids)
+
+    # Contacts still missing for each account; a retry only creates the missing side
+    results = {}
+    contacts = []
+    for account in accounts:
+        sf_account_id = account["RecordID__c"]
+        item = existing.get(sf_account_id, {})
+        if not item.get("Zoho_Customer_ID"):
+            contacts.append((sf_account_id, "customer"))
+        if account.get("AccountType__c") == "Seller" and not item.get("Zoho_Vendor_ID"):
+            contacts.append((sf_account_id, "vendor"))
+        results[sf_account_id] = {"RecordID__c": sf_account_id, "Account_Type": account.get("AccountType__c")}
+
+    created = {}
+    if contacts:
+        # Generate access token, shared by every contact creation
+        generate_access_token_url = "https://accounts.zoho.in/oauth/v2/token"
+        data = {
+            "refresh_token": refresh_token,
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "redirect_uri": "http://www.zoho.in/books",
+            "grant_type": "refresh_token"
+        }
+        token_response = call_dependency(ZOHO, zoho_http.post, generate_access_token_url, data=data)
+        access_token = token_response.json().get("access_token") if token_response.status_code == 200 else None
+        if not access_token:
+            send_failure_email("Zoho Token Generation Failed", "Failed to generate access token for Zoho Books API.", sender, reciever)
+            return {"error": "Failed to generate access token"}
+
+        create_account_url = f"https://www.zohoapis.in/books/v3/contacts?organization_id={org_id}"
+        headers = {
+            "Authorization": f"Zoho-oauthtoken {access_token}",
+            "Content-Type": "application/json"
+        }
+        by_id = {account["RecordID__c"]: account for account in accounts}
+        limiter = zoho_limiter(org_id)
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+            futures = {}
+            for sf_account_id, contact_type in contacts:
+                payload = build_contact_payload(by_id[sf_account_id])
+                payload = build_vendor_payload(by_id[sf_account_id], payload) if contact_type == "vendor" else dict(payload, contact_type="customer")
+                futures[(sf_account_id, contact_type)] = executor.submit(contextvars.copy_context().run, _create_contact, limiter, create_account_url, headers, payload)
+            created = {key: future.result() for key, future in futures.items()}
+
+    # Account records and Salesforce events of every account
+    items = {}
+    publish = []
+    failures = []
+    for account in accounts:
+        sf_account_id = account["RecordID__c"]
+        result = results[sf_account_id]
+        item = dict(existing.get(sf_account_id, {}), Account_ID=sf_account_id, Company_Name=account.get("TradeName__c"), Account_Type=account.get("AccountType__c"))
+        customer = created.get((sf_account_id, "customer"))
+        vendor = created.get((sf_account_id, "vendor"))
+        if customer is None and vendor is None:
+            # Complete already: only republish to Salesforce
+            result["Status"] = "AlreadyExists"
+            result["Zoho_Customer_ID"] = item.get("Zoho_Customer_ID")
+            result["Zoho_Vendor_ID"] = item.get("Zoho_Vendor_ID") or None
+            publish.append(sf_account_id)
+            continue
+
+        if customer:
+            item["Zoho_Customer_ID"] = customer["contact_id"]
+            item["Customer_API_Response"] = {"Customer_API": customer["status"], "Customer_API_timestamp": customer["timestamp"]}
+            result["Customer API Response"] = customer["body"]
+        if vendor:
+            item["Zoho_Vendor_ID"] = vendor["contact_id"]
+            item["Vendor_API_Response"] = {"Vendor_API": vendor["status"], "Vendor_API_timestamp": vendor["timestamp"]}
+            result["Vendor API Response"] = vendor["body"]
+        if account.get("AccountType__c") == "Buyer":
+            item["Zoho_Vendor_ID"] = ""
+        item["Created_At"] = str(datetime.now())
+        result["Zoho_Customer_ID"] = item.get("Zoho_Customer_ID")
+        result["Zoho_Vendor_ID"] = item.get("Zoho_Vendor_ID") or None
+
+        if not item.get("Zoho_Customer_ID"):
+            # Keep a vendor created in the meantime so the retry does not create it again
+            result["Status"] = "Failed"
+            result["error"] = "Failed to create customer account: " + customer["text"]
+            failures.append(f"{sf_account_id} ({account.get('TradeName__c')}): customer creation failed: {customer['text']}")
+            if item.get("Zoho_Vendor_ID"):
+                items[sf_account_id] = item
+            continue
+
+        if vendor and not vendor["contact_id"]:
+            result["Status"] = "PartiallyCreated"
+            failures.append(f"{sf_account_id} ({account.get('TradeName__c')}): vendor creation failed: {vendor['text']}")
+        else:
+            result["Status"] = "Created"
+        items[sf_account_id] = item
+        publish.append(sf_account_id)
+
+    # Send events to Salesforce via EventBridge, grouped
+    entries = [salesforce_account_entry(event.get("event_bus_name"), sf_account_id, results[sf_account_id]["Zoho_Customer_ID"], results[sf_account_id]["Zoho_Vendor_ID"]) for sf_account_id in publish]
+    for sf_account_id, error in zip(publish, publish_entries(entries)):
+        results[sf_account_id]["Salesforce_EventBridge_Response"] = error or "Success"
+        if sf_account_id in items:
+            items[sf_account_id]["Salesforce"] = "Failed" if error else "Published"
+        if error:
+            failures.append(f"{sf_account_id}: Salesforce EventBridge failed: {error}")
+
+    # Insert records into DynamoDB, grouped
+    failed_writes = set(write_accounts(account_table, list(items.values())))
+    for sf_account_id in items:
+        results[sf_account_id]["DynamoDB_Insert"] = "Failed" if sf_account_id in failed_writes else "Success"
+        if sf_account_id in failed_writes:
+            failures.append(f"{sf_account_id}: DynamoDB insertion failed")
+
+    if failures:
+        send_failure_email("Zoho Bulk Account Creation Failed", f"{len(failures)} problem(s) while creating {len(accounts)} accounts in Zoho Books:\n" + "\n".join(failures), sender, reciever)
+
+    statuses = [result["Status"] for result in results.values()]
+    return {
+        "Total": len(accounts),
+        "Created": statuses.count("Created"),
+        "Partially_Created": statuses.count("PartiallyCreated"),
+        "Already_Exists": statuses.count("AlreadyExists"),
+        "Failed": statuses.count("Failed"),
+        "Accounts": [results[sf_account_id] for sf_account_id in account_ids]
+    }
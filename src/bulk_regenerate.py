@@ -0,0 +1,285 @@
+"""
+Bulk regeneration of master invoice PDFs from Zoho Books, for example after a
+template change.
+
+Regenerating through get_invoice_function costs a token request and a PDF
+download per invoice. This job takes one token for the run and asks Zoho for
+the PDF of up to --batch-size invoices in one call (GET /invoices/pdf with
+their ids, Zoho's bulk export), --concurrency batches at a time under the
+organization's rate limit. The combined PDF is split back into one document per
+invoice at page boundaries: a page starts an invoice when it shows that
+invoice's number, and pages that show none (continuation pages) stay with the
+invoice before them. A batch whose pages cannot be told apart (a page showing
+two of the numbers, an invoice missing or split in two) or whose export call
+fails is downloaded again invoice by invoice, with parallel single-invoice GETs;
+--mode single always does that.
+
+Each new master keeps the key (and so the URL) of the one it replaces, its
+annexure pages, copy count, Salesforce id and dates, and is uploaded with the
+batch's other masters through a ConcurrentUploader. Copies are not stored: the
+PDF endpoint assembles them from the master on request (src/invoice_pdf.py).
+
+The invoices come from a JSON-lines file, one object per line with
+`invoice_number` and `zoho_invoice_id` and optionally `invoice_date`, `copies`,
+`sf_invoice_id` and `zoho_last_modified`, or from a parallel Scan of the invoice
+table (every invoice with a Zoho id).
+
+Usage (from the repository root):
+    python -m src.bulk_regenerate --bucket invoice-bucket (--invoices invoices.jsonl | --invoice-table Invoices)
+        [--batch-size 25] [--concurrency 4] [--mode combined|single] [--segments 8] [--output report.json]
+
+Configuration (environment variables, overridden by the matching options):
+    ZOHO_CLIENT_ID, ZOHO_CLIENT_SECRET, ZOHO_REFRESH_TOKEN, ZOHO_ORG_ID
+        Zoho Books credentials and organization
+    PDF_UPLOAD_CONCURRENCY  uploads in flight at once (default 16)
+"""
+
+import argparse
+import contextvars
+import io
+import json
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from PyPDF2 import PdfReader, PdfWriter
+from src.dependencies import call_dependency, ZOHO, zoho_http
+from src.invoice_pdf import storage, locate_master, master_key, master_metadata, master_index
+from src.log import get_logger
+from src.pdf_storage import ConcurrentUploader, STORAGE_BACKEND, UPLOAD_CONCURRENCY
+from src.reconcile import ZohoClient, scan_table, INVOICE_ATTRIBUTES, _invoice_record
+
+logger = get_logger(__name__)
+
+BOOKS_URL = "https://www.zohoapis.in/books/v3"
+# Most invoice ids Zoho exports in one PDF
+MAX_BATCH_SIZE = 25
+
+Job = namedtuple("Job", "invoice_number zoho_id invoice_date copies sf_invoice_id zoho_last_modified")
+
+
+def read_jobs(path):
+    jobs = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            jobs.append(Job(str(row["invoice_number"]), str(row["zoho_invoice_id"]), row.get("invoice_date"),
+                            row.get("copies"), row.get("sf_invoice_id"), row.get("zoho_last_modified")))
+    return jobs
+
+
+def scan_jobs(table_name, segments):
+    invoices = scan_table(table_name, INVOICE_ATTRIBUTES, _invoice_record, segments)
+    return [Job(number, record.zoho_id, record.invoice_date, None, None, None)
+            for number, record in sorted(invoices.items()) if record.zoho_id]
+
+
+def _number_pattern(invoice_number):
+    # INV-1 must not match INV-10; extracted text may run the number into the next word
+    return re.compile(r"(?<![0-9A-Za-z])" + re.escape(invoice_number) + r"(?![0-9])")
+
+
+# Page indexes of each invoice in a combined PDF, by invoice number; None when the pages
+# cannot be told apart
+def split_pages(pages, invoice_numbers):
+    patterns = [(number, _number_pattern(number)) for number in invoice_numbers]
+    segments = []
+    for index, page in enumerate(pages):
+        text = page.extract_text() or ""
+        found = [number for number, pattern in patterns if pattern.search(text)]
+        if len(found) > 1:
+            return None
+        if found and (not segments or segments[-1][0] != found[0]):
+            segments.append((found[0], []))
+        elif not segments:
+            # A first page without any of the numbers
+            return None
+        segments[-1][1].append(index)
+    # Every invoice exactly once, in one run of pages
+    if sorted(number for number, _ in segments) != sorted(invoice_numbers):
+        return None
+    return dict(segments)
+
+
+def _write(pages):
+    writer = PdfWriter()
+    for page in pages:
+        writer.add_page(page)
+    output_pdf = io.BytesIO()
+    writer.write(output_pdf)
+    return output_pdf.getvalue()
+
+
+class Regenerator:
+    """Downloads, splits, rebuilds and uploads the masters of batches of invoices."""
+
+    def __init__(self, zoho, bucket_name, mode="combined", concurrency=4, uploader=None):
+        self.zoho = zoho
+        self.bucket_name = bucket_name
+        self.mode = mode
+        self.concurrency = concurrency
+        # Local backends are written directly; S3 gets a client pooled for the upload workers
+        self.uploader = uploader or ConcurrentUploader(None if STORAGE_BACKEND == "s3" else storage, UPLOAD_CONCURRENCY)
+        # Single-invoice downloads of the batches that fall back to them
+        self._downloads = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-download")
+
+    def _get(self, url, params):
+        self.zoho.limiter.acquire()
+        return call_dependency(ZOHO, zoho_http.get, url, params=params,
+            headers={"Authorization": f"Zoho-oauthtoken {self.zoho.token()}", "X-com-zoho-organizationid": self.zoho.org_id})
+
+    def combined_pdf(self, jobs):
+        response = self._get(f"{BOOKS_URL}/invoices/pdf",
+            {"organization_id": self.zoho.org_id, "invoice_ids": ",".join(job.zoho_id for job in jobs)})
+        if response.status_code != 200 or not response.content:
+            raise RuntimeError(f"Zoho invoice export failed with {response.status_code}: {response.text[:200]}")
+        return response.content
+
+    def single_pdf(self, job):
+        # The query in the URL itself, as get_invoice sends it (and as the tracing span names it)
+        response = self._get(f"{BOOKS_URL}/invoices/{job.zoho_id}?organization_id={self.zoho.org_id}&accept=pdf", None)
+        if response.status_code != 200 or not response.content:
+            raise RuntimeError(f"Zoho PDF download failed with {response.status_code}: {response.text[:200]}")
+        return response.content
+
+    # Invoice pages of every job of a batch by invoice number (an exception for the ones that
+    # could not be downloaded), and whether they came from one combined PDF
+    def download(self, jobs):
+        if self.mode == "combined":
+            try:
+                pages = PdfReader(io.BytesIO(self.combined_pdf(jobs))).pages
+                split = split_pages(pages, [job.invoice_number for job in jobs])
+                if split is not None:
+                    return {number: [pages[index] for index in indexes] for number, indexes in split.items()}, True
+                logger.warning("Combined PDF could not be split, downloading its invoices one by one",
+                               invoices=len(jobs), pages=len(pages))
+            except Exception as e:
+                logger.warning("Combined PDF download failed, downloading its invoices one by one", invoices=len(jobs), error=str(e))
+        futures = {job.invoice_number: self._downloads.submit(contextvars.copy_context().run, self.single_pdf, job) for job in jobs}
+        pages = {}
+        for number, future in futures.items():
+            try:
+                pages[number] = list(PdfReader(io.BytesIO(future.result())).pages)
+            except Exception as e:
+                pages[number] = e
+        return pages, False
+
+    # (key, content, metadata) of the new master of an invoice
+    def build_master(self, job, invoice_pages):
+        key, metadata = locate_master(self.bucket_name, job.invoice_number, job.invoice_date)
+        metadata = metadata or {}
+        annexure = []
+        annexure_pages = int(metadata.get("annexure-pages", "0"))
+        if key and annexure_pages:
+            stored = storage.get(self.bucket_name, key)
+            if stored is not None:
+                annexure = list(PdfReader(io.BytesIO(stored["body"])).pages)[-annexure_pages:]
+        invoice_date = job.invoice_date or metadata.get("invoice-date")
+        content = _write(invoice_pages + annexure)
+        metadata = master_metadata(len(invoice_pages), job.copies or metadata.get("copies", "1"),
+            job.sf_invoice_id or metadata.get("sf-invoice-id"), len(annexure),
+            job.zoho_last_modified or metadata.get("zoho-last-modified"), invoice_date)
+        return key or master_key(job.invoice_number, invoice_date), content, metadata
+
+    def run_batch(self, jobs):
+        start = time.monotonic()
+        pages, combined = self.download(jobs)
+        source = "combined" if combined else "single"
+        results = {}
+        masters = []
+        for job in jobs:
+            result = {"invoice_number": job.invoice_number, "source": source, "key": None, "pages": None, "error": None}
+            results[job.invoice_number] = result
+            if isinstance(pages[job.invoice_number], Exception):
+                result["error"] = str(pages[job.invoice_number])
+                continue
+            try:
+                key, content, metadata = self.build_master(job, pages[job.invoice_number])
+            except Exception as e:
+                result["error"] = f"Failed to build master PDF: {e}"
+                continue
+            result.update(key=key, pages=int(metadata["invoice-pages"]))
+            masters.append((job, key, content, metadata))
+
+        uploads = self.uploader.upload_all([(self.bucket_name, key, content, metadata) for _, key, content, metadata in masters])
+        for (job, key, _, metadata), upload in zip(masters, uploads):
+            if upload["error"]:
+                results[job.invoice_number]["error"] = f"Upload failed: {upload['error']}"
+            else:
+                master_index.remember(self.bucket_name, job.invoice_number, key, metadata)
+        logger.info("Batch regenerated", invoices=len(jobs), source=source, seconds=round(time.monotonic() - start, 3),
+                    failed=sum(1 for result in results.values() if result["error"]))
+        return list(results.values())
+
+    def run(self, jobs, batch_size=MAX_BATCH_SIZE):
+        batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self.run_batch, batch) for batch in batches]
+            results = []
+            for future in futures:
+                results.extend(future.result())
+        self._downloads.shutdown()
+        return results
+
+
+def regenerate(options, jobs):
+    zoho = ZohoClient(options.client_id, options.client_secret, options.refresh_token, options.org_id)
+    start = time.monotonic()
+    results = Regenerator(zoho, options.bucket, options.mode, options.concurrency).run(jobs, options.batch_size)
+    failed = [result for result in results if result["error"]]
+    return {
+        "generated_at": str(datetime.now()),
+        "seconds": round(time.monotonic() - start, 3),
+        "counts": {
+            "invoices": len(results),
+            "regenerated": len(results) - len(failed),
+            "failed": len(failed),
+            "from_combined_pdf": sum(1 for result in results if result["source"] == "combined" and not result["error"]),
+        },
+        "invoices": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", required=True, help="invoice PDF bucket")
+    parser.add_argument("--invoices", help="JSON-lines file of the invoices to regenerate")
+    parser.add_argument("--invoice-table", help="regenerate every invoice of this table that has a Zoho id")
+    parser.add_argument("--client-id", default=os.environ.get("ZOHO_CLIENT_ID"))
+    parser.add_argument("--client-secret", default=os.environ.get("ZOHO_CLIENT_SECRET"))
+    parser.add_argument("--refresh-token", default=os.environ.get("ZOHO_REFRESH_TOKEN"))
+    parser.add_argument("--org-id", default=os.environ.get("ZOHO_ORG_ID"))
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE, help=f"invoices per combined PDF (default and most {MAX_BATCH_SIZE})")
+    parser.add_argument("--concurrency", type=int, default=4, help="batches in flight at once (default 4)")
+    parser.add_argument("--mode", choices=("combined", "single"), default="combined",
+                        help="one combined PDF per batch, or one download per invoice (default combined)")
+    parser.add_argument("--segments", type=int, default=8, help="parallel Scan segments of the invoice table (default 8)")
+    parser.add_argument("--output", help="file for the JSON report (default stdout)")
+    options = parser.parse_args(argv)
+
+    if bool(options.invoices) == bool(options.invoice_table):
+        parser.error("give one of --invoices and --invoice-table")
+    missing = [name for name in ("client_id", "client_secret", "refresh_token", "org_id") if not getattr(options, name)]
+    if missing:
+        parser.error("missing Zoho credentials: " + ", ".join(missing))
+    if not 1 <= options.batch_size <= MAX_BATCH_SIZE:
+        parser.error(f"--batch-size must be between 1 and {MAX_BATCH_SIZE}")
+
+    jobs = read_jobs(options.invoices) if options.invoices else scan_jobs(options.invoice_table, options.segments)
+    report = regenerate(options, jobs)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    else:
+        json.dump(report, sys.stdout, indent=2, default=str)
+        print()
+    print(json.dumps(report["counts"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
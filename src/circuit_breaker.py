@@ -0,0 +1,122 @@
+"""
+Circuit breakers for the external dependencies (Zoho, S3, DynamoDB, EventBridge, SES).
+
+One breaker per dependency is shared by every module in `src/`. After a run of
+consecutive failures the breaker opens and calls fail immediately with
+CircuitOpenError instead of waiting out connect/read timeouts. Once the recovery
+timeout has passed the breaker goes half-open and lets a limited number of trial
+calls through; a success closes it again, a failure re-opens it.
+
+Configuration (environment variables, NAME is the upper-cased dependency name):
+    BREAKER_FAILURE_THRESHOLD          consecutive failures that open a breaker (default 5)
+    BREAKER_RECOVERY_TIMEOUT           seconds a breaker stays open before half-open (default 30)
+    BREAKER_HALF_OPEN_CALLS            trial calls allowed while half-open (default 1)
+    BREAKER_<NAME>_FAILURE_THRESHOLD   per-dependency override, e.g. BREAKER_ZOHO_FAILURE_THRESHOLD
+    BREAKER_<NAME>_RECOVERY_TIMEOUT    per-dependency override
+"""
+
+import math
+import os
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, dependency, retry_after):
+        super().__init__(f"Circuit breaker for {dependency} is open, retry after {retry_after}s")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold, recovery_timeout, half_open_calls):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_calls = half_open_calls
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._rejected = 0
+
+    @classmethod
+    def from_env(cls, name):
+        prefix = f"BREAKER_{name.upper()}_"
+        return cls(
+            name,
+            failure_threshold=int(os.environ.get(prefix + "FAILURE_THRESHOLD", os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))),
+            recovery_timeout=float(os.environ.get(prefix + "RECOVERY_TIMEOUT", os.environ.get("BREAKER_RECOVERY_TIMEOUT", "30"))),
+            half_open_calls=int(os.environ.get("BREAKER_HALF_OPEN_CALLS", "1")),
+        )
+
+    def _retry_after(self):
+        return max(1, int(math.ceil(self._opened_at + self.recovery_timeout - time.monotonic())))
+
+    # Raise CircuitOpenError if the call must not go through
+    def before_call(self):
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    self._rejected += 1
+                    raise CircuitOpenError(self.name, self._retry_after())
+                self._state = HALF_OPEN
+                self._trials = 0
+            if self._state == HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self._rejected += 1
+                    raise CircuitOpenError(self.name, 1)
+                self._trials += 1
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trials = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trials = 0
+
+    def status(self):
+        with self._lock:
+            status = {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "rejected_calls": self._rejected,
+            }
+            if self._state == OPEN:
+                status["retry_after"] = self._retry_after()
+            return status
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+# Shared breaker for the named dependency
+def get_breaker(name):
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker.from_env(name)
+        return breaker
+
+
+# Breaker state of every dependency seen so far, for /health
+def breaker_status():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.status() for breaker in breakers}
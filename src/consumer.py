@@ -0,0 +1,390 @@
+"""
+Pull-based intake: a consumer that long-polls a queue of events and runs each
+one through the same path as POST /event (main.handle), so the rate at which
+events are worked on is ours to choose rather than the sender's.
+
+A message body is the JSON an /event request would carry. Message attributes
+named after request headers (Idempotency-Key, X-Request-Deadline, traceparent,
+X-Profile) are passed on as such. What happens to a message follows the status
+/event would have answered with:
+
+    2xx and other 4xx    deleted (4xx ones are logged: retrying will not help)
+    409, 429, 5xx        left on the queue and made visible again after the
+                         response's Retry-After (or the visibility timeout);
+                         the queue's redrive policy decides when to give up
+
+At most CONSUMER_CONCURRENCY events run at a time and the queue is only polled
+for as many messages as there are free slots, so a backlog waits on the queue,
+not in memory. Deletes are batched. While an event runs, a heartbeat keeps
+extending the visibility of its message (slow PDF jobs would otherwise be handed
+to a second consumer). SIGTERM and SIGINT stop the polling and let the events
+in flight finish.
+
+Two queue backends:
+
+    sqs     an SQS queue (QUEUE_URL), or any SQS-compatible endpoint through AWS_ENDPOINT_URL_SQS
+    sqlite  a local SQLite file with the same semantics, for running without AWS;
+            messages received QUEUE_MAX_RECEIVES times are moved to its dead_letters table
+
+Usage (from the repository root):
+    python -m src.consumer                    run the consumer
+    python -m src.consumer --enqueue FILE     queue the events of FILE (one JSON event per line, "-" for stdin)
+
+Configuration (environment variables):
+    QUEUE_BACKEND                sqs or sqlite (default sqs)
+    QUEUE_URL                    URL of the SQS queue
+    QUEUE_SQLITE_PATH            file of the sqlite queue (default /tmp/event-queue.sqlite3)
+    QUEUE_MAX_RECEIVES           receives before a sqlite message is dead-lettered (default 5)
+    CONSUMER_CONCURRENCY         events handled at a time (default 8)
+    CONSUMER_BATCH_SIZE          most messages taken per poll, at most 10 (default 10)
+    CONSUMER_WAIT_SECONDS        long-poll wait, at most 20 (default 20)
+    CONSUMER_VISIBILITY_TIMEOUT  seconds a received message stays hidden, extended while it runs (default 60)
+"""
+
+import argparse
+import contextvars
+import json
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, SQS
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "sqs")
+QUEUE_URL = os.environ.get("QUEUE_URL")
+QUEUE_SQLITE_PATH = os.environ.get("QUEUE_SQLITE_PATH", "/tmp/event-queue.sqlite3")
+MAX_RECEIVES = int(os.environ.get("QUEUE_MAX_RECEIVES", "5"))
+CONCURRENCY = int(os.environ.get("CONSUMER_CONCURRENCY", "8"))
+BATCH_SIZE = min(int(os.environ.get("CONSUMER_BATCH_SIZE", "10")), 10)
+WAIT_SECONDS = min(int(os.environ.get("CONSUMER_WAIT_SECONDS", "20")), 20)
+VISIBILITY_TIMEOUT = int(os.environ.get("CONSUMER_VISIBILITY_TIMEOUT", "60"))
+
+# SQS batch calls take at most 10 entries
+SQS_BATCH = 10
+# Statuses worth another attempt: the event was refused or cut short, not wrong
+RETRYABLE_STATUSES = {409, 429}
+# Message attributes passed on as request headers
+HEADER_ATTRIBUTES = ("Idempotency-Key", "X-Request-Deadline", "traceparent", "X-Profile")
+
+
+class Message:
+    def __init__(self, message_id, receipt, body, attributes, receive_count=1):
+        self.id = message_id
+        self.receipt = receipt
+        self.body = body
+        self.attributes = attributes
+        self.receive_count = receive_count
+
+
+class SqsQueue:
+    def __init__(self, url):
+        if not url:
+            raise ValueError("QUEUE_URL is required for the sqs backend")
+        self.url = url
+        # A long poll holds the connection for up to WAIT_SECONDS: the shared read timeout is too short
+        self._sqs = boto3.client("sqs", config=AWS_CLIENT_CONFIG.merge(
+            Config(read_timeout=WAIT_SECONDS + 10, max_pool_connections=CONCURRENCY + 2)))
+
+    def receive(self, max_messages, wait_seconds, visibility_timeout):
+        response = call_dependency(SQS, self._sqs.receive_message,
+            QueueUrl=self.url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=wait_seconds,
+            VisibilityTimeout=visibility_timeout,
+            MessageAttributeNames=["All"],
+            AttributeNames=["ApproximateReceiveCount"])
+        return [Message(
+            m["MessageId"], m["ReceiptHandle"], m["Body"],
+            {name: value.get("StringValue") for name, value in m.get("MessageAttributes", {}).items()},
+            int(m.get("Attributes", {}).get("ApproximateReceiveCount", 1))
+        ) for m in response.get("Messages", [])]
+
+    # Receipts that could not be deleted
+    def delete(self, receipts):
+        failed = []
+        for start in range(0, len(receipts), SQS_BATCH):
+            entries = [{"Id": str(i), "ReceiptHandle": receipt} for i, receipt in enumerate(receipts[start:start + SQS_BATCH])]
+            response = call_dependency(SQS, self._sqs.delete_message_batch, QueueUrl=self.url, Entries=entries)
+            failed.extend(entries[int(f["Id"])]["ReceiptHandle"] for f in response.get("Failed", []))
+        return failed
+
+    # `timeouts` maps receipts to their new visibility timeout in seconds
+    def change_visibility(self, timeouts):
+        items = list(timeouts.items())
+        for start in range(0, len(items), SQS_BATCH):
+            entries = [{"Id": str(i), "ReceiptHandle": receipt, "VisibilityTimeout": timeout}
+                       for i, (receipt, timeout) in enumerate(items[start:start + SQS_BATCH])]
+            call_dependency(SQS, self._sqs.change_message_visibility_batch, QueueUrl=self.url, Entries=entries)
+
+    def send(self, body, attributes=None):
+        call_dependency(SQS, self._sqs.send_message, QueueUrl=self.url, MessageBody=body,
+            MessageAttributes={name: {"DataType": "String", "StringValue": value} for name, value in (attributes or {}).items()})
+
+
+class SqliteQueue:
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, path, max_receives=MAX_RECEIVES):
+        self.max_receives = max_receives
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        for table in ("messages", "dead_letters"):
+            self._db.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                id TEXT PRIMARY KEY, body TEXT NOT NULL, attributes TEXT NOT NULL, sent_at REAL NOT NULL,
+                visible_at REAL NOT NULL, receive_count INTEGER NOT NULL DEFAULT 0, receipt TEXT)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_visible_at ON messages (visible_at)")
+
+    def _receive_now(self, max_messages, visibility_timeout):
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE: two consumers on the same file must not receive the same message
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, body, attributes, receive_count FROM messages WHERE visible_at <= ? ORDER BY visible_at, sent_at LIMIT ?",
+                    (now, max_messages)).fetchall()
+                messages = []
+                for message_id, body, attributes, receive_count in rows:
+                    if receive_count >= self.max_receives:
+                        self._db.execute("INSERT OR REPLACE INTO dead_letters SELECT * FROM messages WHERE id = ?", (message_id,))
+                        self._db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+                        logger.warning("Message dead-lettered", message_id=message_id, receive_count=receive_count)
+                        continue
+                    # A new receipt per receive: a consumer whose visibility lapsed can no longer delete it
+                    receipt = uuid.uuid4().hex
+                    self._db.execute("UPDATE messages SET visible_at = ?, receive_count = receive_count + 1, receipt = ? WHERE id = ?",
+                                     (now + visibility_timeout, receipt, message_id))
+                    messages.append(Message(message_id, receipt, body, json.loads(attributes), receive_count + 1))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return messages
+
+    def receive(self, max_messages, wait_seconds, visibility_timeout):
+        give_up_at = time.monotonic() + wait_seconds
+        while True:
+            messages = self._receive_now(max_messages, visibility_timeout)
+            if messages or time.monotonic() >= give_up_at:
+                return messages
+            time.sleep(self.POLL_INTERVAL)
+
+    def delete(self, receipts):
+        failed = []
+        with self._lock:
+            for receipt in receipts:
+                if self._db.execute("DELETE FROM messages WHERE receipt = ?", (receipt,)).rowcount == 0:
+                    failed.append(receipt)
+        return failed
+
+    def change_visibility(self, timeouts):
+        now = time.time()
+        with self._lock:
+            self._db.executemany("UPDATE messages SET visible_at = ? WHERE receipt = ?",
+                                 [(now + timeout, receipt) for receipt, timeout in timeouts.items()])
+
+    def send(self, body, attributes=None):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT INTO messages (id, body, attributes, sent_at, visible_at) VALUES (?, ?, ?, ?, ?)",
+                             (uuid.uuid4().hex, body, json.dumps(attributes or {}), now, now))
+
+
+def create_queue(kind=QUEUE_BACKEND):
+    if kind == "sqs":
+        return SqsQueue(QUEUE_URL)
+    if kind == "sqlite":
+        return SqliteQueue(QUEUE_SQLITE_PATH)
+    raise ValueError(f"Unknown QUEUE_BACKEND: {kind}")
+
+
+# Seconds before a retryable message should be tried again
+def _retry_after(headers):
+    try:
+        return max(1, int(float(headers.get("Retry-After"))))
+    except (TypeError, ValueError):
+        return None
+
+
+class Consumer:
+    def __init__(self, queue, handler, concurrency=CONCURRENCY, batch_size=BATCH_SIZE,
+                 wait_seconds=WAIT_SECONDS, visibility_timeout=VISIBILITY_TIMEOUT):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
+        self.visibility_timeout = visibility_timeout
+        self.counts = {"received": 0, "deleted": 0, "retried": 0, "rejected": 0, "failed": 0}
+        self._stopping = threading.Event()
+        self._done = threading.Event()
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._to_delete = []
+
+    def stop(self, *_):
+        if not self._stopping.is_set():
+            logger.info("Consumer stopping, finishing the events in flight", in_flight=len(self._in_flight))
+        self._stopping.set()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _free_slots(self):
+        # Wait for one slot, then take whatever else is free without waiting
+        while not self._slots.acquire(timeout=1):
+            if self._stopping.is_set():
+                return 0
+        if self._stopping.is_set():
+            self._slots.release()
+            return 0
+        taken = 1
+        while taken < self.batch_size and self._slots.acquire(blocking=False):
+            taken += 1
+        return taken
+
+    def _handle(self, message):
+        try:
+            try:
+                event = json.loads(message.body)
+            except ValueError:
+                event = None
+            if not isinstance(event, dict) or not event:
+                logger.error("Message is not a JSON event, dropping it", message_id=message.id)
+                outcome = "rejected"
+            else:
+                headers = {name: value for name, value in message.attributes.items() if name in HEADER_ATTRIBUTES and value is not None}
+                body, status, response_headers = self.handler(event, headers)
+                if status in RETRYABLE_STATUSES or status >= 500:
+                    delay = _retry_after(response_headers)
+                    logger.warning("Event will be retried", message_id=message.id, status=status,
+                                   receive_count=message.receive_count, retry_after=delay)
+                    if delay is not None:
+                        self.queue.change_visibility({message.receipt: delay})
+                    outcome = "retried"
+                elif status >= 400:
+                    logger.error("Event rejected, dropping it", message_id=message.id, status=status,
+                                 error=body.get("error") if isinstance(body, dict) else None)
+                    outcome = "rejected"
+                else:
+                    outcome = "deleted"
+        except Exception as e:
+            # Left to reappear once its visibility times out
+            logger.error("Event failed", message_id=message.id, error=str(e))
+            outcome = "failed"
+        finally:
+            with self._lock:
+                self._in_flight.pop(message.receipt, None)
+                if outcome in ("deleted", "rejected"):
+                    self._to_delete.append(message.receipt)
+            self._slots.release()
+        self._count(outcome)
+
+    def _delete_done(self):
+        with self._lock:
+            receipts, self._to_delete = self._to_delete, []
+        if not receipts:
+            return
+        try:
+            failed = self.queue.delete(receipts)
+        except Exception as e:
+            # Handled again once visible: the handlers are idempotent per invoice
+            logger.error("Failed to delete messages", count=len(receipts), error=str(e))
+            return
+        if failed:
+            logger.warning("Messages not deleted, their visibility lapsed", count=len(failed))
+
+    # Keep the messages being worked on hidden and flush the deletes
+    def _heartbeat(self):
+        interval = max(1, self.visibility_timeout / 3)
+        while not self._done.wait(min(interval, 1)):
+            self._delete_done()
+            now = time.monotonic()
+            with self._lock:
+                due = {receipt: self.visibility_timeout for receipt, extended_at in self._in_flight.items() if now - extended_at >= interval}
+                self._in_flight.update((receipt, now) for receipt in due if receipt in self._in_flight)
+            if due:
+                try:
+                    self.queue.change_visibility(due)
+                except Exception as e:
+                    logger.warning("Failed to extend message visibility", count=len(due), error=str(e))
+
+    def run(self):
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        logger.info("Consumer started", backend=type(self.queue).__name__, concurrency=self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self._stopping.is_set():
+                free = self._free_slots()
+                if not free:
+                    break
+                try:
+                    messages = self.queue.receive(free, self.wait_seconds, self.visibility_timeout)
+                except Exception as e:
+                    logger.error("Failed to receive messages", error=str(e))
+                    messages = []
+                    self._stopping.wait(1)
+                for _ in range(free - len(messages)):
+                    self._slots.release()
+                now = time.monotonic()
+                for message in messages:
+                    with self._lock:
+                        self._in_flight[message.receipt] = now
+                    self._count("received")
+                    executor.submit(contextvars.copy_context().run, self._handle, message)
+        # The executor has waited for the events in flight, the heartbeat extended them meanwhile
+        self._done.set()
+        heartbeat.join()
+        self._delete_done()
+        logger.info("Consumer stopped", **self.counts)
+        return self.counts
+
+
+def enqueue(queue, stream):
+    count = 0
+    for line in stream:
+        if line.strip():
+            event = json.loads(line)
+            queue.send(json.dumps(event))
+            count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--enqueue", metavar="FILE", help="queue the events of FILE (one JSON event per line, - for stdin) and exit")
+    options = parser.parse_args(argv)
+    queue = create_queue()
+
+    if options.enqueue:
+        if options.enqueue == "-":
+            count = enqueue(queue, sys.stdin)
+        else:
+            with open(options.enqueue) as f:
+                count = enqueue(queue, f)
+        print(json.dumps({"queued": count}), file=sys.stderr)
+        return
+
+    # Imported here: loading the handlers (and their AWS clients) is not needed to enqueue
+    from main import handle
+    consumer = Consumer(queue, handle)
+    signal.signal(signal.SIGTERM, consumer.stop)
+    signal.signal(signal.SIGINT, consumer.stop)
+    print(json.dumps(consumer.run()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
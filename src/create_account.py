@@ -3,42 +3,139 @@ This lambda function creates an account (customer/vendor) in Zoho Books
 and logs the response in a DynamoDB table.
 """
 
-import requests
 import boto3
 import json
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from src.email import send_failure_email
+from src import deadline
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, ZOHO, zoho_http, DYNAMODB, EVENTBRIDGE
+from src.circuit_breaker import CircuitOpenError
+from src.records import compact_account
+from src.log import get_logger
 
-dynamodb = boto3.resource('dynamodb')
-eventbridge = boto3.client('events')
+logger = get_logger(__name__)
+
+dynamodb = boto3.resource('dynamodb', config=AWS_CLIENT_CONFIG)
+eventbridge = boto3.client('events', config=AWS_CLIENT_CONFIG)
+
+gst_type_mapping = {
+    "Regular": "business_gst",
+    "SEZ": "business_sez",
+    "Overseas": "overseas"
+}
+
+# EventBridge entry telling Salesforce the Zoho ids of an account
+def salesforce_account_entry(event_bus_name, sf_account_id, zoho_customer_id, zoho_vendor_id):
+    salesforce_payload = {
+        "Status__c" : "ZohoAccountCreated",
+        "recordId__c": sf_account_id,
+        "External_ID__c": zoho_customer_id,
+        "Zoho_Vendor_Id__c": zoho_vendor_id
+    }
+    return {
+        "Source": "zoho-account",
+        "DetailType": "zoho-account",
+        "Detail": json.dumps(salesforce_payload),
+        "EventBusName": event_bus_name
+    }
 
 # Function to send event to Salesforce via EventBridge
 def salesforce_eventbridge(event, sf_account_id, zoho_customer_id, zoho_vendor_id):
     try:
-        salesforce_payload = {
-            "Status__c" : "ZohoAccountCreated",
-            "recordId__c": sf_account_id,
-            "External_ID__c": zoho_customer_id,
-            "Zoho_Vendor_Id__c": zoho_vendor_id
-        }
         # Send event to Salesforce via EventBridge
-        response_sf = eventbridge.put_events(
+        response_sf = call_dependency(EVENTBRIDGE, eventbridge.put_events,
             Entries=[
-                {
-                    "Source": "zoho-account",
-                    "DetailType": "zoho-account",
-                    "Detail": json.dumps(salesforce_payload),
-                    "EventBusName": event.get("event_bus_name")
-                }
+                salesforce_account_entry(event.get("event_bus_name"), sf_account_id, zoho_customer_id, zoho_vendor_id)
             ]
         )
         return "Success"
     except Exception as e:
         return str(e)
 
+# Prepare the Zoho contact payload for an account event
+def build_contact_payload(event):
+    payload = {
+        "contact_name": event.get("TradeName__c"),
+        "company_name": event.get("TradeName__c"),
+        "billing_address": {
+            "address": event.get("BillingStreet__c"),
+            "city": event.get("BillingCity__c"),
+            "state": event.get("BillingState__c"),
+            "zip": event.get("BillingPostalCode__c"),
+            "country": event.get("BillingCountry__c")
+        },
+        "shipping_address": {
+            "address": event.get("ShippingStreet__c"),
+            "city": event.get("ShippingCity__c"),
+            "state": event.get("ShippingState__c"),
+            "zip": event.get("ShippingPostalCode__c"),
+            "country": event.get("ShippingCountry__c")
+        }
+    }
+
+    # Add GST details if provided
+    if event.get("prod_flag") == "1":
+        payload["gst_treatment"] = gst_type_mapping.get(event.get("GSTTreatement__c"))
+        # Add gst_number only if GST_Type is not Overseas
+        if event.get("GSTTreatement__c") != "Overseas":
+            payload["gst_no"] = event.get("GSTIN__c")
+        elif event.get("GSTTreatement__c") == "Overseas" and event.get("PAN__c"):
+            payload["pan_no"] = event.get("PAN__c")
+        else: 
+            logger.warning("PAN Number not provided for Overseas GST Type")
+    return payload
+
+# Vendor contact payload: the contact payload plus MSME registration details
+def build_vendor_payload(event, payload):
+    vendor_payload = dict(payload, contact_type="vendor")
+    if event.get("MSMENumber__c") and event.get("MSMEType__c"):
+        vendor_payload["udyam_reg_no"] = event.get("MSMENumber__c")
+        vendor_payload["msme_type"] = event.get("MSMEType__c").lower()
+    return vendor_payload
+
+# Create one Zoho contact; returns its status, contact id (None on failure) and response body
+def create_zoho_contact(create_account_url, headers, payload):
+    try:
+        response = call_dependency(ZOHO, zoho_http.post, create_account_url, headers=headers, json=payload)
+    except CircuitOpenError as e:
+        # Another contact may already exist at this point, so an open Zoho breaker must not
+        # abort the event: record this contact as failed and let the retry create it.
+        return {"status": 503, "contact_id": None, "body": {"error": str(e)}, "text": str(e), "timestamp": str(datetime.now())}
+    try:
+        body = response.json()
+    except ValueError:
+        body = {"error": response.text}
+    contact_id = None
+    if response.status_code == 201:
+        # The contact exists in Zoho now, the bookkeeping must run to completion
+        deadline.commit()
+        contact_id = body.get("contact", {}).get("contact_id")
+    return {"status": response.status_code, "contact_id": contact_id, "body": body, "text": response.text, "timestamp": str(datetime.now())}
+
+# Write the account record, merging into any existing item
+def update_account_record(table, sf_account_id, dynamodb_account_payload):
+    dynamodb_account_payload["Created_At"] = str(datetime.now())
+    record = compact_account(dict(dynamodb_account_payload, Account_ID=sf_account_id))
+    update_fields = {k: v for k, v in record.items() if k not in ["Account_ID"]}
+    expression_attribute_names = {f"#{k.replace(' ', '_')}": k for k in update_fields.keys()}
+    expression_attribute_values = {f":{k.replace(' ', '_')}": v for k, v in update_fields.items()}
+        # Build the UpdateExpression dynamically
+    update_expr = "SET " + ", ".join(f"#{k.replace(' ', '_')} = :{k.replace(' ', '_')}" for k in update_fields.keys())
+
+    call_dependency(DYNAMODB, table.update_item,
+        Key={
+            "Account_ID": sf_account_id   
+        },
+        UpdateExpression=update_expr,
+        ExpressionAttributeNames=expression_attribute_names,
+        ExpressionAttributeValues=expression_attribute_values
+    )
+
 def create_account_function(event):
     # Extract required fields from the event
-    print("test")
     client_id = event.get("client_id")
     client_secret = event.get("client_secret")
     refresh_token = event.get("refresh_token")
@@ -47,12 +144,6 @@ def create_account_function(event):
     sf_account_id = event.get("RecordID__c")
     table = dynamodb.Table(account_table)
 
-    gst_type_mapping = {
-        "Regular": "business_gst",
-        "SEZ": "business_sez",
-        "Overseas": "overseas"
-    }
-    
     # Validate required fields
     if not all([client_id, client_secret, refresh_token, org_id]):
         return {"error": "Missing required fields: client_id, client_secret, refresh_token, org_id"}
@@ -63,7 +154,8 @@ def create_account_function(event):
         "Account_Type": event.get("AccountType__c"),
     }
 
-    res = table.get_item(Key={'Account_ID': event.get("RecordID__c")})
+    res = call_dependency(DYNAMODB, table.get_item, Key={'Account_ID': event.get("RecordID__c")})
+    existing_item = res.get('Item') or {}
     if 'Item' in res:
         item = res['Item']
         if event.get("AccountType__c") == "Buyer" and item.get("Zoho_Customer_ID"):
@@ -73,7 +165,7 @@ def create_account_function(event):
             resp1 = salesforce_eventbridge(event, sf_account_id, item.get("Zoho_Customer_ID"), item.get("Zoho_Vendor_ID"))
             return {"error": "Both Customer and Vendor are created for this Vendor in Zoho Books already. And it's vendor id is " + str(item.get("Zoho_Vendor_ID")) +"and customer id is "+ str(item.get("Zoho_Customer_ID")) +". For more details please check DynamoDB. Again posted of Salesforce and response is " + str(resp1)}
         else:
-            print("Record exists but missing Zoho IDs, proceeding to create missing account types.")
+            logger.info("Record exists but missing Zoho IDs, proceeding to create missing account types")
     # if 'Item' in table.get_item(Key={'Account_ID': event.get("RecordID__c")}):
     #     return {"error": "Account already exists in DynamoDB"}
 
@@ -87,8 +179,8 @@ def create_account_function(event):
         "redirect_uri": "http://www.zoho.in/books",
         "grant_type": "refresh_token"
     }
-    token_response = requests.post(generate_access_token_url, data=data)
-    print("Zoho token response:", token_response.text)
+    token_response = call_dependency(ZOHO, zoho_http.post, generate_access_token_url, data=data)
+    logger.debug("Zoho token response", status=token_response.status_code)
     # Check if token generation was successful
     if token_response.status_code != 200:
         send_failure_email("Zoho Token Generation Failed", "Failed to generate access token for Zoho Books API.", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
@@ -107,100 +199,72 @@ def create_account_function(event):
         "Content-Type": "application/json"
     }
     # Prepare payload for account creation
-    payload = {
-        "contact_name": event.get("TradeName__c"),
-        "company_name": event.get("TradeName__c"),
-        "billing_address": {
-            "address": event.get("BillingStreet__c"),
-            "city": event.get("BillingCity__c"),
-            "state": event.get("BillingState__c"),
-            "zip": event.get("BillingPostalCode__c"),
-            "country": event.get("BillingCountry__c")
-        },
-        "shipping_address": {
-            "address": event.get("ShippingStreet__c"),
-            "city": event.get("ShippingCity__c"),
-            "state": event.get("ShippingState__c"),
-            "zip": event.get("ShippingPostalCode__c"),
-            "country": event.get("ShippingCountry__c")
-        }
-    }
-
-    # Add GST details if provided
-    if event.get("prod_flag") == "1":
-        payload["gst_treatment"] = gst_type_mapping.get(event.get("GSTTreatement__c"))
-        # Add gst_number only if GST_Type is not Overseas
-        if event.get("GSTTreatement__c") != "Overseas":
-            payload["gst_no"] = event.get("GSTIN__c")
-        elif event.get("GSTTreatement__c") == "Overseas" and event.get("PAN__c"):
-            payload["pan_no"] = event.get("PAN__c")
-        else: 
-            print("PAN Number not provided for Overseas GST Type")
+    payload = build_contact_payload(event)
 
     # Create account(s) based on the creation_type    
     if event.get("AccountType__c") == "Seller":
-        # Create Customer
-        payload["contact_type"] = "customer"
-        response_1 = requests.post(create_account_url, headers=headers, json=payload)
-        # Log API response with timestamp
-        api_response_1 = {
-            "Customer_API": response_1.status_code,
-            "Customer_API_timestamp": str(datetime.now())
-        }
-        # Check if customer account creation was successful
-        if response_1.status_code == 201:
-            resp_1 = response_1.json().get("contact", {}).get("contact_id")
-        else:
-            send_failure_email("Zoho Customer Account Creation Failed", "Failed to create customer account of the seller: "+ event.get("TradeName__c") + response_1.text, event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
-            return {"error": "Failed to create customer account of the seller: " + response_1.text}
+        # A retry only creates the side that is still missing from the account table
+        existing_customer_id = existing_item.get("Zoho_Customer_ID")
+        existing_vendor_id = existing_item.get("Zoho_Vendor_ID")
 
-        # Log customer ID and API response in DynamoDB payload
-        dynamodb_account_payload["Zoho_Customer_ID"] = resp_1
-        dynamodb_account_payload["Customer_API_Response"] = api_response_1
+        customer_payload = dict(payload, contact_type="customer")
+        vendor_payload = build_vendor_payload(event, payload)
 
-        # Create Vendor
-        payload["contact_type"] = "vendor"
-        if event.get("MSMENumber__c") and event.get("MSMEType__c"):
-            payload["udyam_reg_no"] = event.get("MSMENumber__c")
-            payload["msme_type"] = event.get("MSMEType__c").lower()
-        response_2 = requests.post(create_account_url, headers=headers, json=payload)
-        # Log API response with timestamp
-        api_response_2 = {
-            "Vendor_API": response_2.status_code,
-            "Vendor_API_timestamp": str(datetime.now())
-        }
-        # Check if vendor account creation was successful
-        if response_2.status_code == 201:
-            resp_2 = response_2.json().get("contact", {}).get("contact_id")
-        else:
-            resp_2 = None
-            send_failure_email("Zoho Vendor Account Creation Failed", "Failed to create vendor account of the seller: "+ event.get("TradeName__c") + "Customer Account of the created, but vendor account failed. " + "\n" + response_2.text, event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
+        # Create Customer and Vendor concurrently with the shared token
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            customer_future = None if existing_customer_id else executor.submit(contextvars.copy_context().run, create_zoho_contact, create_account_url, headers, customer_payload)
+            vendor_future = None if existing_vendor_id else executor.submit(contextvars.copy_context().run, create_zoho_contact, create_account_url, headers, vendor_payload)
+            customer = customer_future.result() if customer_future else None
+            vendor = vendor_future.result() if vendor_future else None
 
-        # Log vendor ID and API response in DynamoDB payload
+        cloudwatch_payload = {}
+        if customer:
+            # Log customer ID and API response in DynamoDB payload
+            dynamodb_account_payload["Customer_API_Response"] = {
+                "Customer_API": customer["status"],
+                "Customer_API_timestamp": customer["timestamp"]
+            }
+            cloudwatch_payload["Customer API Response"] = customer["body"]
+        if vendor:
+            # Log vendor ID and API response in DynamoDB payload
+            dynamodb_account_payload["Vendor_API_Response"] = {
+                "Vendor_API": vendor["status"],
+                "Vendor_API_timestamp": vendor["timestamp"]
+            }
+            cloudwatch_payload["Vendor API Response"] = vendor["body"]
+
+        resp_1 = existing_customer_id or customer["contact_id"]
+        resp_2 = existing_vendor_id or vendor["contact_id"]
+        dynamodb_account_payload["Zoho_Customer_ID"] = resp_1
         dynamodb_account_payload["Zoho_Vendor_ID"] = resp_2
-        dynamodb_account_payload["Vendor_API_Response"] = api_response_2
 
-        # Log API responses in CloudWatch payload
-        cloudwatch_payload = {
-            "Customer API Response": response_1.json(),
-            "Vendor API Response": response_2.json()
-        }
+        # Check if customer account creation was successful
+        if not resp_1:
+            send_failure_email("Zoho Customer Account Creation Failed", "Failed to create customer account of the seller: "+ event.get("TradeName__c") + customer["text"], event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
+            # Record a vendor created in the meantime so the retry does not create it again
+            if resp_2:
+                try:
+                    update_account_record(table, sf_account_id, dynamodb_account_payload)
+                except Exception as e:
+                    send_failure_email("DynamoDB Insertion Failed", "Failed to record the vendor of the seller: "+ event.get("TradeName__c") + " in DynamoDB. Error: "+ str(e), event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
+            return {"error": "Failed to create customer account of the seller: " + customer["text"]}
+
+        # Check if vendor account creation was successful
+        if not resp_2:
+            send_failure_email("Zoho Vendor Account Creation Failed", "Failed to create vendor account of the seller: "+ event.get("TradeName__c") + "Customer Account of the created, but vendor account failed. " + "\n" + vendor["text"], event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
 
     elif event.get("AccountType__c") == "Buyer":
         # Create Customer
-        payload["contact_type"] = "customer"
-        response_1 = requests.post(create_account_url, headers=headers, json=payload)
+        customer = create_zoho_contact(create_account_url, headers, dict(payload, contact_type="customer"))
         # Log API response with timestamp
         api_response = {
-            "Customer_API": response_1.status_code,
-            "Customer_API_timestamp": str(datetime.now())
+            "Customer_API": customer["status"],
+            "Customer_API_timestamp": customer["timestamp"]
         }
         # Check if customer account creation was successful
-        if response_1.status_code == 201:
-            resp_1 = response_1.json().get("contact", {}).get("contact_id")
-        else:
-            resp_1 = None
-            send_failure_email("Zoho Customer Account Creation Failed", "Failed to create customer account of the buyer: "+ event.get("TradeName__c") + "\n" + response_1.text, event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
+        resp_1 = customer["contact_id"]
+        if not resp_1:
+            send_failure_email("Zoho Customer Account Creation Failed", "Failed to create customer account of the buyer: "+ event.get("TradeName__c") + "\n" + customer["text"], event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
         
         # Log customer ID and API response in DynamoDB payload
         dynamodb_account_payload["Zoho_Customer_ID"] = resp_1
@@ -209,7 +273,7 @@ def create_account_function(event):
 
         # Log API responses in CloudWatch payload
         cloudwatch_payload = {
-            "Customer API Response": response_1.json()
+            "Customer API Response": customer["body"]
         }
 
 
@@ -256,21 +320,7 @@ def create_account_function(event):
         
     # Insert record into DynamoDB
     try:
-        dynamodb_account_payload["Created_At"] = str(datetime.now())
-        update_fields = {k: v for k, v in dynamodb_account_payload.items() if k not in ["Account_ID"]}
-        expression_attribute_names = {f"#{k.replace(' ', '_')}": k for k in update_fields.keys()}
-        expression_attribute_values = {f":{k.replace(' ', '_')}": v for k, v in update_fields.items()}
-            # Build the UpdateExpression dynamically
-        update_expr = "SET " + ", ".join(f"#{k.replace(' ', '_')} = :{k.replace(' ', '_')}" for k in update_fields.keys())
-
-        table.update_item(
-            Key={
-                "Account_ID": sf_account_id   
-            },
-            UpdateExpression=update_expr,
-            ExpressionAttributeNames=expression_attribute_names,
-            ExpressionAttributeValues=expression_attribute_values
-        )
+        update_account_record(table, sf_account_id, dynamodb_account_payload)
         # Log DynamoDB insertion success in CloudWatch payload
         cloudwatch_payload["DynamoDB_Insert"] = "Success"
         return cloudwatch_payload
@@ -0,0 +1,135 @@
+"""
+Per-event deadline budget propagated through the invoice pipeline.
+
+`handle_event` opens a deadline scope for every event, taken from the X-Deadline-Seconds
+request header or the per-action default below. Every external call made through
+`call_dependency` then gets the remaining time as its timeout (Zoho), or is refused
+up front once the budget is spent (AWS, whose clients use the fixed timeouts in
+AWS_CLIENT_CONFIG). Optional stages such as PDF regeneration check `has_budget`
+and are skipped and recorded for later completion when there is not enough time.
+
+Once a handler has made a change in Zoho it calls `commit()`: the remaining
+bookkeeping (EventBridge, DynamoDB, SES) must not be abandoned half way, so from
+then on calls are no longer refused and get at least COMMIT_MIN_TIMEOUT seconds.
+
+Configuration (environment variables):
+    DEADLINE_DEFAULT_SECONDS   budget for actions without their own default (default 30)
+    ZOHO_CONNECT_TIMEOUT       connect timeout for Zoho calls, in seconds (default 5)
+    ZOHO_READ_TIMEOUT          upper bound for Zoho read timeouts, in seconds (default 30)
+    AWS_CONNECT_TIMEOUT        connect timeout for AWS clients, in seconds (default 5)
+    AWS_READ_TIMEOUT           read timeout for AWS clients, in seconds (default 10)
+    PDF_STAGE_MIN_SECONDS      budget needed to run PDF regeneration inline (default 10)
+"""
+
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from botocore.config import Config
+
+DEFAULT_SECONDS = float(os.environ.get("DEADLINE_DEFAULT_SECONDS", "30"))
+ZOHO_CONNECT_TIMEOUT = float(os.environ.get("ZOHO_CONNECT_TIMEOUT", "5"))
+ZOHO_READ_TIMEOUT = float(os.environ.get("ZOHO_READ_TIMEOUT", "30"))
+PDF_STAGE_MIN_SECONDS = float(os.environ.get("PDF_STAGE_MIN_SECONDS", "10"))
+COMMIT_MIN_TIMEOUT = 2.0
+
+DEADLINE_HEADER = "X-Deadline-Seconds"
+
+# Default budget per action, in seconds
+ACTION_DEADLINES = {
+    "CreateZohoAccount": 20.0,
+    # Contact creation is paced by the Zoho rate limit, see src/rate_limit.py
+    "BulkCreateZohoAccount": 300.0,
+    "Buyer": 30.0,
+    "Seller_Technology_Fee": 30.0,
+    "X1VP_Subscription": 30.0,
+    "get_invoice": 30.0,
+    "get_invoice_pdf": 15.0,
+}
+
+AWS_CLIENT_CONFIG = Config(
+    connect_timeout=float(os.environ.get("AWS_CONNECT_TIMEOUT", "5")),
+    read_timeout=float(os.environ.get("AWS_READ_TIMEOUT", "10")),
+)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an event has no budget left for the next external call."""
+
+
+class Deadline:
+    __slots__ = ("expires_at", "committed")
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+        self.committed = False
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+# Budget for an event: the request header wins over the per-action default
+def budget_for(action, header_value=None):
+    if header_value:
+        try:
+            seconds = float(header_value)
+            if seconds > 0:
+                return seconds
+        except ValueError:
+            pass
+    return ACTION_DEADLINES.get(action, DEFAULT_SECONDS)
+
+
+# Run the current event under a deadline of `seconds`
+@contextmanager
+def scope(seconds):
+    token = _current.set(Deadline(seconds))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+# Seconds left for the current event, or None when no deadline is set
+def remaining():
+    current = _current.get()
+    return None if current is None else current.remaining()
+
+
+# Whether at least `seconds` of budget is left
+def has_budget(seconds):
+    left = remaining()
+    return left is None or left >= seconds
+
+
+# Mark the event as having made changes in Zoho, so the bookkeeping still runs
+def commit():
+    current = _current.get()
+    if current is not None:
+        current.committed = True
+
+
+# Raise DeadlineExceeded if the budget is spent and the event has not committed yet
+def check(stage):
+    current = _current.get()
+    if current is not None and not current.committed and current.remaining() <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+# Timeout to pass to an HTTP call: the remaining budget, capped at `cap`
+def timeout(cap):
+    current = _current.get()
+    if current is None:
+        return cap
+    left = current.remaining()
+    if current.committed:
+        left = max(left, COMMIT_MIN_TIMEOUT)
+    return max(min(left, cap), 0.001)
+
+
+# (connect, read) timeout tuple for a Zoho request
+def zoho_timeout():
+    return (timeout(ZOHO_CONNECT_TIMEOUT), timeout(ZOHO_READ_TIMEOUT))
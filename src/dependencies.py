@@ -0,0 +1,182 @@
+"""
+Single entry point for calls to external dependencies (Zoho, S3, DynamoDB,
+EventBridge, SES) so that their latency is measured and their circuit breaker
+is consulted in one place. Zoho requests get the remaining event deadline as
+their timeout; AWS calls are refused once the deadline has passed.
+`call_dependency_async` does the same for coroutine functions (the async
+pipeline's httpx and aiobotocore clients). Every call is a tracing span of the
+event: "zoho token", "zoho pdf download", "zoho create invoices", "s3 put_object",
+"dynamodb get_item" and so on.
+
+Synchronous Zoho calls go through `zoho_http`, one keep-alive connection pool
+shared by every event (requests.post and friends open a new TLS connection per
+call). It keeps no cookies: the same pool serves every organization.
+
+Configuration (environment variables):
+    ZOHO_MAX_CONNECTIONS  connections kept open to each Zoho host (default 50)
+"""
+
+import os
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from botocore.exceptions import ClientError
+from src import admission, deadline, tracing
+from src.circuit_breaker import get_breaker
+
+try:
+    import httpx
+    TIMEOUT_ERRORS = (requests.Timeout, httpx.TimeoutException)
+except ImportError:
+    # Only the async pipeline uses httpx
+    TIMEOUT_ERRORS = (requests.Timeout,)
+
+ZOHO = "zoho"
+S3 = "s3"
+DYNAMODB = "dynamodb"
+EVENTBRIDGE = "eventbridge"
+SES = "ses"
+# Only the queue consumer (src/consumer.py) talks to SQS: not part of /health
+SQS = "sqs"
+# Read by the tenant registry (src/tenants.py) in the background: not part of /health
+SECRETS_MANAGER = "secretsmanager"
+
+ALL_DEPENDENCIES = (ZOHO, S3, DYNAMODB, EVENTBRIDGE, SES)
+
+ZOHO_MAX_CONNECTIONS = int(os.environ.get("ZOHO_MAX_CONNECTIONS", "50"))
+
+zoho_http = requests.Session()
+zoho_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=ZOHO_MAX_CONNECTIONS))
+zoho_http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+# Register every breaker up front so /health reports them before the first call
+for _dependency in ALL_DEPENDENCIES:
+    get_breaker(_dependency)
+
+# AWS error codes that mean the service is struggling rather than the request being wrong
+THROTTLING_ERROR_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestLimitExceeded",
+    "ProvisionedThroughputExceededException", "SlowDown", "ServiceUnavailable", "InternalError",
+}
+
+
+# Whether an exception raised by a dependency should count against its breaker
+def _is_failure(exc):
+    if isinstance(exc, ClientError):
+        error = exc.response.get("Error", {})
+        status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 500)
+        return status >= 500 or error.get("Code") in THROTTLING_ERROR_CODES
+    return True
+
+
+def _record_error(breaker, exc):
+    # A timeout cut short by the event deadline says nothing about Zoho's health
+    cut_short = isinstance(exc, TIMEOUT_ERRORS) and not deadline.has_budget(0.1)
+    if _is_failure(exc) and not cut_short:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def _record_result(breaker, result):
+    # HTTP responses (Zoho) signal server-side trouble through the status code
+    status_code = getattr(result, "status_code", None)
+    if status_code is not None and (status_code >= 500 or status_code == 429):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+ZOHO_OPERATIONS = {"post": "create", "put": "update", "get": "get", "delete": "delete"}
+
+
+# Span name and attributes of a call: Zoho calls are named after what the URL does,
+# AWS calls after the operation
+def _span_of(dependency, fn, args, kwargs):
+    operation = getattr(fn, "__name__", "call")
+    if dependency != ZOHO:
+        resource = kwargs.get("TableName") or kwargs.get("Bucket") or getattr(getattr(fn, "__self__", None), "name", None)
+        body = kwargs.get("Body")
+        return f"{dependency} {operation}", {
+            "dependency": dependency,
+            "resource": resource if isinstance(resource, str) else None,
+            "key": kwargs.get("Key") if isinstance(kwargs.get("Key"), str) else None,
+            "bytes": len(body) if isinstance(body, (bytes, str)) else None,
+        }
+    url = urlparse(args[0] if args else kwargs.get("url", ""))
+    if "/oauth/" in url.path:
+        name = "zoho token"
+    elif "accept=pdf" in url.query:
+        name = "zoho pdf download"
+    else:
+        # /books/v3/invoices/<id>/address/billing -> invoices
+        parts = url.path.split("/")
+        name = f"zoho {ZOHO_OPERATIONS.get(operation, operation)} {parts[3] if len(parts) > 3 else url.path}"
+    return name, {"dependency": dependency, "http.method": operation.upper(), "http.path": url.path}
+
+
+# Status and response size of a finished call
+def _trace_result(span, result):
+    status_code = getattr(result, "status_code", None)
+    if status_code is not None:
+        span.set(status=status_code, response_bytes=len(result.content))
+    elif isinstance(result, dict):
+        span.set(status=result.get("ResponseMetadata", {}).get("HTTPStatusCode"), response_bytes=result.get("ContentLength"))
+
+
+def _trace_error(span, exc):
+    if isinstance(exc, ClientError):
+        span.set(status=exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode"),
+                 error_code=exc.response.get("Error", {}).get("Code"))
+
+
+# Call fn(*args, **kwargs) as a request to the named dependency
+def call_dependency(dependency, fn, *args, **kwargs):
+    deadline.check(dependency)
+    breaker = get_breaker(dependency)
+    breaker.before_call()
+    if dependency == ZOHO and "timeout" not in kwargs:
+        kwargs["timeout"] = deadline.zoho_timeout()
+    # Naming the span costs a little, so only traced events pay for it
+    name, attributes = _span_of(dependency, fn, args, kwargs) if tracing.active() else (None, {})
+    with tracing.span(name, **attributes) as span:
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            _record_error(breaker, e)
+            _trace_error(span, e)
+            raise
+        finally:
+            admission.record_latency(dependency, time.monotonic() - start)
+        _trace_result(span, result)
+    _record_result(breaker, result)
+    return result
+
+
+# Await fn(*args, **kwargs) as a request to the named dependency. Zoho calls get the
+# deadline as an httpx timeout
+async def call_dependency_async(dependency, fn, *args, **kwargs):
+    deadline.check(dependency)
+    breaker = get_breaker(dependency)
+    breaker.before_call()
+    if dependency == ZOHO and "timeout" not in kwargs:
+        connect_timeout, read_timeout = deadline.zoho_timeout()
+        kwargs["timeout"] = httpx.Timeout(read_timeout, connect=connect_timeout)
+    # Naming the span costs a little, so only traced events pay for it
+    name, attributes = _span_of(dependency, fn, args, kwargs) if tracing.active() else (None, {})
+    with tracing.span(name, **attributes) as span:
+        start = time.monotonic()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            _record_error(breaker, e)
+            _trace_error(span, e)
+            raise
+        finally:
+            admission.record_latency(dependency, time.monotonic() - start)
+        _trace_result(span, result)
+    _record_result(breaker, result)
+    return result
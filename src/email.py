@@ -1,11 +1,16 @@
 import boto3
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, SES
+from src.log import get_logger
 
-ses = boto3.client('ses', region_name='ap-south-1')
+logger = get_logger(__name__)
+
+ses = boto3.client('ses', region_name='ap-south-1', config=AWS_CLIENT_CONFIG)
 
 # Function to send failure email notification
 def send_failure_email(subject, message, sender_mail, reciever_mail):
     try:
-        response = ses.send_email(
+        response = call_dependency(SES, ses.send_email,
             Source= sender_mail,
             Destination={'ToAddresses': [reciever_mail]},
             Message={
@@ -13,6 +18,6 @@ def send_failure_email(subject, message, sender_mail, reciever_mail):
                 'Body': {'Text': {'Data': message}}
             }
         )
-        print("Email sent! Message ID:", response['MessageId'])
+        logger.info("Failure email sent", subject=subject, message_id=response['MessageId'])
     except Exception as email_error:
-        print("Error sending failure email notification:", str(email_error))
\ No newline at end of file
+        logger.error("Failed to send failure email", subject=subject, error=str(email_error))
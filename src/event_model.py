@@ -0,0 +1,249 @@
+"""
+Typed model of a Salesforce event.
+
+`parse_event` decodes `Payload__c` once per request (with orjson when it is
+installed) into slotted objects that the handlers use instead of walking nested
+dicts, and validates the fields each action needs before any network call, so a
+malformed event is rejected with EventValidationError instead of failing after a
+Zoho token round trip.
+
+The flat event fields (credentials, table names, Salesforce fields) stay on the
+raw event dict, which is kept on the model as `raw`.
+
+Configuration (environment variables):
+    BULK_ACCOUNT_MAX   accounts accepted in one BulkCreateZohoAccount event (default 500)
+"""
+
+import json
+import os
+import re
+
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+except ImportError:
+    def loads(data):
+        return json.loads(data)
+
+CREDENTIAL_FIELDS = ("client_id", "client_secret", "refresh_token", "org_id")
+
+BULK_ACCOUNT_MAX = int(os.environ.get("BULK_ACCOUNT_MAX", "500"))
+
+# Product_Details__c format of X1VP subscription events
+PRODUCT_DETAILS_PATTERN = re.compile(r'ProductName-(.*?)_HSN/SAC-(\d+)_GST-(\d+)')
+
+
+class EventValidationError(ValueError):
+    """Raised when an event is missing fields or carries malformed values."""
+
+
+def _require(mapping, fields, where):
+    missing = [field for field in fields if not mapping.get(field)]
+    if missing:
+        raise EventValidationError(f"Missing required fields in {where}: {', '.join(missing)}")
+
+
+def _object(payload, name, required):
+    value = payload.get(name)
+    if value is None:
+        if required:
+            raise EventValidationError(f"Missing required object in Payload__c: {name}")
+        return {}
+    if not isinstance(value, dict):
+        raise EventValidationError(f"Payload__c.{name} must be an object")
+    return value
+
+
+class Account:
+    __slots__ = ("zoho_account_id", "gst_treatment", "invoice_copies")
+
+    def __init__(self, data):
+        # Buyer payloads spell it zohoAccountID, seller tech/subscription payloads zohoAccountId
+        self.zoho_account_id = data.get("zohoAccountID") or data.get("zohoAccountId")
+        self.gst_treatment = data.get("GSTTreatment")
+        copies = data.get("invoiceCopies")
+        self.invoice_copies = 1 if copies is None else copies
+
+    # GST treatment used for tax mapping, Regular when Salesforce sends none
+    @property
+    def gst_treatment_or_default(self):
+        return self.gst_treatment or "Regular"
+
+
+class InvoiceInfo:
+    __slots__ = ("sf_invoice_id", "zoho_invoice_id", "tech_fee_amount")
+
+    def __init__(self, data):
+        # Buyer payloads spell it Invoiceid, seller tech/subscription payloads invoiceId
+        self.sf_invoice_id = data.get("Invoiceid") or data.get("invoiceId")
+        self.zoho_invoice_id = data.get("ZohoInvoiceId")
+        self.tech_fee_amount = data.get("techFeeAmount")
+
+
+class Address:
+    __slots__ = ("street", "city", "state_code", "postal_code", "country_code")
+
+    def __init__(self, data, prefix):
+        self.street = data.get(prefix + "Street__s")
+        self.city = data.get(prefix + "City__s")
+        self.state_code = data.get(prefix + "StateCode__s")
+        self.postal_code = data.get(prefix + "PostalCode__s")
+        self.country_code = data.get(prefix + "CountryCode__s")
+
+
+class Shipment:
+    __slots__ = ("name", "shipping_cost", "billing_address", "shipping_address")
+
+    def __init__(self, data):
+        self.name = data.get("Shipmentname")
+        self.shipping_cost = data.get("shippingCost")
+        self.billing_address = Address(data, "Bill_To_Address__")
+        self.shipping_address = Address(data, "Ship_To_Address__")
+
+
+class Order:
+    __slots__ = ("order_number", "po_date")
+
+    def __init__(self, data):
+        self.order_number = data.get("orderNumber")
+        self.po_date = data.get("PoDate")
+
+
+class LineItem:
+    __slots__ = ("product", "unit_price", "quantity", "uom", "ref_code", "hsn", "gst")
+
+    def __init__(self, data, index):
+        self.product = data.get("product")
+        self.unit_price = data.get("unitPrice")
+        try:
+            self.quantity = int(data.get("quantity"))
+        except (TypeError, ValueError):
+            raise EventValidationError(f"Payload__c.lineItems[{index}].quantity must be an integer")
+        self.uom = data.get("UoM")
+        self.ref_code = data.get("RefCode")
+        self.hsn = data.get("hsn")
+        self.gst = data.get("gst")
+
+
+class Payload:
+    __slots__ = ("account", "invoice", "shipment", "order", "line_items", "shipments")
+
+    def __init__(self, data, require_shipment=False, require_order=False, with_line_items=False):
+        self.account = Account(_object(data, "account", True))
+        self.invoice = InvoiceInfo(_object(data, "invoice", True))
+        self.shipment = Shipment(_object(data, "shipment", require_shipment))
+        self.order = Order(_object(data, "order", require_order))
+        # Line items are only read (and validated) when creating a Buyer invoice
+        self.line_items = [LineItem(item, i) for i, item in enumerate(data.get("lineItems") or [])] if with_line_items else []
+        # Per-shipment rows of seller tech fee invoices, rendered as the PDF annexure
+        self.shipments = data.get("shipments") or []
+
+
+class ProductDetails:
+    __slots__ = ("name", "hsn_or_sac", "gst")
+
+    def __init__(self, value):
+        match = PRODUCT_DETAILS_PATTERN.search(value or "")
+        if not match:
+            raise EventValidationError("Product_Details__c must look like ProductName-<name>_HSN/SAC-<code>_GST-<rate>")
+        self.name = match.group(1).strip()
+        self.hsn_or_sac = match.group(2)
+        self.gst = float(match.group(3))
+
+
+class EventModel:
+    __slots__ = ("action", "raw", "payload", "product_details", "accounts")
+
+    def __init__(self, action, raw, payload=None, product_details=None, accounts=None):
+        self.action = action
+        self.raw = raw
+        self.payload = payload
+        self.product_details = product_details
+        self.accounts = accounts
+
+    # Whether a Buyer event updates an existing Zoho invoice rather than creating one
+    @property
+    def is_address_update(self):
+        return bool(self.payload and self.payload.invoice.zoho_invoice_id)
+
+
+def _load_payload(event):
+    raw_payload = event.get("Payload__c")
+    if not raw_payload:
+        raise EventValidationError("Missing required field: Payload__c")
+    try:
+        data = loads(raw_payload)
+    except ValueError as e:
+        raise EventValidationError(f"Payload__c is not valid JSON: {str(e)}")
+    if not isinstance(data, dict):
+        raise EventValidationError("Payload__c must be a JSON object")
+    return data
+
+
+def _validate_account(account, where):
+    _require(account, ("RecordID__c", "TradeName__c"), where)
+    if account.get("AccountType__c") not in ("Buyer", "Seller"):
+        raise EventValidationError(f"Invalid account type in {where}, please choose from Buyer, Seller.")
+
+
+# Account objects of a BulkCreateZohoAccount event
+def _load_accounts(event):
+    accounts = event.get("Accounts__c")
+    if isinstance(accounts, str):
+        try:
+            accounts = loads(accounts)
+        except ValueError as e:
+            raise EventValidationError(f"Accounts__c is not valid JSON: {str(e)}")
+    if not isinstance(accounts, list) or not accounts:
+        raise EventValidationError("Accounts__c must be a non-empty list of accounts")
+    if len(accounts) > BULK_ACCOUNT_MAX:
+        raise EventValidationError(f"Accounts__c has {len(accounts)} accounts, at most {BULK_ACCOUNT_MAX} are accepted per event")
+    seen = set()
+    for i, account in enumerate(accounts):
+        if not isinstance(account, dict):
+            raise EventValidationError(f"Accounts__c[{i}] must be an object")
+        # Fields missing from an account fall back to the shared event fields
+        merged = dict(event, **account)
+        _validate_account(merged, f"Accounts__c[{i}]")
+        if merged["RecordID__c"] in seen:
+            raise EventValidationError(f"Duplicate RecordID__c in Accounts__c: {merged['RecordID__c']}")
+        seen.add(merged["RecordID__c"])
+    return accounts
+
+
+# Parse and validate an event for the given action
+def parse_event(action, event):
+    if action == "get_invoice":
+        _require(event, CREDENTIAL_FIELDS + ("invoice_number", "bucket_name"), "event")
+        return EventModel(action, event)
+
+    _require(event, CREDENTIAL_FIELDS, "event")
+
+    if action == "CreateZohoAccount":
+        _require(event, ("account_table", "RecordID__c", "TradeName__c"), "event")
+        if event.get("AccountType__c") not in ("Buyer", "Seller"):
+            raise EventValidationError("Invalid account type, please choose from Buyer, Seller.")
+        return EventModel(action, event)
+
+    if action == "BulkCreateZohoAccount":
+        _require(event, ("account_table",), "event")
+        return EventModel(action, event, accounts=_load_accounts(event))
+
+    _require(event, ("InvoiceNumber__c", "invoice_table"), "event")
+    data = _load_payload(event)
+
+    if action == "Buyer":
+        # Invoice creation also reads the order details for production payloads
+        creating = not _object(data, "invoice", True).get("ZohoInvoiceId")
+        payload = Payload(data, require_shipment=True, require_order=creating and event.get("prod_flag") == "1", with_line_items=creating)
+        if creating and not (payload.account.zoho_account_id and payload.invoice.sf_invoice_id):
+            raise EventValidationError("Missing required fields in Payload__c: account.zohoAccountID, invoice.Invoiceid")
+        return EventModel(action, event, payload)
+
+    payload = Payload(data)
+    if not (payload.account.zoho_account_id and payload.invoice.sf_invoice_id):
+        raise EventValidationError("Missing required fields in Payload__c: account.zohoAccountId, invoice.invoiceId")
+    product_details = ProductDetails(event.get("Product_Details__c")) if action == "X1VP_Subscription" else None
+    return EventModel(action, event, payload, product_details)
@@ -1,240 +1,256 @@
+from datetime import datetime
 from flask import jsonify
-import requests
-import boto3
-from PyPDF2 import PdfReader, PdfWriter, PageObject
-import io
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, PageBreak, Spacer
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-
-s3 = boto3.client("s3")
-
-def create_header_pdf(header_text, width, height):
-    packet = io.BytesIO()
-    can = canvas.Canvas(packet, pagesize=(width, height))
-    can.setFont("Helvetica", 16)
-    can.drawString(30, height - 30, header_text)
-    can.save()
-    packet.seek(0)
-    return PdfReader(packet).pages[0]
-
-def create_annexure_pdf(annexure_data):
-    """Create an Annexure page with a table from the provided data."""
-    packet = io.BytesIO()
-    doc = SimpleDocTemplate(packet, pagesize=A4, topMargin=0.5*inch, bottomMargin=0.5*inch)
-    
-    elements = []
-    
-    # Add "Annexure" heading
-    styles = getSampleStyleSheet()
-    heading_style = ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading1'],
-        fontSize=16,
-        textColor=colors.black,
-        spaceAfter=20,
-        alignment=1  # Center alignment
-    )
-    heading = Paragraph("Annexure", heading_style)
-    elements.append(heading)
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Check if annexure_data is a list of dicts
-    if not annexure_data or not isinstance(annexure_data, list):
-        packet.close()
-        return None
-    
-    # Extract table data
-    if len(annexure_data) > 0 and isinstance(annexure_data[0], dict):
-        # Define header display name mapping
-        header_display_names = {
-            "shipmentName": "Shipment Number",
-            "amount": "Amount",
-            "techFeeAmount": "Tech Fee Amount",
-            "orderSellerTechFee": "Tech Fee %",
-        }
-        
-        # Define the desired column order
-        column_order = ["shipmentName", "amount", "orderSellerTechFee", "techFeeAmount"]
-        
-        # Get headers from first dict keys
-        original_headers = list(annexure_data[0].keys())
-        
-        # Reorder headers according to column_order, keeping any extra columns at the end
-        headers = []
-        for col in column_order:
-            if col in original_headers:
-                headers.append(col)
-        # Add any remaining headers not in the predefined order
-        for col in original_headers:
-            if col not in headers:
-                headers.append(col)
-        
-        # Transform headers for display
-        display_headers = [header_display_names.get(header, header) for header in headers]
-        
-        # Create table data with display headers
-        table_data = [display_headers]
-        for row in annexure_data:
-            table_data.append([str(row.get(header, "")) for header in headers])
-        
-        # Calculate column widths based on content length
-        # col_widths = []
-        # for col_idx, header in enumerate(headers):
-        #     # Start with display header length
-        #     max_length = len(str(display_headers[col_idx]))
-        #     # Check all rows for this column
-        #     for row in annexure_data:
-        #         cell_value = str(row.get(header, ""))
-        #         max_length = max(max_length, len(cell_value))
-            
-        #     # Calculate width: minimum 1 inch, maximum 3 inches, scale by character count
-        #     # Approximate 0.08 inch per character
-        #     width = min(max(1*inch, max_length * 0.08*inch), 3*inch)
-        #     col_widths.append(width)
-        
-        # Create table
-        # table = Table(table_data, colWidths=col_widths)
-        table = Table(table_data, colWidths=[2*inch] * len(headers))
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTSIZE', (0, 1), (-1, -1), 10),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey]),
-        ]))
-        
-        elements.append(table)
-    
-    # Build PDF
-    doc.build(elements)
-    packet.seek(0)
-    return PdfReader(packet).pages[0] if packet.getvalue() else None
-
-def get_invoice_function(event):
-    client_id = event.get("client_id")
-    client_secret = event.get("client_secret")
-    refresh_token = event.get("refresh_token")
-    org_id = event.get("org_id")
-    # Accept either a Zoho invoice id (`invoice_id`) or a Salesforce invoice number (`invoice_number`).
-    invoice_number = event.get("invoice_number")
-    zoho_invoice_id = event.get("invoice_id")
-    bucket_name = event.get("bucket_name")
-    copies_raw = event.get("copies", 1)
-    sf_invoice_id = event.get("sf_invoice_id")
+from src.dependencies import call_dependency, ZOHO, zoho_http
+from src.circuit_breaker import CircuitOpenError
+from src.invoice_pdf import store_master, locate_master, publish_invoice
+from src.pdf_build import build_master, create_annexure_pdf
+from src.log import get_logger
+from src import deadline, tracing
+
+logger = get_logger(__name__)
+
+TOKEN_URL = "https://accounts.zoho.in/oauth/v2/token"
 
+# Fields of the PDF stage event a pending stage keeps, to run the stage later
+PENDING_PDF_FIELDS = ("invoice_number", "sf_invoice_id", "invoice_id", "copies", "invoice_date")
+
+
+# Whether a stored master can be served instead of regenerating it for this event
+def is_master_current(metadata, event):
+    # A master stored without the annexure the event asks for
+    if event.get("annexure_data") and metadata.get("annexure-pages", "0") == "0":
+        return False
+    # The caller knows of a Zoho change newer than the stored master (same Zoho timestamp format)
+    zoho_last_modified = event.get("zoho_last_modified")
+    stored_last_modified = metadata.get("zoho-last-modified")
+    if zoho_last_modified and stored_last_modified and str(zoho_last_modified) > stored_last_modified:
+        return False
+    return True
+
+
+# Copy count an event asks for, at least 1
+def copies_of(event):
+    copies_raw = event.get("copies", 1)
     try:
         copies = int(copies_raw) if copies_raw is not None else 1
         if copies < 1:
             copies = 1
     except Exception:
         copies = 1
+    return copies
 
-    # Validate required fields
-    if not all([client_id, client_secret, refresh_token, org_id, invoice_number, bucket_name]):
+
+# Error result of an event missing a required field, None when it has them all
+def missing_fields(event):
+    if not all([event.get("client_id"), event.get("client_secret"), event.get("refresh_token"), event.get("org_id"),
+                event.get("invoice_number"), event.get("bucket_name")]):
         return {"error": "Missing required fields: client_id, client_secret, refresh_token, org_id, invoice_id/invoice_number, bucket_name"}, 400
+    return None
+
+
+def forced(event):
+    return str(event.get("force", "")).lower() in ("true", "1", "yes")
 
-    # Use the provided Salesforce invoice number for the S3 filename when available,
-    # otherwise fall back to the Zoho invoice id.
-    s3_name = invoice_number
-    s3_key = f"invoices/{sf_invoice_id}_{s3_name}.pdf"
-    generate_access_token_url = "https://accounts.zoho.in/oauth/v2/token"
-    data = {
-        "refresh_token": refresh_token,
-        "client_id": client_id,
-        "client_secret": client_secret,
+
+# Result of an event answered from its stored master, None when there is no current one.
+# Raises CircuitOpenError while S3 is failing
+def stored_invoice(event, copies):
+    invoice_number = event.get("invoice_number")
+    bucket_name = event.get("bucket_name")
+    try:
+        _, metadata = locate_master(bucket_name, invoice_number, event.get("invoice_date"))
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        # The lookup is only a shortcut, regenerate when S3 cannot answer it
+        logger.warning("Failed to look up stored PDF", invoice_number=invoice_number, error=str(e))
+        return None
+    if metadata is None or not is_master_current(metadata, event):
+        return None
+    try:
+        url = publish_invoice(bucket_name, event.get("invoice_url_prefix"), invoice_number, copies,
+                              metadata.get("invoice-date"), metadata.get("sf-invoice-id") or event.get("sf_invoice_id"))
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return {"error": f"S3 upload failed: {str(e)}"}, 400
+    return {
+        "message": "Invoice PDF already stored",
+        "s3_location": url,
+        "cached": True
+    }, 200
+
+
+# Form of the Zoho access token request
+def token_request_data(event):
+    return {
+        "refresh_token": event.get("refresh_token"),
+        "client_id": event.get("client_id"),
+        "client_secret": event.get("client_secret"),
         "redirect_uri": "http://www.zoho.in/books",
         "grant_type": "refresh_token"
     }
 
-    token_response = requests.post(generate_access_token_url, data=data)
-    if token_response.status_code != 200:
-        return {"error": f"Token generation failed in get invoice function: {token_response.text}"}, 400
 
+# (access token, None) of a Zoho token response, or (None, error result)
+def access_token_of(token_response):
+    if token_response.status_code != 200:
+        return None, ({"error": f"Token generation failed in get invoice function: {token_response.text}"}, 400)
     access_token = token_response.json().get("access_token")
     if not access_token:
-        return {"error": "No access token received in get invoice function"}, 400
+        return None, ({"error": "No access token received in get invoice function"}, 400)
+    return access_token, None
+
+
+# URL and headers of the Zoho PDF download of an invoice
+def pdf_request(event, access_token):
+    org_id = event.get("org_id")
     # Use the resolved invoice id (Zoho id or invoice number fallback) to request the PDF
-    invoice_pdf_url = f"https://www.zohoapis.in/books/v3/invoices/{zoho_invoice_id}?organization_id={org_id}&accept=pdf"
+    invoice_pdf_url = f"https://www.zohoapis.in/books/v3/invoices/{event.get('invoice_id')}?organization_id={org_id}&accept=pdf"
     headers = {
         "Authorization": f"Zoho-oauthtoken {access_token}",
         "X-com-zoho-organizationid": org_id
     }
+    return invoice_pdf_url, headers
+
 
-    response = requests.get(invoice_pdf_url, headers=headers)
+# Error result of a Zoho PDF download, None when it returned a PDF
+def pdf_response_error(response):
     if response.status_code != 200:
         return {"error": f"Failed to download PDF, Zoho get invoice api failed: {response.text}"}, 400
-
     # Verify we got PDF content
     if not response.content or len(response.content) == 0:
         return {"error": "Zoho API returned empty PDF content"}, 400
+    return None
 
-    original_pdf = io.BytesIO(response.content)
-    try:
-        reader = PdfReader(original_pdf)
-        if len(reader.pages) == 0:
-            return {"error": "No pages found in Zoho PDF"}, 400
-    except Exception as pdf_error:
-        return {"error": f"Failed to read PDF from Zoho: {str(pdf_error)}"}, 400
-    
-    writer = PdfWriter()
-
-    # Extract all pages once to avoid iterator issues
-    pages = list(reader.pages)
-    
-    header_labels = ["Original", "Duplicate", "Triplate", "Quadruplicate", "Quintuplicate", "Sextuplicate"]
-    for copy_num in range(copies):
-        label = header_labels[copy_num] if copy_num < len(header_labels) else f"Copy {copy_num+1}"
-        for page in pages:
-            # Re-read the page from original PDF each time to avoid modification issues
-            reader_copy = PdfReader(io.BytesIO(response.content))
-            current_page = reader_copy.pages[pages.index(page)]
-            
-            # Get page size
-            width = float(current_page.mediabox.width)
-            height = float(current_page.mediabox.height)
-            # Create header page
-            header_page = create_header_pdf(label, width, height)
-            # Merge header onto the original page directly
-            current_page.merge_page(header_page)
-            writer.add_page(current_page)
-        
-        # Add Annexure page once per copy (if needed only on first copy, move outside loop)
-        if copy_num == 0:  # Add annexure only once
-            annexure_data = event.get("annexure_data")
-            if annexure_data:
-                try:
-                    annexure_page = create_annexure_pdf(annexure_data)
-                    if annexure_page:
-                        writer.add_page(annexure_page)
-                        print("Annexure page added to PDF")
-                except Exception as e:
-                    print(f"Warning: Failed to add annexure page: {str(e)}")
-
-    output_pdf = io.BytesIO()
-    writer.write(output_pdf)
-    output_pdf.seek(0)
 
-    # Upload to S3
+# Error result of a master built by pdf_build.build_master, None when it can be stored
+def master_error(invoice_number, invoice_pages, annexure_error):
+    if annexure_error:
+        logger.warning("Failed to add annexure page", invoice_number=invoice_number, error=annexure_error)
+    if invoice_pages == 0:
+        return {"error": "No pages found in Zoho PDF"}, 400
+    return None
+
+
+# Store the master PDF built for an event and publish it; the event's result. Only the
+# master is stored, the labelled copies are assembled by the PDF endpoint on request
+def store_invoice(event, copies, pdf_content, invoice_pages, annexure_pages):
+    bucket_name = event.get("bucket_name")
+    invoice_number = event.get("invoice_number")
+    sf_invoice_id = event.get("sf_invoice_id")
     try:
-        pdf_content = output_pdf.getvalue()
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=s3_key,
-            Body=pdf_content,
-            ContentType="application/pdf"
-        )
+        store_master(bucket_name, invoice_number, pdf_content, invoice_pages, copies, sf_invoice_id,
+                     annexure_pages=annexure_pages, zoho_last_modified=event.get("zoho_last_modified"),
+                     invoice_date=event.get("invoice_date"))
         return {
             "message": f"Invoice PDF ({copies} copies) uploaded successfully",
-            "s3_location": f"{event.get('invoice_url_prefix')}/{s3_key}"
+            "s3_location": publish_invoice(bucket_name, event.get("invoice_url_prefix"), invoice_number, copies,
+                                           event.get("invoice_date"), sf_invoice_id, pdf_content, invoice_pages)
         }, 200
     except Exception as s3_error:
-        return {"error": f"S3 upload failed: {str(s3_error)}"}, 400
\ No newline at end of file
+        return {"error": f"S3 upload failed: {str(s3_error)}"}, 400
+
+
+# With read_through, an invoice whose master PDF is already stored is answered without
+# touching Zoho, unless the event sets `force`. The steps are shared with the async
+# pipeline (src/async_pipeline.py)
+def get_invoice_function(event, read_through=False):
+    # Accept either a Zoho invoice id (`invoice_id`) or a Salesforce invoice number (`invoice_number`).
+    invoice_number = event.get("invoice_number")
+    copies = copies_of(event)
+
+    # Validate required fields
+    error = missing_fields(event)
+    if error:
+        return error
+
+    try:
+        if read_through and not forced(event):
+            result = stored_invoice(event, copies)
+            if result is not None:
+                return result
+        token_response = call_dependency(ZOHO, zoho_http.post, TOKEN_URL, data=token_request_data(event))
+        access_token, error = access_token_of(token_response)
+        if error:
+            return error
+        invoice_pdf_url, headers = pdf_request(event, access_token)
+        response = call_dependency(ZOHO, zoho_http.get, invoice_pdf_url, headers=headers)
+    except CircuitOpenError as e:
+        return {"error": str(e), "retryable": True}, 503
+    error = pdf_response_error(response)
+    if error:
+        return error
+
+    try:
+        with tracing.span("pdf merge", invoice_number=invoice_number, bytes=len(response.content)) as span:
+            pdf_content, invoice_pages, annexure_pages, annexure_error = build_master(response.content, event.get("annexure_data"))
+            span.set(output_bytes=len(pdf_content), pages=invoice_pages, annexure_pages=annexure_pages)
+    except Exception as pdf_error:
+        return {"error": f"Failed to read PDF from Zoho: {str(pdf_error)}"}, 400
+    error = master_error(invoice_number, invoice_pages, annexure_error)
+    if error:
+        return error
+
+    # Upload to S3
+    return store_invoice(event, copies, pdf_content, invoice_pages, annexure_pages)
+
+
+# get_invoice event of the PDF stage of an invoice just created in Zoho (`invoice` is
+# Zoho's invoice object)
+def pdf_stage_event(event, sf_invoice_id, copies, invoice, annexure_data):
+    return {
+        "client_id": event.get("client_id"),
+        "client_secret": event.get("client_secret"),
+        "refresh_token": event.get("refresh_token"),
+        "org_id": event.get("org_id"),
+        "invoice_number": event.get("InvoiceNumber__c"),
+        "sf_invoice_id": sf_invoice_id,
+        "invoice_id": invoice.get("invoice_id"),
+        "bucket_name": event.get("bucket_name"),
+        "invoice_url_prefix": event.get("invoice_url_prefix"),
+        "copies": copies,
+        "zoho_last_modified": invoice.get("last_modified_time"),
+        "invoice_date": invoice.get("date"),
+        "annexure_data": annexure_data
+    }
+
+
+# Fetching the PDF is optional: when the event is short on budget the stage is skipped
+# (this result) and recorded as a pending stage on the invoice so it can be completed later
+def pdf_stage_fits():
+    return deadline.has_budget(deadline.PDF_STAGE_MIN_SECONDS)
+
+
+def skipped_pdf_stage():
+    return {"error": "Skipped, not enough deadline budget left", "skipped": True}, None
+
+
+# Pending_Stages entry of a PDF stage left to reconciliation (src/reconcile.py)
+def pending_pdf_stage(get_event, force=False):
+    stage = {k: get_event[k] for k in PENDING_PDF_FIELDS}
+    if force:
+        stage["force"] = True
+    return {"Invoice_PDF": stage}
+
+
+# Record the result of the PDF stage of a new invoice on its item and in the event's
+# result; returns the GET_Invoice_Response entry and whether the stage failed
+def record_pdf_stage(get_event, body, status_code, dynamodb_payload, cloudwatch_payload):
+    get_invoice_response = {
+        "API_Status": status_code,
+        "API_Timestamp": str(datetime.now())
+    }
+    failed = False
+    if status_code == 200:
+        dynamodb_payload["Invoice_URL"] = body.get("s3_location")
+    elif body.get("skipped"):
+        dynamodb_payload["Invoice_URL"] = None
+        dynamodb_payload["Pending_Stages"] = pending_pdf_stage(get_event)
+        cloudwatch_payload["Skipped_Stages"] = ["Invoice_PDF"]
+    else:
+        dynamodb_payload["Invoice_URL"] = None
+        cloudwatch_payload["Get_Invoice_Error"] = body.get("error")
+        get_invoice_response["Error_Details"] = body.get("error")
+        failed = True
+    return get_invoice_response, failed
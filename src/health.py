@@ -0,0 +1,249 @@
+"""
+Start-up warm-up and the deep health check.
+
+The first event after a deploy used to pay for DNS lookups, TLS handshakes to
+Zoho and AWS and the first reportlab and PyPDF2 renders. `start()` does that
+work before the app takes traffic:
+
+    zoho   opens WARMUP_ZOHO_CONNECTIONS keep-alive connections to the Zoho
+           accounts and Books hosts in the shared pool (src/dependencies.py)
+    aws    makes one cheap call with every boto3 client of the loaded modules
+           (each client has its own connection pool)
+    pdf    renders an annexure page (reportlab fonts and styles) and builds
+           labelled copies of it (PyPDF2, the copy label overlays)
+
+The servers call it as they start (`python main.py`, the lifespan startup of
+asgi.py); importing main does not, so scripts and the queue consumer that
+import it pay for none of this. It then starts a background probe that checks every dependency each
+HEALTH_PROBE_INTERVAL_SECONDS, which also keeps a pooled connection to each of
+them alive. GET /health/deep answers from the probe's last results, so polling
+it costs nothing but a dict copy; GET /health stays a plain liveness check.
+
+A dependency that answers at all is reachable, errors included (a probe call
+refused for lack of permission still proves the endpoint and the TLS path
+work). /health/deep is 200 when every dependency was reachable on the last
+probe and 503 when one was not, or when the probe has not run recently.
+
+Probe calls are made directly, not through call_dependency: a failed probe must
+not open a circuit breaker or count as event latency.
+
+Configuration (environment variables):
+    WARMUP                         warm up when the app starts: 1 or 0 (default 1)
+    WARMUP_TIMEOUT_SECONDS         longest the warm-up may delay start-up (default 15)
+    WARMUP_ZOHO_CONNECTIONS        connections opened to each Zoho host (default 4)
+    HEALTH_PROBE_INTERVAL_SECONDS  seconds between dependency probes; 0 disables them and
+                                   /health/deep reports the warm-up results (default 30)
+    HEALTH_PROBE_TIMEOUT_SECONDS   timeout of a probe call (default 5)
+"""
+
+import io
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from boto3.resources.base import ServiceResource
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from PyPDF2 import PdfWriter
+from src.dependencies import zoho_http, S3, DYNAMODB, EVENTBRIDGE, SES
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT_SECONDS", "15"))
+WARMUP_ZOHO_CONNECTIONS = int(os.environ.get("WARMUP_ZOHO_CONNECTIONS", "4"))
+PROBE_INTERVAL = float(os.environ.get("HEALTH_PROBE_INTERVAL_SECONDS", "30"))
+PROBE_TIMEOUT = float(os.environ.get("HEALTH_PROBE_TIMEOUT_SECONDS", "5"))
+
+ZOHO_HOSTS = {
+    "zoho_accounts": "https://accounts.zoho.in/oauth/v2/token",
+    "zoho_books": "https://www.zohoapis.in/books/v3/organizations",
+}
+
+INVOICE_BUCKET = os.environ.get("INVOICE_BUCKET")
+
+# Cheapest call of each AWS service, by endpoint prefix
+AWS_PROBES = {
+    "dynamodb": (DYNAMODB, lambda client: client.describe_limits()),
+    "s3": (S3, lambda client: client.head_bucket(Bucket=INVOICE_BUCKET) if INVOICE_BUCKET else client.list_buckets()),
+    "events": (EVENTBRIDGE, lambda client: client.list_event_buses(Limit=1)),
+    "email": (SES, lambda client: client.get_send_quota()),
+}
+
+
+# Every boto3 client of the loaded src modules, including those held by module-level objects
+def _aws_clients():
+    clients = {}
+
+    def visit(value, depth):
+        if isinstance(value, ServiceResource):
+            value = value.meta.client
+        if isinstance(value, BaseClient):
+            clients[id(value)] = value
+        elif depth < 2 and hasattr(value, "__dict__") and not isinstance(value, type):
+            for attribute in list(vars(value).values()):
+                visit(attribute, depth + 1)
+
+    for name, module in list(sys.modules.items()):
+        if module is not None and (name == "src" or name.startswith("src.")):
+            for value in list(vars(module).values()):
+                if not isinstance(value, type(sys)):
+                    visit(value, 1)
+    return [client for client in clients.values() if _service(client) in AWS_PROBES]
+
+
+def _service(client):
+    return client.meta.service_model.endpoint_prefix
+
+
+def _probe(check):
+    start = time.monotonic()
+    result = {"reachable": True, "error": None}
+    try:
+        check()
+    except ClientError as e:
+        # Answered: reachable, even if the call itself was refused
+        result["error"] = e.response.get("Error", {}).get("Code")
+    except Exception as e:
+        result.update(reachable=False, error=f"{type(e).__name__}: {e}")
+    result["latency_ms"] = round((time.monotonic() - start) * 1000, 1)
+    result["checked_at"] = round(time.time(), 3)
+    return result
+
+
+def _zoho_check(url):
+    return lambda: zoho_http.head(url, timeout=PROBE_TIMEOUT, allow_redirects=False)
+
+
+def _aws_check(client):
+    return lambda: AWS_PROBES[_service(client)][1](client)
+
+
+# Probed dependency name -> check; one client per AWS service
+def _targets(clients):
+    targets = {name: _zoho_check(url) for name, url in ZOHO_HOSTS.items()}
+    for client in clients:
+        targets.setdefault(AWS_PROBES[_service(client)][0], _aws_check(client))
+    return targets
+
+
+class Prober:
+    """Probes every dependency in the background and keeps the last results."""
+
+    def __init__(self, interval, clients):
+        self.interval = interval
+        self.targets = _targets(clients)
+        self.results = {}
+        self.last_run = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.targets), thread_name_prefix="health-probe")
+
+    def record(self, name, result):
+        with self._lock:
+            self.results[name] = result
+
+    def run_once(self):
+        futures = {name: self._executor.submit(_probe, check) for name, check in self.targets.items()}
+        for name, future in futures.items():
+            self.record(name, future.result())
+        self.last_run = time.time()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Health probe failed", error=str(e))
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True, name="health-prober").start()
+
+    # (body, HTTP status) of /health/deep
+    def report(self):
+        with self._lock:
+            results = dict(self.results)
+        age = None if self.last_run is None else round(time.time() - self.last_run, 1)
+        # Without a periodic probe (interval 0) the warm-up results stand
+        if age is None or (self.interval and age > 3 * self.interval):
+            status = "stale"
+        elif all(result["reachable"] for result in results.values()):
+            status = "healthy"
+        else:
+            status = "degraded"
+        return {"status": status, "probe_age_seconds": age, "dependencies": results}, 200 if status == "healthy" else 503
+
+
+prober = None
+warmed_up = False
+
+
+def _warm_zoho(url):
+    # Concurrent requests, so the pool ends up holding that many connections
+    with ThreadPoolExecutor(max_workers=WARMUP_ZOHO_CONNECTIONS) as executor:
+        results = list(executor.map(lambda _: _probe(_zoho_check(url)), range(WARMUP_ZOHO_CONNECTIONS)))
+    return min(results, key=lambda result: (not result["reachable"], result["latency_ms"]))
+
+
+def _warm_pdf():
+    # Imported here: get_invoice pulls in reportlab and every handler dependency
+    from src.get_invoice import create_annexure_pdf
+    from src.invoice_pdf import build_invoice_copies
+    writer = PdfWriter()
+    writer.add_page(create_annexure_pdf([{"shipmentName": "warm-up", "amount": 0, "orderSellerTechFee": 0, "techFeeAmount": 0}]))
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    build_invoice_copies(pdf.getvalue(), 2, invoice_pages=1)
+
+
+# Open connections and load what the first event would, for at most `timeout` seconds.
+# Returns the Zoho results by host name and the AWS results in the order of `clients`
+def warm_up(clients, timeout=WARMUP_TIMEOUT):
+    start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=len(ZOHO_HOSTS) + len(clients) + 1, thread_name_prefix="warm-up")
+    zoho = {name: executor.submit(_warm_zoho, url) for name, url in ZOHO_HOSTS.items()}
+    aws = [executor.submit(_probe, _aws_check(client)) for client in clients]
+    pdf = executor.submit(_probe, _warm_pdf)
+    wait(list(zoho.values()) + aws + [pdf], timeout=timeout)
+    # Steps still running finish in the background
+    executor.shutdown(wait=False)
+
+    def result(future):
+        return future.result() if future.done() else {"reachable": False, "error": "warm-up timed out", "latency_ms": None}
+
+    zoho, aws, pdf = {name: result(future) for name, future in zoho.items()}, [result(future) for future in aws], result(pdf)
+    logger.info("Warm-up finished", seconds=round(time.monotonic() - start, 3), pdf=pdf["error"] or pdf["latency_ms"],
+                zoho={name: r["error"] or r["latency_ms"] for name, r in zoho.items()},
+                aws=[f"{_service(client)}: {r['error'] or r['latency_ms']}" for client, r in zip(clients, aws)])
+    return zoho, aws
+
+
+# Warm up (when enabled) and start the background probe; once per process
+def start():
+    global prober, warmed_up
+    if prober is not None:
+        return
+    clients = _aws_clients()
+    prober = Prober(PROBE_INTERVAL, clients)
+    if WARMUP:
+        zoho, aws = warm_up(clients)
+        # The warm-up doubles as the first probe
+        for name, result in zoho.items():
+            prober.record(name, result)
+        for client, result in zip(clients, aws):
+            prober.results.setdefault(AWS_PROBES[_service(client)][0], result)
+        prober.last_run = time.time()
+        warmed_up = True
+    if PROBE_INTERVAL > 0:
+        prober.start()
+
+
+# (body, HTTP status) of /health/deep
+def deep_report():
+    if prober is None:
+        return {"status": "stale", "probe_age_seconds": None, "dependencies": {}, "warmed_up": False}, 503
+    body, status = prober.report()
+    body["warmed_up"] = warmed_up
+    return body, status
@@ -0,0 +1,127 @@
+"""
+Idempotent result cache for /event replays.
+
+When Salesforce replays an event that already completed, the stored result is
+returned straight away instead of running the handler again (which would hit Zoho,
+send a duplicate-invoice SES email or republish to EventBridge). Events are keyed
+by an explicit idempotency key (Idempotency-Key header or IdempotencyKey__c field)
+or, failing that, by a hash of the whole event. Buyer address updates are replayed
+only with an explicit key: the same addresses sent again may revert a later change.
+
+Completed results are kept in an in-process LRU cache with a TTL, backed by an
+optional DynamoDB table so replays are recognised across workers and restarts.
+
+Configuration (environment variables):
+    IDEMPOTENCY_TABLE        DynamoDB table (partition key `Idempotency_Key`, TTL
+                             attribute `Expires_At`); unset keeps results in memory only
+    IDEMPOTENCY_TTL_SECONDS  how long a completed result is replayed (default 86400)
+    IDEMPOTENCY_CACHE_SIZE   results kept in the in-process LRU cache (default 1024)
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import boto3
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, DYNAMODB
+from src.singleflight import fingerprint
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+TABLE_NAME = os.environ.get("IDEMPOTENCY_TABLE")
+TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "86400"))
+CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "1024"))
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_FIELD = "IdempotencyKey__c"
+
+# Actions whose completed results are replayed
+IDEMPOTENT_ACTIONS = ("CreateZohoAccount", "Buyer", "Seller_Technology_Fee", "X1VP_Subscription")
+
+
+class ResultCache:
+    """LRU cache of completed results with a TTL, optionally backed by DynamoDB."""
+
+    def __init__(self, max_entries, ttl, table_name=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = boto3.resource("dynamodb", config=AWS_CLIENT_CONFIG).Table(table_name) if table_name else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _put_local(self, key, result, expires_at):
+        with self._lock:
+            self._entries[key] = (result, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+
+        if self.table is None:
+            return None
+        try:
+            item = call_dependency(DYNAMODB, self.table.get_item, Key={"Idempotency_Key": key}).get("Item")
+        except Exception as e:
+            # A cache that cannot be read just means the event runs normally
+            logger.warning("Failed to read idempotency record", key=key, error=str(e))
+            return None
+        # DynamoDB deletes expired items lazily, so check the expiry here as well
+        if not item or int(item["Expires_At"]) <= now:
+            return None
+        result = json.loads(item["Result"])
+        self._put_local(key, result, int(item["Expires_At"]))
+        return result
+
+    def put(self, key, result):
+        expires_at = int(time.time()) + self.ttl
+        self._put_local(key, result, expires_at)
+        if self.table is None:
+            return
+        try:
+            call_dependency(DYNAMODB, self.table.put_item, Item={
+                "Idempotency_Key": key,
+                "Result": json.dumps(result, default=str),
+                "Expires_At": expires_at
+            })
+        except Exception as e:
+            logger.warning("Failed to store idempotency record", key=key, error=str(e))
+
+
+cache = ResultCache(CACHE_SIZE, TTL_SECONDS, TABLE_NAME)
+
+
+# Idempotency key for an event, or None when the event is not replayed
+def key_for(action, event, header_value=None, model=None):
+    if action not in IDEMPOTENT_ACTIONS:
+        return None
+    explicit = header_value or event.get(IDEMPOTENCY_FIELD)
+    if explicit:
+        return f"{action}:{explicit}"
+    # An address update that reverts an earlier one (A -> B -> A) is byte-identical to it
+    # and must still reach Zoho: only an explicit key makes it replayable
+    if model is not None and model.is_address_update:
+        return None
+    return f"{action}:sha256:{fingerprint(event)}"
+
+
+# Stored result of a completed event, or None
+def lookup(key):
+    return cache.get(key) if key else None
+
+
+# Store the result of an event if it completed
+def remember(key, result):
+    if key and isinstance(result, dict) and "error" not in result:
+        cache.put(key, result)
@@ -0,0 +1,466 @@
+"""
+Master invoice PDFs and on-demand copy rendering.
+
+One master PDF is stored per invoice, in the backend chosen by PDF_STORAGE: the
+Zoho invoice pages followed by the annexure page, if any. The labelled copies
+(Original, Duplicate, ...) are not stored; GET /invoice/<invoice_number>/pdf?copies=N&annexure=0|1 assembles them
+from the master on request, so changing the copy count needs no regeneration and
+S3 holds a single copy of every invoice.
+
+The master's S3 metadata records how many of its pages belong to the invoice
+(`invoice-pages`, the rest is annexure) and the default copy count (`copies`).
+Assembled PDFs are cached in memory (LRU, bounded in bytes) and optionally on
+disk, keyed by the master's ETag so a regenerated master is never served stale.
+
+Salesforce gets the URL `publish_invoice` returns, never a master's (master keys
+are guessable from the invoice number: the master prefix must not be publicly
+readable). INVOICE_URL_MODE picks it:
+
+    endpoint  the PDF endpoint under INVOICE_PDF_BASE_URL, signed with
+              INVOICE_URL_SECRET over the bucket, invoice number and date (default).
+              The endpoint serves signed URLs only, from the bucket the URL names
+              (INVOICE_BUCKET when it names none), so invoices of any tenant can be
+              served and none can be enumerated. Only the master is stored.
+    copies    transitional, for deployments whose PDF endpoint is not reachable from
+              Salesforce yet: the labelled copies are also assembled and stored,
+              under invoices/<sf_invoice_id>_<invoice_number>.pdf as before masters
+              (invoices/<invoice_number>.pdf without a Salesforce id): two objects
+              per invoice, and PDF work on the create path. The copies record the
+              ETag of the master they were assembled from (`master-etag`), so
+              publishing an unchanged master with the same copy count again (a
+              read-through get_invoice) only HEADs both objects.
+
+Master keys follow PDF_KEY_LAYOUT, spreading month-end bursts over many S3 prefixes:
+
+    flat   invoices/master/<invoice_number>.pdf (default)
+    hash   invoices/master/<h0h1>/<h2h3>/<invoice_number>.pdf, h = sha256(invoice_number)
+    date   invoices/master/<YYYY>/<MM>/<DD>/<invoice_number>.pdf from the Zoho invoice
+           date; the hash key when the date is not known
+
+An invoice is looked up under every key it may have (the layout's keys, then the
+flat key), and a regenerated master is written back to the key it already has, so
+an invoice URL given out once keeps working after regeneration or a layout change.
+
+`stored_master` answers whether a master exists (used by the read-through
+get_invoice action) from a short-lived local index, falling back to a HEAD.
+The metadata also carries the Zoho `last_modified_time` of the invoice the master
+was rendered from (`zoho-last-modified`) and its annexure page count.
+
+Configuration (environment variables):
+    INVOICE_BUCKET             bucket holding the master PDFs, for the PDF endpoint
+    INVOICE_URL_MODE           endpoint or copies (default endpoint)
+    INVOICE_PDF_BASE_URL       public base URL of this service; required in endpoint mode
+    INVOICE_URL_SECRET         key signing the PDF endpoint URLs; required in endpoint mode
+    INVOICE_MAX_COPIES         highest copy count the endpoint renders (default 10)
+    PDF_CACHE_MAX_BYTES        size of the in-memory cache of assembled PDFs (default 67108864)
+    PDF_CACHE_DIR              directory of the disk cache; unset disables it
+    PDF_CACHE_DISK_MAX_FILES   assembled PDFs kept in the disk cache (default 1000)
+    MASTER_INDEX_TTL_SECONDS   how long a master's metadata is trusted without a HEAD (default 300)
+    PDF_KEY_LAYOUT             flat, hash or date (default flat)
+"""
+
+import hashlib
+import hmac
+import io
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject
+from src.pdf_storage import create_storage
+from src.log import get_logger
+from src import tracing
+
+logger = get_logger(__name__)
+
+# Where master PDFs are stored, see src/pdf_storage.py
+storage = create_storage()
+
+INVOICE_BUCKET = os.environ.get("INVOICE_BUCKET")
+URL_MODE = os.environ.get("INVOICE_URL_MODE", "endpoint")
+INVOICE_PDF_BASE_URL = os.environ.get("INVOICE_PDF_BASE_URL")
+INVOICE_URL_SECRET = os.environ.get("INVOICE_URL_SECRET")
+MAX_COPIES = int(os.environ.get("INVOICE_MAX_COPIES", "10"))
+CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_DIR = os.environ.get("PDF_CACHE_DIR")
+CACHE_DISK_MAX_FILES = int(os.environ.get("PDF_CACHE_DISK_MAX_FILES", "1000"))
+MASTER_INDEX_TTL = float(os.environ.get("MASTER_INDEX_TTL_SECONDS", "300"))
+MASTER_INDEX_SIZE = 4096
+KEY_LAYOUT = os.environ.get("PDF_KEY_LAYOUT", "flat")
+
+if URL_MODE not in ("endpoint", "copies"):
+    raise ValueError(f"Unknown INVOICE_URL_MODE: {URL_MODE}")
+if URL_MODE == "endpoint" and not (INVOICE_PDF_BASE_URL and INVOICE_URL_SECRET):
+    raise ValueError("INVOICE_URL_MODE=endpoint needs INVOICE_PDF_BASE_URL and INVOICE_URL_SECRET "
+                     "(INVOICE_URL_MODE=copies stores the copies instead, while moving over)")
+
+MASTER_PREFIX = "invoices/master"
+INVOICE_DATE_PATTERN = re.compile(r"^(\d{4})-(\d{2})-(\d{2})")
+
+COPY_LABELS = ["Original", "Duplicate", "Triplate", "Quadruplicate", "Quintuplicate", "Sextuplicate"]
+
+# Font resource name of the copy label; unlikely to clash with the names Zoho uses
+LABEL_FONT = "/FCopyLabel"
+
+
+class InvoicePdfNotFound(Exception):
+    """Raised when no master PDF is stored for an invoice."""
+
+
+def copy_label(copy_num):
+    return COPY_LABELS[copy_num] if copy_num < len(COPY_LABELS) else f"Copy {copy_num+1}"
+
+
+def _add_stream(writer, data):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return writer._add_object(stream)
+
+
+class _SharedCopyObjects:
+    """Objects written once and referenced by every copy of every page."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        # The original content runs between q/Q so the label is drawn in the default graphics state
+        self.save_state = _add_stream(writer, b"q\n")
+        self.restore_state = _add_stream(writer, b"\nQ\n")
+        self.label_font = writer._add_object(DictionaryObject({
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/Helvetica"),
+            NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+        }))
+        self._pages = {}
+        self._labels = {}
+
+    # Label overlay drawn at the top left of a page (same place as the old reportlab header page)
+    def label(self, text, height):
+        key = (text, height)
+        if key not in self._labels:
+            escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            self._labels[key] = _add_stream(self.writer, f"BT {LABEL_FONT} 16 Tf 30 {height - 30:.2f} Td ({escaped}) Tj ET\n".encode("latin-1"))
+        return self._labels[key]
+
+    # Content stream references and resources of an original page, shared by its copies
+    def page(self, index, page):
+        if index not in self._pages:
+            contents = page.raw_get("/Contents") if "/Contents" in page else ArrayObject()
+            if isinstance(contents, ArrayObject):
+                contents = list(contents)
+            elif isinstance(contents, IndirectObject):
+                contents = [contents]
+            else:
+                contents = [self.writer._add_object(contents)]
+
+            resources = page["/Resources"] if "/Resources" in page else DictionaryObject()
+            merged = DictionaryObject({key: resources.raw_get(key) for key in resources})
+            fonts = resources["/Font"] if "/Font" in resources else DictionaryObject()
+            merged[NameObject("/Font")] = DictionaryObject({key: fonts.raw_get(key) for key in fonts})
+            merged["/Font"][NameObject(LABEL_FONT)] = self.label_font
+            self._pages[index] = ([self.save_state] + contents + [self.restore_state], self.writer._add_object(merged))
+        return self._pages[index]
+
+
+def build_invoice_copies(pdf_content, copies, invoice_pages=None, annexure=True):
+    """Return the PDF bytes of `copies` labelled copies of the invoice, the annexure following the first copy.
+
+    The first `invoice_pages` pages of `pdf_content` are the invoice (all pages when
+    None), the rest is annexure. Fonts, images and content streams of the invoice are
+    written once and referenced by every copy; a copy only adds its page dictionaries
+    and a tiny label stream.
+    """
+    reader = PdfReader(io.BytesIO(pdf_content))
+    pages = list(reader.pages)
+    if invoice_pages is None:
+        invoice_pages = len(pages)
+    writer = PdfWriter()
+    shared = _SharedCopyObjects(writer)
+    for copy_num in range(copies):
+        label = copy_label(copy_num)
+        for index, page in enumerate(pages[:invoice_pages]):
+            # add_page clones only the page dictionary; the objects below it are added once
+            copy_page = writer.add_page(page)
+            contents, resources = shared.page(index, copy_page)
+            copy_page[NameObject("/Contents")] = ArrayObject(contents + [shared.label(label, float(copy_page.mediabox.height))])
+            copy_page[NameObject("/Resources")] = resources
+
+        # Add annexure only once, after the first copy
+        if copy_num == 0 and annexure:
+            for page in pages[invoice_pages:]:
+                writer.add_page(page)
+
+    output_pdf = io.BytesIO()
+    writer.write(output_pdf)
+    return output_pdf.getvalue()
+
+
+def _flat_key(invoice_number):
+    return f"{MASTER_PREFIX}/{invoice_number}.pdf"
+
+
+def _hash_key(invoice_number):
+    digest = hashlib.sha256(str(invoice_number).encode()).hexdigest()
+    return f"{MASTER_PREFIX}/{digest[:2]}/{digest[2:4]}/{invoice_number}.pdf"
+
+
+def _date_key(invoice_number, invoice_date):
+    match = INVOICE_DATE_PATTERN.match(str(invoice_date or ""))
+    if not match:
+        return None
+    return f"{MASTER_PREFIX}/{match.group(1)}/{match.group(2)}/{match.group(3)}/{invoice_number}.pdf"
+
+
+# Key a new master is written to under the configured layout
+def master_key(invoice_number, invoice_date=None, layout=None):
+    layout = layout or KEY_LAYOUT
+    if layout == "date":
+        return _date_key(invoice_number, invoice_date) or _hash_key(invoice_number)
+    if layout == "hash":
+        return _hash_key(invoice_number)
+    return _flat_key(invoice_number)
+
+
+# Every key a master of the invoice may be stored under, most likely first
+def candidate_keys(invoice_number, invoice_date=None):
+    keys = [master_key(invoice_number, invoice_date)]
+    if KEY_LAYOUT == "date":
+        keys.append(_hash_key(invoice_number))
+    keys.append(_flat_key(invoice_number))
+    return list(OrderedDict.fromkeys(keys))
+
+
+# Storage metadata of a master PDF
+def master_metadata(invoice_pages, copies, sf_invoice_id=None, annexure_pages=0, zoho_last_modified=None, invoice_date=None):
+    metadata = {"invoice-pages": str(invoice_pages), "annexure-pages": str(annexure_pages), "copies": str(copies)}
+    if sf_invoice_id:
+        metadata["sf-invoice-id"] = str(sf_invoice_id)
+    if zoho_last_modified:
+        metadata["zoho-last-modified"] = str(zoho_last_modified)
+    if invoice_date:
+        metadata["invoice-date"] = str(invoice_date)
+    return metadata
+
+
+# Store the master PDF of an invoice; returns the key it was stored under
+def store_master(bucket_name, invoice_number, pdf_content, invoice_pages, copies, sf_invoice_id=None, annexure_pages=0, zoho_last_modified=None, invoice_date=None):
+    metadata = master_metadata(invoice_pages, copies, sf_invoice_id, annexure_pages, zoho_last_modified, invoice_date)
+    # A regenerated master keeps the key (and so the URL) of the one it replaces
+    key, _ = locate_master(bucket_name, invoice_number, invoice_date)
+    key = key or master_key(invoice_number, invoice_date)
+    storage.put(bucket_name, key, pdf_content, metadata)
+    master_index.remember(bucket_name, invoice_number, key, metadata)
+    return key
+
+
+def url_token(bucket_name, invoice_number, invoice_date=None):
+    message = f"{bucket_name}\n{invoice_number}\n{invoice_date or ''}".encode()
+    return hmac.new(INVOICE_URL_SECRET.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+# Whether a PDF endpoint request carries the token of a URL handed out by invoice_url
+def verify_url_token(bucket_name, invoice_number, invoice_date, token):
+    if not INVOICE_URL_SECRET or not token:
+        return False
+    return hmac.compare_digest(str(token), url_token(bucket_name, invoice_number, invoice_date))
+
+
+# Signed PDF endpoint URL of an invoice; the bucket is named when it is not INVOICE_BUCKET
+def invoice_url(bucket_name, invoice_number, copies, invoice_date=None):
+    invoice_date = invoice_date if KEY_LAYOUT == "date" else None
+    params = {"copies": copies}
+    if bucket_name != INVOICE_BUCKET:
+        params["bucket"] = bucket_name
+    if invoice_date:
+        params["date"] = invoice_date
+    params["token"] = url_token(bucket_name, invoice_number, invoice_date)
+    return f"{INVOICE_PDF_BASE_URL.rstrip('/')}/invoice/{invoice_number}/pdf?{urlencode(params)}"
+
+
+# Key of the stored copies of an invoice, the same on every call so republishing replaces
+# them; the Salesforce id, when the invoice has one, keeps it unguessable
+def copies_key(invoice_number, sf_invoice_id=None):
+    if sf_invoice_id:
+        return f"invoices/{sf_invoice_id}_{invoice_number}.pdf"
+    return f"invoices/{invoice_number}.pdf"
+
+
+# URL of an invoice's PDF with `copies` labelled copies, for Salesforce: the signed PDF
+# endpoint, or in copies mode the copies stored under copies_key. These are assembled
+# again (from `master_pdf`, read from storage when None) only when the stored ones are
+# of another master or copy count
+def publish_invoice(bucket_name, invoice_url_prefix, invoice_number, copies, invoice_date=None, sf_invoice_id=None,
+                    master_pdf=None, invoice_pages=None):
+    if URL_MODE == "endpoint":
+        return invoice_url(bucket_name, invoice_number, copies, invoice_date)
+    key = copies_key(invoice_number, sf_invoice_id)
+    source_key, _ = locate_master(bucket_name, invoice_number, invoice_date)
+    master = storage.head(bucket_name, source_key) if source_key else None
+    if master is None:
+        raise InvoicePdfNotFound(f"No PDF stored for invoice {invoice_number}")
+    stored = storage.head(bucket_name, key)
+    if stored is not None and stored["metadata"].get("master-etag") == master["etag"] and stored["metadata"].get("copies") == str(copies):
+        return f"{invoice_url_prefix}/{key}"
+
+    if master_pdf is None:
+        master = storage.get(bucket_name, source_key)
+        if master is None:
+            raise InvoicePdfNotFound(f"No PDF stored for invoice {invoice_number}")
+        master_pdf = master["body"]
+        invoice_pages = int(master["metadata"]["invoice-pages"]) if "invoice-pages" in master["metadata"] else None
+    with tracing.span("pdf copies", invoice_number=invoice_number, copies=copies, bytes=len(master_pdf)) as span:
+        content = build_invoice_copies(master_pdf, copies, invoice_pages)
+        span.set(output_bytes=len(content))
+    storage.put(bucket_name, key, content, {"copies": str(copies), "master-etag": master["etag"]})
+    return f"{invoice_url_prefix}/{key}"
+
+
+class PdfCache:
+    """LRU cache of assembled PDFs bounded in bytes, with an optional disk tier."""
+
+    def __init__(self, max_bytes, directory=None, max_files=1000):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + ".pdf")
+
+    def _put_memory(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = content
+            self._size += len(content)
+            while self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1])
+
+    def get(self, key):
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self._entries.move_to_end(key)
+                return content
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            # Touch the file so the disk tier evicts least recently used files first
+            os.utime(path)
+        except OSError:
+            return None
+        self._put_memory(key, content)
+        return content
+
+    def put(self, key, content):
+        self._put_memory(key, content)
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            # Write to a temporary file first so readers never see a partial PDF
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+            self._prune_disk()
+        except OSError as e:
+            logger.warning("Failed to write PDF cache file", path=path, error=str(e))
+
+    def _prune_disk(self):
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".pdf")]
+        if len(files) <= self.max_files:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+cache = PdfCache(CACHE_MAX_BYTES, CACHE_DIR, CACHE_DISK_MAX_FILES)
+
+
+class MasterIndex:
+    """Key and metadata of recently seen master PDFs, so a lookup usually needs no HEAD."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def remember(self, bucket_name, invoice_number, key, metadata):
+        with self._lock:
+            self._entries[(bucket_name, invoice_number)] = (key, metadata, time.monotonic() + self.ttl)
+            self._entries.move_to_end((bucket_name, invoice_number))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, bucket_name, invoice_number, invoice_date=None):
+        with self._lock:
+            entry = self._entries.get((bucket_name, invoice_number))
+            if entry is not None:
+                if entry[2] > time.monotonic():
+                    return entry[0], entry[1]
+                del self._entries[(bucket_name, invoice_number)]
+        for key in candidate_keys(invoice_number, invoice_date):
+            head = storage.head(bucket_name, key)
+            if head is not None:
+                self.remember(bucket_name, invoice_number, key, head["metadata"])
+                return key, head["metadata"]
+        return None, None
+
+
+master_index = MasterIndex(MASTER_INDEX_TTL, MASTER_INDEX_SIZE)
+
+
+# Key and metadata of the stored master PDF of an invoice, (None, None) when there is none
+def locate_master(bucket_name, invoice_number, invoice_date=None):
+    return master_index.get(bucket_name, invoice_number, invoice_date)
+
+
+# Metadata of the stored master PDF of an invoice, or None when there is none
+def stored_master(bucket_name, invoice_number, invoice_date=None):
+    return locate_master(bucket_name, invoice_number, invoice_date)[1]
+
+
+# PDF of an invoice with `copies` labelled copies (the stored default when None), with or without its annexure
+def render_invoice_pdf(invoice_number, copies=None, annexure=True, bucket_name=None, invoice_date=None):
+    bucket_name = bucket_name or INVOICE_BUCKET
+    key, _ = locate_master(bucket_name, invoice_number, invoice_date)
+    # The ETag always comes from a fresh HEAD, the index only saves probing the candidate keys
+    head = storage.head(bucket_name, key) if key else None
+    if head is None:
+        raise InvoicePdfNotFound(f"No PDF stored for invoice {invoice_number}")
+    if copies is None:
+        copies = int(head["metadata"].get("copies", "1"))
+
+    cache_key = (invoice_number, head["etag"], copies, annexure)
+    content = cache.get(cache_key)
+    if content is not None:
+        return content
+
+    # The master may have been replaced since the HEAD: cache under the ETag actually read
+    master = storage.get(bucket_name, key)
+    if master is None:
+        raise InvoicePdfNotFound(f"No PDF stored for invoice {invoice_number}")
+    metadata = master["metadata"]
+    invoice_pages = int(metadata["invoice-pages"]) if "invoice-pages" in metadata else None
+    with tracing.span("pdf copies", invoice_number=invoice_number, copies=copies, bytes=len(master["body"])) as span:
+        content = build_invoice_copies(master["body"], copies, invoice_pages, annexure)
+        span.set(output_bytes=len(content))
+    cache.put((invoice_number, master["etag"], copies, annexure), content)
+    return content
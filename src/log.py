@@ -0,0 +1,184 @@
+"""
+Structured JSON logging without blocking the request path.
+
+Every module logs through `get_logger(__name__)`; keyword arguments become JSON
+fields of the line:
+
+    logger.warning("Failed to read idempotency record", key=key, error=str(e))
+
+Lines are formatted on the calling thread and handed to a bounded queue; a
+background listener thread writes them to stdout. When the queue is full the
+line is dropped and counted instead of making the request wait.
+
+Each line carries the correlation ID of the event being handled (the invoice
+number or Salesforce record id), set by `correlation(event)` in handle_event and
+inherited by the handler's worker threads. Debug lines are sampled per event: an
+event either logs all of its debug lines or none. Secrets (client_secret,
+refresh_token, access tokens, Authorization headers) are redacted from the
+fields and from the message text.
+
+Configuration (environment variables):
+    LOG_LEVEL              minimum level written (default INFO)
+    LOG_DEBUG_SAMPLE_RATE  fraction of events whose debug lines are written (default 0.01)
+    LOG_QUEUE_SIZE         lines buffered for the writer thread before dropping (default 10000)
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+LOGGER_NAME = "zoho_integration"
+
+# Event fields identifying what an event is about, in order of preference
+CORRELATION_FIELDS = ("InvoiceNumber__c", "RecordID__c", "invoice_number")
+
+SECRET_KEYS = {"client_secret", "refresh_token", "access_token", "authorization", "password"}
+REDACTED = "[REDACTED]"
+# key=value, "key": "value" and Zoho-oauthtoken <token> forms inside free text
+_SECRET_TEXT = re.compile(r'((?:client_secret|refresh_token|access_token)"?\s*[:=]\s*"?)[^"&,\s}]+|(Zoho-oauthtoken\s+)\S+', re.IGNORECASE)
+
+_correlation_id = contextvars.ContextVar("correlation_id", default=None)
+_debug_sampled = contextvars.ContextVar("debug_sampled", default=None)
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if str(k).lower() in SECRET_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+def redact_text(text):
+    return _SECRET_TEXT.sub(lambda m: (m.group(1) or m.group(2)) + REDACTED, text)
+
+
+def correlation_id_for(event):
+    for field in CORRELATION_FIELDS:
+        if event.get(field):
+            return str(event[field])
+    return uuid.uuid4().hex[:12]
+
+
+# Tag every line logged while handling `event` with its correlation ID
+@contextmanager
+def correlation(event):
+    id_token = _correlation_id.set(correlation_id_for(event) if isinstance(event, dict) else uuid.uuid4().hex[:12])
+    sample_token = _debug_sampled.set(random.random() < DEBUG_SAMPLE_RATE)
+    try:
+        yield
+    finally:
+        _debug_sampled.reset(sample_token)
+        _correlation_id.reset(id_token)
+
+
+def current_correlation_id():
+    return _correlation_id.get()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name[len(LOGGER_NAME) + 1:] or record.name,
+            "correlation_id": getattr(record, "correlation_id", None),
+            "message": redact_text(record.getMessage()),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            line.update(redact(fields))
+        if record.exc_info:
+            line["exception"] = redact_text(self.formatException(record.exc_info))
+        return json.dumps(line, default=str)
+
+
+class _SampleDebug(logging.Filter):
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        sampled = _debug_sampled.get()
+        return random.random() < DEBUG_SAMPLE_RATE if sampled is None else sampled
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Formats on the caller's thread (the record may refer to objects it mutates later) and never waits."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        record.correlation_id = _correlation_id.get()
+        line = self.format(record)
+        return logging.makeLogRecord({"msg": line, "levelno": record.levelno, "levelname": record.levelname})
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """Logger whose keyword arguments become JSON fields."""
+
+    def process(self, msg, kwargs):
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in ("exc_info", "stack_info", "extra")}
+        kwargs["extra"] = {"fields": fields}
+        return msg, kwargs
+
+
+_handler = None
+_setup_lock = threading.Lock()
+
+
+def _setup():
+    global _handler
+    with _setup_lock:
+        if _handler is not None:
+            return
+        log_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        handler = _DroppingQueueHandler(log_queue)
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(_SampleDebug())
+        writer = logging.StreamHandler(sys.stdout)
+        listener = logging.handlers.QueueListener(log_queue, writer)
+        listener.start()
+        # Write what is still queued when the process exits
+        atexit.register(listener.stop)
+
+        base = logging.getLogger(LOGGER_NAME)
+        base.setLevel(LOG_LEVEL)
+        base.addHandler(handler)
+        base.propagate = False
+        _handler = handler
+
+
+def get_logger(name):
+    _setup()
+    return StructuredLogger(logging.getLogger(f"{LOGGER_NAME}.{name}"), {})
+
+
+# Lines dropped because the writer thread fell behind
+def dropped_lines():
+    return _handler.dropped if _handler is not None else 0
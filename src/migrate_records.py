@@ -0,0 +1,151 @@
+"""
+Migration of the invoice and account tables to the compact record schema
+(src/records.py).
+
+Both tables are read with a segmented parallel Scan (one thread and boto3
+session per segment), filtered to the items that still carry legacy fields. For
+each one the legacy maps and timestamps are recorded in the audit store
+(src/audit.py) and the item is rewritten with a single update_item that SETs the
+status fields and REMOVEs the legacy ones. The update is conditional on the item
+not having been written since the scan (every handler write sets Updated_At),
+so an item a handler rewrote in the meantime is left alone; a re-run picks it
+up if it still needs it.
+
+Without --apply nothing is written: the report only counts the items to migrate
+and the bytes they would shed. --apply needs AUDIT_BUCKET (see src/audit.py). The audit files are rotated and shipped before
+the command exits.
+
+Usage (from the repository root):
+    python -m src.migrate_records --invoice-table Invoices --account-table Accounts \\
+        [--segments 8] [--output report.json] [--apply]
+"""
+
+import argparse
+import contextvars
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import boto3
+from botocore.exceptions import ClientError
+from src import audit, records
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, DYNAMODB
+
+
+def _size(item):
+    return len(json.dumps(item, default=str))
+
+
+def _migrate_item(table, kind, item, apply):
+    key_field = records.KEY_FIELDS[kind]
+    compacted, history = records.split(kind, item, migrating=True)
+    changes = {field: value for field, value in compacted.items() if field not in item or item[field] != value}
+    saved = _size(item) - _size(compacted)
+    if not apply:
+        return "to_migrate", saved
+
+    # History first: an interrupted run may audit an item twice, but never loses it
+    audit.record(kind, item[key_field], history, block=True)
+    names = {f"#s{i}": field for i, field in enumerate(changes)}
+    names.update({f"#l{i}": field for i, field in enumerate(history)})
+    names["#u"] = "Updated_At"
+    values = {f":s{i}": value for i, value in enumerate(changes.values())}
+    expression = "REMOVE " + ", ".join(f"#l{i}" for i in range(len(history)))
+    if changes:
+        expression = "SET " + ", ".join(f"#s{i} = :s{i}" for i in range(len(changes))) + " " + expression
+    # Every handler write sets Updated_At: the item must not have been written since the scan
+    condition = " AND ".join(f"attribute_exists(#l{i})" for i in range(len(history)))
+    if "Updated_At" in item:
+        condition += " AND #u = :scanned_updated_at"
+        values[":scanned_updated_at"] = item["Updated_At"]
+    else:
+        condition += " AND attribute_not_exists(#u)"
+    try:
+        call_dependency(DYNAMODB, table.update_item,
+            Key={key_field: item[key_field]},
+            UpdateExpression=expression,
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            **({"ExpressionAttributeValues": values} if values else {}))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return "changed_meanwhile", 0
+        raise
+    return "migrated", saved
+
+
+def _migrate_segment(table_name, kind, segment, total_segments, apply):
+    # boto3 resources are not thread-safe, every segment gets its own session
+    table = boto3.session.Session().resource("dynamodb", config=AWS_CLIENT_CONFIG).Table(table_name)
+    legacy = tuple(records.LEGACY_FIELDS[kind]) + records.TIMESTAMP_FIELDS
+    kwargs = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "FilterExpression": " OR ".join(f"attribute_exists(#l{i})" for i in range(len(legacy))),
+        "ExpressionAttributeNames": {f"#l{i}": field for i, field in enumerate(legacy)}
+    }
+    counts = {"scanned": 0, "to_migrate": 0, "migrated": 0, "changed_meanwhile": 0, "failed": 0, "bytes_saved": 0}
+    failures = []
+    while True:
+        response = call_dependency(DYNAMODB, table.scan, **kwargs)
+        counts["scanned"] += response.get("ScannedCount", 0)
+        for item in response.get("Items", []):
+            try:
+                outcome, saved = _migrate_item(table, kind, item, apply)
+            except Exception as e:
+                outcome, saved = "failed", 0
+                failures.append({"key": item.get(records.KEY_FIELDS[kind]), "error": str(e)})
+            counts[outcome] += 1
+            counts["bytes_saved"] += saved
+        if "LastEvaluatedKey" not in response:
+            return counts, failures
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def migrate_table(table_name, kind, segments, apply):
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _migrate_segment, table_name, kind, segment, segments, apply)
+                   for segment in range(segments)]
+        counts, failures = {}, []
+        for future in futures:
+            segment_counts, segment_failures = future.result()
+            for name, value in segment_counts.items():
+                counts[name] = counts.get(name, 0) + value
+            failures.extend(segment_failures)
+    return {"table": table_name, "counts": counts, "failures": failures}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoice-table")
+    parser.add_argument("--account-table")
+    parser.add_argument("--segments", type=int, default=8, help="parallel Scan segments per table (default 8)")
+    parser.add_argument("--output", help="file for the JSON report (default stdout)")
+    parser.add_argument("--apply", action="store_true", help="rewrite the items instead of only counting them")
+    options = parser.parse_args(argv)
+    if not (options.invoice_table or options.account_table):
+        parser.error("give --invoice-table, --account-table or both")
+    if options.apply and not audit.durable():
+        # The legacy maps are removed from the tables once recorded: only in a local file
+        # they would be lost with this machine
+        parser.error("--apply needs AUDIT_BUCKET, so the removed history is shipped to S3")
+
+    tables = [(name, kind) for name, kind in ((options.invoice_table, records.INVOICE), (options.account_table, records.ACCOUNT)) if name]
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        results = list(executor.map(lambda table: migrate_table(table[0], table[1], options.segments, options.apply), tables))
+    audit.store.close()
+
+    report = {"generated_at": str(datetime.now()), "applied": options.apply, "tables": results,
+              "audit_entries_dropped": audit.dropped_entries()}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    else:
+        json.dump(report, sys.stdout, indent=2, default=str)
+        print()
+    print(json.dumps({result["table"]: result["counts"] for result in results}), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
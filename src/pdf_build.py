@@ -0,0 +1,152 @@
+"""
+PDF building that needs nothing but PyPDF2 and reportlab: the annexure page and
+the master PDF.
+
+The async pipeline builds masters in spawned worker processes, and a spawned
+worker imports the module of every function it runs. Importing src.get_invoice or
+src.invoice_pdf there would create the PDF storage backend (with
+PDF_STORAGE=write_behind: replaying the pending-upload log and starting upload
+threads next to the parent's) and start the logging, tracing and audit threads
+in every worker. The functions the workers run live here instead, and this module
+must not import any other src module.
+"""
+
+import io
+import os
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+
+
+def create_annexure_pdf(annexure_data):
+    """Create an Annexure page with a table from the provided data."""
+    packet = io.BytesIO()
+    doc = SimpleDocTemplate(packet, pagesize=A4, topMargin=0.5*inch, bottomMargin=0.5*inch)
+    
+    elements = []
+    
+    # Add "Annexure" heading
+    styles = getSampleStyleSheet()
+    heading_style = ParagraphStyle(
+        'CustomHeading',
+        parent=styles['Heading1'],
+        fontSize=16,
+        textColor=colors.black,
+        spaceAfter=20,
+        alignment=1  # Center alignment
+    )
+    heading = Paragraph("Annexure", heading_style)
+    elements.append(heading)
+    elements.append(Spacer(1, 0.3*inch))
+    
+    # Check if annexure_data is a list of dicts
+    if not annexure_data or not isinstance(annexure_data, list):
+        packet.close()
+        return None
+    
+    # Extract table data
+    if len(annexure_data) > 0 and isinstance(annexure_data[0], dict):
+        # Define header display name mapping
+        header_display_names = {
+            "shipmentName": "Shipment Number",
+            "amount": "Amount",
+            "techFeeAmount": "Tech Fee Amount",
+            "orderSellerTechFee": "Tech Fee %",
+        }
+        
+        # Define the desired column order
+        column_order = ["shipmentName", "amount", "orderSellerTechFee", "techFeeAmount"]
+        
+        # Get headers from first dict keys
+        original_headers = list(annexure_data[0].keys())
+        
+        # Reorder headers according to column_order, keeping any extra columns at the end
+        headers = []
+        for col in column_order:
+            if col in original_headers:
+                headers.append(col)
+        # Add any remaining headers not in the predefined order
+        for col in original_headers:
+            if col not in headers:
+                headers.append(col)
+        
+        # Transform headers for display
+        display_headers = [header_display_names.get(header, header) for header in headers]
+        
+        # Create table data with display headers
+        table_data = [display_headers]
+        for row in annexure_data:
+            table_data.append([str(row.get(header, "")) for header in headers])
+        
+        # Calculate column widths based on content length
+        # col_widths = []
+        # for col_idx, header in enumerate(headers):
+        #     # Start with display header length
+        #     max_length = len(str(display_headers[col_idx]))
+        #     # Check all rows for this column
+        #     for row in annexure_data:
+        #         cell_value = str(row.get(header, ""))
+        #         max_length = max(max_length, len(cell_value))
+            
+        #     # Calculate width: minimum 1 inch, maximum 3 inches, scale by character count
+        #     # Approximate 0.08 inch per character
+        #     width = min(max(1*inch, max_length * 0.08*inch), 3*inch)
+        #     col_widths.append(width)
+        
+        # Create table
+        # table = Table(table_data, colWidths=col_widths)
+        table = Table(table_data, colWidths=[2*inch] * len(headers))
+        table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('FONTSIZE', (0, 1), (-1, -1), 10),
+            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey]),
+        ]))
+        
+        elements.append(table)
+    
+    # Build PDF
+    doc.build(elements)
+    packet.seek(0)
+    return PdfReader(packet).pages[0] if packet.getvalue() else None
+
+
+# Master PDF of an invoice: the Zoho PDF with the annexure page appended; returns (bytes, invoice page count)
+def build_master_pdf(zoho_pdf, annexure_page=None):
+    invoice_pages = len(PdfReader(io.BytesIO(zoho_pdf)).pages)
+    if annexure_page is None:
+        return zoho_pdf, invoice_pages
+    writer = PdfWriter()
+    writer.append_pages_from_reader(PdfReader(io.BytesIO(zoho_pdf)))
+    writer.add_page(annexure_page)
+    output_pdf = io.BytesIO()
+    writer.write(output_pdf)
+    return output_pdf.getvalue(), invoice_pages
+
+
+# Master PDF of an invoice from the Zoho PDF and the annexure rows, in a PDF worker process.
+# Returns (bytes, invoice page count, annexure page count, annexure error); a failed annexure
+# is left out and its error logged by the caller
+def build_master(zoho_pdf, annexure_data):
+    annexure_page = None
+    annexure_error = None
+    if annexure_data:
+        try:
+            annexure_page = create_annexure_pdf(annexure_data)
+        except Exception as e:
+            annexure_error = str(e)
+    pdf_content, invoice_pages = build_master_pdf(zoho_pdf, annexure_page)
+    return pdf_content, invoice_pages, 1 if annexure_page is not None else 0, annexure_error
+
+
+def warm_worker():
+    return os.getpid()
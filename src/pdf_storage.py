@@ -0,0 +1,328 @@
+"""
+Storage backends for invoice PDFs.
+
+Every backend stores objects by bucket and key with string metadata and offers
+`put`, `head` and `get`; `head` and `get` return None for a missing object. ETags
+are the quoted MD5 of the content for every backend, as S3 reports them for
+single-part uploads, so caches keyed by ETag work the same on all of them.
+
+    s3            objects are written to S3 while the request waits (default)
+    local         objects are files under PDF_STORAGE_DIR/<bucket>/<key>, with the
+                  metadata in a `.meta.json` file next to them; no AWS needed
+    write_behind  objects are written locally and the request returns at once; a
+                  background worker uploads them to S3 with retries. Every upload is
+                  recorded in a durable pending-upload log before `put` returns, and
+                  uploads not yet confirmed in the log are replayed on restart. A
+                  failing upload is retried with a capped backoff until it succeeds;
+                  reads serve the local copy until then.
+
+`ConcurrentUploader` writes many objects at once through one S3 client whose
+connection pool is sized to its worker count, for batch regeneration jobs.
+
+Configuration (environment variables):
+    PDF_STORAGE            s3, local or write_behind (default s3)
+    PDF_STORAGE_DIR        root directory of the local and write-behind backends
+                           (default /tmp/invoice-pdfs)
+    PDF_UPLOAD_LOG         pending-upload log of the write-behind backend
+                           (default <PDF_STORAGE_DIR>/pending-uploads.log)
+    PDF_UPLOAD_WORKERS     background upload threads (default 2)
+    PDF_UPLOAD_RETRIES     failed attempts of an upload logged as warnings before they are
+                           logged as errors (default 5)
+    PDF_UPLOAD_RETRY_MAX_SECONDS  longest wait between attempts of a failing upload (default 300)
+    PDF_UPLOAD_CONCURRENCY uploads in flight at once in batch jobs (default 16)
+    S3_MAX_POOL_CONNECTIONS  pooled HTTP connections of the S3 client (default 50)
+"""
+
+import contextvars
+import hashlib
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from src.dependencies import call_dependency, S3
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+STORAGE_BACKEND = os.environ.get("PDF_STORAGE", "s3")
+STORAGE_DIR = os.environ.get("PDF_STORAGE_DIR", "/tmp/invoice-pdfs")
+UPLOAD_LOG = os.environ.get("PDF_UPLOAD_LOG") or os.path.join(STORAGE_DIR, "pending-uploads.log")
+UPLOAD_WORKERS = int(os.environ.get("PDF_UPLOAD_WORKERS", "2"))
+UPLOAD_RETRIES = int(os.environ.get("PDF_UPLOAD_RETRIES", "5"))
+UPLOAD_RETRY_BACKOFF = 1.0
+UPLOAD_RETRY_MAX_BACKOFF = float(os.environ.get("PDF_UPLOAD_RETRY_MAX_SECONDS", "300"))
+UPLOAD_CONCURRENCY = int(os.environ.get("PDF_UPLOAD_CONCURRENCY", "16"))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "50"))
+
+
+def etag_of(content):
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+class S3Storage:
+    def __init__(self, client=None, max_pool_connections=S3_MAX_POOL_CONNECTIONS):
+        if client is None:
+            import boto3
+            from src.deadline import AWS_CLIENT_CONFIG
+            # boto3 clients are thread-safe; the pool bounds how many requests run in parallel
+            client = boto3.client("s3", config=AWS_CLIENT_CONFIG.merge(Config(max_pool_connections=max_pool_connections)))
+        self.client = client
+
+    def put(self, bucket_name, key, content, metadata):
+        call_dependency(S3, self.client.put_object,
+            Bucket=bucket_name,
+            Key=key,
+            Body=content,
+            ContentType="application/pdf",
+            Metadata=metadata
+        )
+
+    def head(self, bucket_name, key):
+        try:
+            head = call_dependency(S3, self.client.head_object, Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {"metadata": head.get("Metadata", {}), "etag": head["ETag"]}
+
+    def get(self, bucket_name, key):
+        try:
+            response = call_dependency(S3, self.client.get_object, Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {"body": response["Body"].read(), "metadata": response.get("Metadata", {}), "etag": response["ETag"]}
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket_name, key):
+        path = os.path.normpath(os.path.join(self.root, bucket_name, key))
+        # Keys come from invoice numbers; never let one escape the storage root
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def put(self, bucket_name, key, content, metadata):
+        path = self._path(bucket_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to temporary files first so readers never see a partial object
+        with open(path + ".meta.json.tmp", "w") as f:
+            json.dump(metadata, f)
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".meta.json.tmp", path + ".meta.json")
+        os.replace(path + ".tmp", path)
+
+    def head(self, bucket_name, key):
+        stored = self.get(bucket_name, key)
+        return None if stored is None else {"metadata": stored["metadata"], "etag": stored["etag"]}
+
+    def get(self, bucket_name, key):
+        path = self._path(bucket_name, key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            with open(path + ".meta.json") as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return None
+        return {"body": content, "metadata": metadata, "etag": etag_of(content)}
+
+    def delete(self, bucket_name, key):
+        path = self._path(bucket_name, key)
+        for name in (path, path + ".meta.json"):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+class WriteBehindStorage:
+    """Writes locally and uploads to the remote backend in the background."""
+
+    def __init__(self, local, remote, log_path, workers=2, retries=5):
+        self.local = local
+        self.remote = remote
+        self.log_path = log_path
+        self.retries = retries
+        self._log_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        # Uploads still pending per (bucket, key); the local copy is kept until it reaches 0
+        self._pending = {}
+        self._queue = queue.Queue()
+        # Failed uploads waiting for their next attempt, as a heap of (due, sequence, record)
+        self._retries = []
+        self._retry_sequence = 0
+        self._retry_ready = threading.Condition()
+        os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+        self._replay()
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+        threading.Thread(target=self._retry_loop, daemon=True, name="pdf-upload-retry").start()
+
+    def _append_log(self, record):
+        line = json.dumps(record) + "\n"
+        with self._log_lock:
+            with open(self.log_path, "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    # Re-queue uploads that were logged but never confirmed, and compact the log to them
+    def _replay(self):
+        pending = {}
+        try:
+            with open(self.log_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash while it was being written
+                        continue
+                    if record.get("op") == "put":
+                        pending[record["id"]] = record
+                    elif record.get("op") == "done":
+                        pending.pop(record["id"], None)
+        except FileNotFoundError:
+            pass
+
+        with open(self.log_path + ".tmp", "w") as f:
+            for record in pending.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.log_path + ".tmp", self.log_path)
+
+        if pending:
+            logger.info("Replaying pending PDF uploads", count=len(pending), log_path=self.log_path)
+        for record in pending.values():
+            self._mark_pending(record["bucket"], record["key"])
+            self._queue.put(record)
+
+    def _mark_pending(self, bucket_name, key):
+        with self._pending_lock:
+            self._pending[(bucket_name, key)] = self._pending.get((bucket_name, key), 0) + 1
+
+    def put(self, bucket_name, key, content, metadata):
+        # Marked pending before the local write, so a finishing upload of the same key keeps the file
+        self._mark_pending(bucket_name, key)
+        record = {"op": "put", "id": str(uuid.uuid4()), "bucket": bucket_name, "key": key}
+        try:
+            self.local.put(bucket_name, key, content, metadata)
+            self._append_log(record)
+        except Exception:
+            self._finish(record, False)
+            raise
+        self._queue.put(record)
+
+    def _upload(self, record):
+        # Upload what is stored locally now: a later put of the same key only makes this upload newer
+        stored = self.local.get(record["bucket"], record["key"])
+        if stored is not None:
+            self.remote.put(record["bucket"], record["key"], stored["body"], stored["metadata"])
+
+    def _worker(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self._upload(record)
+                self._append_log({"op": "done", "id": record["id"]})
+            except Exception as e:
+                self._retry_later(record, e)
+            else:
+                self._finish(record, True)
+            finally:
+                self._queue.task_done()
+
+    # Queue a failed upload again after a capped backoff. It stays pending, so reads keep
+    # serving the local copy, and stays in the log for a restart in the meantime
+    def _retry_later(self, record, error):
+        attempt = record.get("attempt", 0) + 1
+        delay = min(UPLOAD_RETRY_BACKOFF * (2 ** (attempt - 1)), UPLOAD_RETRY_MAX_BACKOFF)
+        log = logger.warning if attempt < self.retries else logger.error
+        log("PDF upload failed", key=record["key"], attempt=attempt, retry_in_seconds=delay, error=str(error))
+        with self._retry_ready:
+            self._retry_sequence += 1
+            heapq.heappush(self._retries, (time.monotonic() + delay, self._retry_sequence, dict(record, attempt=attempt)))
+            self._retry_ready.notify()
+
+    def _retry_loop(self):
+        while True:
+            with self._retry_ready:
+                while not self._retries or self._retries[0][0] > time.monotonic():
+                    self._retry_ready.wait(self._retries[0][0] - time.monotonic() if self._retries else None)
+                _, _, record = heapq.heappop(self._retries)
+            self._queue.put(record)
+
+    def _finish(self, record, uploaded):
+        object_key = (record["bucket"], record["key"])
+        with self._pending_lock:
+            self._pending[object_key] -= 1
+            if self._pending[object_key] > 0:
+                return
+            del self._pending[object_key]
+            # Uploaded: the remote copy is authoritative from here on. A put that failed
+            # before it was logged is never uploaded
+            if uploaded:
+                self.local.delete(record["bucket"], record["key"])
+
+    def head(self, bucket_name, key):
+        with self._pending_lock:
+            pending = (bucket_name, key) in self._pending
+            if pending:
+                stored = self.local.head(bucket_name, key)
+        return stored if pending else self.remote.head(bucket_name, key)
+
+    def get(self, bucket_name, key):
+        with self._pending_lock:
+            pending = (bucket_name, key) in self._pending
+            if pending:
+                stored = self.local.get(bucket_name, key)
+        return stored if pending else self.remote.get(bucket_name, key)
+
+    # Wait until every queued upload has been attempted once; failed ones wait for their retry
+    def flush(self):
+        self._queue.join()
+
+
+class ConcurrentUploader:
+    """Uploads many objects in parallel over a shared, pooled S3 client."""
+
+    def __init__(self, storage=None, workers=UPLOAD_CONCURRENCY):
+        self.storage = storage or S3Storage(max_pool_connections=max(workers, S3_MAX_POOL_CONNECTIONS))
+        self.workers = workers
+
+    def _put(self, bucket_name, key, content, metadata):
+        try:
+            self.storage.put(bucket_name, key, content, metadata)
+            return {"key": key, "error": None}
+        except Exception as e:
+            return {"key": key, "error": str(e)}
+
+    def upload_all(self, objects):
+        """Upload (bucket, key, content, metadata) tuples; returns {"key", "error"} per object, in order."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self._put, *obj) for obj in objects]
+            return [future.result() for future in futures]
+
+
+# Storage backend selected by PDF_STORAGE
+def create_storage(backend=STORAGE_BACKEND):
+    if backend == "s3":
+        return S3Storage()
+    if backend == "local":
+        return LocalStorage(STORAGE_DIR)
+    if backend == "write_behind":
+        return WriteBehindStorage(LocalStorage(STORAGE_DIR), S3Storage(), UPLOAD_LOG, UPLOAD_WORKERS, UPLOAD_RETRIES)
+    raise ValueError(f"Unknown PDF_STORAGE backend: {backend}")
@@ -0,0 +1,176 @@
+"""
+On-demand profiling of single events.
+
+An event is profiled when its request carries `X-Profile: <PROFILE_TOKEN>` or
+when it is picked by PROFILE_SAMPLE_RATE. handle_event then runs under cProfile
+and tracemalloc and writes two artifacts to PROFILE_DIR, named
+<action>-<invoice number>-<timestamp>:
+
+    .prof   the cProfile stats (pstats / snakeviz)
+    .json   wall time, the slowest functions by cumulative time, and the peak
+            traced memory with the lines that allocated the most
+
+GET /profiles lists the artifacts, newest first; GET /profiles/<name> returns the
+summary and GET /profiles/<name>.prof downloads the stats. They require the
+X-Profile header as well, so they are unavailable while PROFILE_TOKEN is unset.
+
+Only one event is profiled at a time (cProfile and tracemalloc are process-wide);
+an event asking while another is profiled simply runs unprofiled. cProfile sees
+the handler's own thread only: calls made from worker threads show up as the
+time spent waiting for them. Under the ASGI app the profile also contains the
+other events interleaved on the event loop. With no token and a sample rate of
+0 (the defaults) nothing is ever profiled and an event pays one header lookup.
+
+Configuration (environment variables):
+    PROFILE_TOKEN          X-Profile value that turns profiling on for a request (default unset: header ignored)
+    PROFILE_SAMPLE_RATE    fraction of events profiled without the header (default 0)
+    PROFILE_DIR            directory of the artifacts (default /tmp/profiles)
+    PROFILE_MAX_ARTIFACTS  profiles kept before the oldest are deleted (default 100)
+"""
+
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+MAX_ARTIFACTS = int(os.environ.get("PROFILE_MAX_ARTIFACTS", "100"))
+
+PROFILE_HEADER = "X-Profile"
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 20
+
+_ARTIFACT_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+_active = threading.Lock()
+
+
+# Whether the header value grants access to profiling
+def authorized(header_value):
+    return bool(PROFILE_TOKEN) and header_value is not None and hmac.compare_digest(header_value.encode(), PROFILE_TOKEN.encode())
+
+
+def _requested(header_value):
+    if header_value is not None and authorized(header_value):
+        return True
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def _safe(value):
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(value or "none"))[:64]
+
+
+# Profile the block when the request asks for it (or is sampled) and no other event is being profiled
+@contextmanager
+def profile(action, invoice_number, header_value=None):
+    if not _requested(header_value) or not _active.acquire(blocking=False):
+        yield
+        return
+    try:
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        start = time.monotonic()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            wall_time = time.monotonic() - start
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracemalloc:
+                tracemalloc.stop()
+            try:
+                _write_artifacts(action, invoice_number, profiler, wall_time, snapshot, peak)
+            except Exception as e:
+                logger.warning("Failed to write profile", action=action, invoice_number=invoice_number, error=str(e))
+    finally:
+        _active.release()
+
+
+def _write_artifacts(action, invoice_number, profiler, wall_time, snapshot, peak):
+    now = datetime.now(timezone.utc)
+    name = f"{_safe(action)}-{_safe(invoice_number)}-{now.strftime('%Y%m%dT%H%M%S%f')}"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name + ".prof"))
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+    allocations = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")[:TOP_ALLOCATIONS]
+    summary = {
+        "name": name,
+        "action": action,
+        "invoice_number": invoice_number,
+        "created_at": now.isoformat(timespec="seconds"),
+        "wall_time_seconds": round(wall_time, 4),
+        "peak_memory_bytes": peak,
+        "top_allocations": [{"location": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in allocations],
+        "top_functions": report.getvalue().splitlines(),
+    }
+    with open(os.path.join(PROFILE_DIR, name + ".json.tmp"), "w") as f:
+        json.dump(summary, f, indent=1)
+    os.replace(os.path.join(PROFILE_DIR, name + ".json.tmp"), os.path.join(PROFILE_DIR, name + ".json"))
+    logger.info("Profile written", profile=name, wall_time_seconds=summary["wall_time_seconds"], peak_memory_bytes=peak)
+    _prune()
+
+
+def _names():
+    try:
+        files = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    # Names end in their UTC timestamp
+    names = [f[:-len(".json")] for f in files if f.endswith(".json")]
+    return sorted(names, key=lambda n: n.rsplit("-", 1)[-1], reverse=True)
+
+
+def _prune():
+    for name in _names()[MAX_ARTIFACTS:]:
+        for suffix in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name + suffix))
+            except FileNotFoundError:
+                pass
+
+
+# Stored profiles, newest first
+def list_profiles():
+    profiles = []
+    for name in _names():
+        try:
+            with open(os.path.join(PROFILE_DIR, name + ".json")) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        profiles.append({key: summary.get(key) for key in ("name", "action", "invoice_number", "created_at", "wall_time_seconds", "peak_memory_bytes")})
+    return profiles
+
+
+# (content, content type) of a stored artifact, or None; `name` is <profile> or <profile>.prof
+def read_artifact(name):
+    if not _ARTIFACT_NAME.match(name) or name.startswith("."):
+        return None
+    path, content_type = (name, "application/octet-stream") if name.endswith(".prof") else (name + ".json", "application/json")
+    try:
+        with open(os.path.join(PROFILE_DIR, path), "rb") as f:
+            return f.read(), content_type
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,62 @@
+"""
+Token-bucket rate limiting of Zoho Books API calls per organization.
+
+Zoho Books allows a fixed number of API requests per minute for each
+organization. Bulk work (such as bulk account onboarding) takes a token from the
+organization's bucket before every request, so concurrent workers spread their
+calls over the minute instead of being rejected with HTTP 429.
+
+Configuration (environment variables):
+    ZOHO_RATE_LIMIT_PER_MINUTE   requests per minute allowed per organization (default 100)
+    ZOHO_RATE_LIMIT_BURST        requests that may be sent back to back (default 10)
+"""
+
+import os
+import threading
+import time
+
+RATE_PER_MINUTE = float(os.environ.get("ZOHO_RATE_LIMIT_PER_MINUTE", "100"))
+BURST = float(os.environ.get("ZOHO_RATE_LIMIT_BURST", "10"))
+
+
+class RateLimiter:
+    """Thread-safe token bucket refilled at `rate_per_minute`, holding at most `burst` tokens."""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(burst, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """Take one token, waiting up to `timeout` seconds (forever when None); returns False on timeout."""
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if give_up_at is not None and now + wait > give_up_at:
+                return False
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+# Rate limiter shared by every caller for a Zoho organization
+def zoho_limiter(org_id):
+    with _limiters_lock:
+        limiter = _limiters.get(org_id)
+        if limiter is None:
+            limiter = _limiters[org_id] = RateLimiter(RATE_PER_MINUTE, BURST)
+        return limiter
@@ -0,0 +1,420 @@
+"""
+Reconciliation of the DynamoDB invoice and account tables with Zoho Books.
+
+Finds the records a handler left incomplete: invoices created in Zoho whose
+DynamoDB insert failed, invoices without an Invoice_URL or with pending stages,
+invoices and accounts whose Salesforce event failed, and accounts whose Zoho
+contacts are missing. Prints a JSON drift report with one repair action per
+fixable problem, and runs the repairs with --apply.
+
+Both tables are read with a segmented parallel Scan (one thread and boto3
+session per segment) and the Zoho invoices and contacts list APIs are paged
+concurrently under the organization's rate limit. Only the attributes the join
+needs are kept, as tuples in dicts keyed by invoice number and contact id, so a
+few hundred thousand rows fit comfortably in memory.
+
+Usage (from the repository root):
+    python -m src.reconcile --invoice-table Invoices --account-table Accounts \\
+        --bucket invoice-bucket --invoice-url-prefix https://... --event-bus sf-bus \\
+        [--segments 8] [--concurrency 8] [--output report.json] [--apply]
+
+Configuration (environment variables, overridden by the matching options):
+    ZOHO_CLIENT_ID, ZOHO_CLIENT_SECRET, ZOHO_REFRESH_TOKEN, ZOHO_ORG_ID
+        Zoho Books credentials and organization
+"""
+
+import argparse
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import boto3
+from src.create_account import salesforce_account_entry
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, ZOHO, zoho_http, DYNAMODB, EVENTBRIDGE
+from src.get_invoice import get_invoice_function
+from src.invoice_pdf import locate_master, publish_invoice
+from src.rate_limit import zoho_limiter
+
+ZOHO_PAGE_SIZE = 200
+ZOHO_TOKEN_LIFETIME = 3000
+
+# Compact rows of the join: only what drift detection and the repairs need
+InvoiceRecord = namedtuple("InvoiceRecord", "zoho_id customer_id has_url salesforce invoice_date pending")
+ZohoInvoice = namedtuple("ZohoInvoice", "invoice_id customer_id invoice_date last_modified")
+AccountRecord = namedtuple("AccountRecord", "customer_id vendor_id account_type salesforce")
+
+INVOICE_ATTRIBUTES = ("Invoice_Number", "Zoho_Invoice_ID", "Customer_ID", "Invoice_URL", "Salesforce", "Invoice_Date", "Pending_Stages")
+ACCOUNT_ATTRIBUTES = ("Account_ID", "Zoho_Customer_ID", "Zoho_Vendor_ID", "Account_Type", "Salesforce")
+
+
+def _invoice_record(item):
+    return item["Invoice_Number"], InvoiceRecord(
+        item.get("Zoho_Invoice_ID"), item.get("Customer_ID"), bool(item.get("Invoice_URL")),
+        item.get("Salesforce"), item.get("Invoice_Date"), item.get("Pending_Stages") or None)
+
+
+def _account_record(item):
+    return item["Account_ID"], AccountRecord(
+        item.get("Zoho_Customer_ID") or None, item.get("Zoho_Vendor_ID") or None,
+        item.get("Account_Type"), item.get("Salesforce"))
+
+
+def _scan_segment(table_name, attributes, to_record, segment, total_segments):
+    # boto3 resources are not thread-safe, every segment gets its own session
+    table = boto3.session.Session().resource("dynamodb", config=AWS_CLIENT_CONFIG).Table(table_name)
+    names = {f"#a{i}": name for i, name in enumerate(attributes)}
+    kwargs = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names
+    }
+    records = {}
+    while True:
+        response = call_dependency(DYNAMODB, table.scan, **kwargs)
+        for item in response.get("Items", []):
+            key, record = to_record(item)
+            records[key] = record
+        if "LastEvaluatedKey" not in response:
+            return records
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+# Every record of a table as {key: compact record}, read with a parallel segmented Scan
+def scan_table(table_name, attributes, to_record, segments):
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _scan_segment, table_name, attributes, to_record, segment, segments)
+                   for segment in range(segments)]
+        records = {}
+        for future in futures:
+            records.update(future.result())
+    return records
+
+
+class ZohoClient:
+    """Zoho Books list APIs of one organization, with a refreshed token and the shared rate limit."""
+
+    def __init__(self, client_id, client_secret, refresh_token, org_id):
+        self.credentials = {"client_id": client_id, "client_secret": client_secret, "refresh_token": refresh_token}
+        self.org_id = org_id
+        self.limiter = zoho_limiter(org_id)
+        self._token = None
+        self._token_time = 0
+        self._token_lock = threading.Lock()
+
+    def token(self):
+        # Zoho access tokens live for an hour; a full run over a large organization can take longer
+        with self._token_lock:
+            return self._refresh_token()
+
+    def _refresh_token(self):
+        if self._token is None or time.monotonic() - self._token_time > ZOHO_TOKEN_LIFETIME:
+            data = dict(self.credentials, redirect_uri="http://www.zoho.in/books", grant_type="refresh_token")
+            self.limiter.acquire()
+            response = call_dependency(ZOHO, zoho_http.post, "https://accounts.zoho.in/oauth/v2/token", data=data)
+            access_token = response.json().get("access_token") if response.status_code == 200 else None
+            if not access_token:
+                raise RuntimeError(f"Zoho token generation failed: {response.text}")
+            self._token, self._token_time = access_token, time.monotonic()
+        return self._token
+
+    def _page(self, resource, page):
+        self.limiter.acquire()
+        response = call_dependency(ZOHO, zoho_http.get, f"https://www.zohoapis.in/books/v3/{resource}",
+            params={"organization_id": self.org_id, "page": page, "per_page": ZOHO_PAGE_SIZE},
+            headers={"Authorization": f"Zoho-oauthtoken {self.token()}"})
+        if response.status_code != 200:
+            raise RuntimeError(f"Zoho {resource} page {page} failed: {response.text}")
+        body = response.json()
+        return body.get(resource, []), body.get("page_context", {}).get("has_more_page", False)
+
+    def list_all(self, resource, concurrency):
+        """Every row of a Zoho list API, fetched `concurrency` pages at a time."""
+        rows = []
+        page = 1
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                futures = [executor.submit(contextvars.copy_context().run, self._page, resource, page + i) for i in range(concurrency)]
+                more = True
+                for future in futures:
+                    page_rows, has_more = future.result()
+                    rows.extend(page_rows)
+                    more = more and has_more and bool(page_rows)
+                if not more:
+                    return rows
+                page += concurrency
+
+
+def find_drift(invoices, zoho_invoices, accounts, zoho_contact_ids):
+    """Compare both sides; returns (drift, repairs)."""
+    drift = {
+        "invoices_missing_in_dynamodb": [],
+        "invoices_missing_zoho_id": [],
+        "invoices_zoho_id_mismatch": [],
+        "invoices_missing_in_zoho": [],
+        "invoices_missing_url": [],
+        "invoices_pending_stages": [],
+        "invoices_salesforce_failed": [],
+        "accounts_missing_customer_id": [],
+        "accounts_missing_vendor_id": [],
+        "accounts_contact_missing_in_zoho": [],
+        "accounts_salesforce_failed": [],
+        "zoho_contacts_without_account": []
+    }
+    repairs = []
+
+    zoho_invoice_ids = {zoho.invoice_id for zoho in zoho_invoices.values()}
+    for invoice_number, zoho in zoho_invoices.items():
+        if invoice_number not in invoices:
+            # Created in Zoho, but the DynamoDB insert failed
+            drift["invoices_missing_in_dynamodb"].append(invoice_number)
+            repairs.append({"action": "restore_invoice_record", "invoice_number": invoice_number, "zoho_invoice_id": zoho.invoice_id,
+                            "customer_id": zoho.customer_id, "invoice_date": zoho.invoice_date})
+
+    for invoice_number, record in invoices.items():
+        zoho = zoho_invoices.get(invoice_number)
+        zoho_id = record.zoho_id
+        if zoho is None:
+            # Failed Zoho creations are stored without an id and have nothing to repair
+            if zoho_id and zoho_id not in zoho_invoice_ids:
+                drift["invoices_missing_in_zoho"].append(invoice_number)
+            continue
+        if not zoho_id:
+            drift["invoices_missing_zoho_id"].append(invoice_number)
+            repairs.append({"action": "set_zoho_invoice_id", "invoice_number": invoice_number, "zoho_invoice_id": zoho.invoice_id})
+            zoho_id = zoho.invoice_id
+        elif zoho_id != zoho.invoice_id:
+            drift["invoices_zoho_id_mismatch"].append({"invoice_number": invoice_number, "dynamodb": zoho_id, "zoho": zoho.invoice_id})
+            continue
+
+        stage = (record.pending or {}).get("Invoice_PDF")
+        if stage:
+            drift["invoices_pending_stages"].append(invoice_number)
+        elif not record.has_url:
+            drift["invoices_missing_url"].append(invoice_number)
+        if stage or not record.has_url:
+            repairs.append({"action": "regenerate_pdf", "invoice_number": invoice_number, "zoho_invoice_id": zoho_id,
+                            "invoice_date": record.invoice_date or zoho.invoice_date, "zoho_last_modified": zoho.last_modified,
+                            "copies": (stage or {}).get("copies"), "sf_invoice_id": (stage or {}).get("sf_invoice_id"),
+                            "force": bool((stage or {}).get("force"))})
+        if record.salesforce == "Failed":
+            drift["invoices_salesforce_failed"].append(invoice_number)
+            repairs.append({"action": "republish_invoice", "invoice_number": invoice_number, "zoho_invoice_id": zoho_id,
+                            "invoice_date": record.invoice_date or zoho.invoice_date, "sf_invoice_id": (stage or {}).get("sf_invoice_id")})
+
+    linked_contacts = set()
+    for account_id, record in accounts.items():
+        linked_contacts.update(contact_id for contact_id in (record.customer_id, record.vendor_id) if contact_id)
+        if not record.customer_id:
+            drift["accounts_missing_customer_id"].append(account_id)
+            continue
+        if record.account_type == "Seller" and not record.vendor_id:
+            drift["accounts_missing_vendor_id"].append(account_id)
+        missing = [contact_id for contact_id in (record.customer_id, record.vendor_id) if contact_id and contact_id not in zoho_contact_ids]
+        if missing:
+            drift["accounts_contact_missing_in_zoho"].append({"account_id": account_id, "contact_ids": missing})
+        elif record.salesforce == "Failed":
+            drift["accounts_salesforce_failed"].append(account_id)
+            repairs.append({"action": "republish_account", "account_id": account_id, "zoho_customer_id": record.customer_id,
+                            "zoho_vendor_id": record.vendor_id})
+    drift["zoho_contacts_without_account"] = sorted(zoho_contact_ids - linked_contacts)
+
+    return drift, repairs
+
+
+class Repairer:
+    """Runs repair actions; every method returns the updated fields or raises."""
+
+    def __init__(self, options, zoho):
+        self.options = options
+        self.zoho = zoho
+        self.dynamodb = boto3.resource("dynamodb", config=AWS_CLIENT_CONFIG)
+        self.eventbridge = boto3.client("events", config=AWS_CLIENT_CONFIG)
+        self.invoice_table = self.dynamodb.Table(options.invoice_table)
+        self.account_table = self.dynamodb.Table(options.account_table)
+
+    def _stored_url(self, invoice_number, invoice_date):
+        if not self.options.bucket:
+            return None, {}
+        key, metadata = locate_master(self.options.bucket, invoice_number, invoice_date)
+        if key is None:
+            return None, {}
+        return publish_invoice(self.options.bucket, self.options.invoice_url_prefix, invoice_number, metadata.get("copies", "1"),
+                               metadata.get("invoice-date"), metadata.get("sf-invoice-id")), metadata
+
+    def restore_invoice_record(self, repair):
+        url, _ = self._stored_url(repair["invoice_number"], repair["invoice_date"])
+        item = {
+            "Invoice_Number": repair["invoice_number"],
+            "Customer_ID": repair["customer_id"],
+            "Zoho_Invoice_ID": repair["zoho_invoice_id"],
+            "Invoice_Date": repair["invoice_date"],
+            "Invoice_URL": url,
+            "Reconciled_At": int(time.time())
+        }
+        if url is None:
+            # Left for the PDF repair of the next run
+            item["Pending_Stages"] = {"Invoice_PDF": {"invoice_number": repair["invoice_number"], "sf_invoice_id": None,
+                                                      "invoice_id": repair["zoho_invoice_id"], "copies": None, "invoice_date": repair["invoice_date"]}}
+        # A handler may have written the record since the scan
+        call_dependency(DYNAMODB, self.invoice_table.put_item, Item=item, ConditionExpression="attribute_not_exists(Invoice_Number)")
+        return {"Invoice_URL": url}
+
+    def set_zoho_invoice_id(self, repair):
+        call_dependency(DYNAMODB, self.invoice_table.update_item, Key={"Invoice_Number": repair["invoice_number"]},
+            UpdateExpression="SET Zoho_Invoice_ID = :id, Reconciled_At = :now",
+            ExpressionAttributeValues={":id": repair["zoho_invoice_id"], ":now": int(time.time())})
+        return {"Zoho_Invoice_ID": repair["zoho_invoice_id"]}
+
+    def regenerate_pdf(self, repair):
+        get_event = dict(self.zoho.credentials,
+            org_id=self.zoho.org_id,
+            invoice_number=repair["invoice_number"],
+            invoice_id=repair["zoho_invoice_id"],
+            sf_invoice_id=repair["sf_invoice_id"],
+            bucket_name=self.options.bucket,
+            invoice_url_prefix=self.options.invoice_url_prefix,
+            copies=repair["copies"] or 1,
+            zoho_last_modified=repair["zoho_last_modified"],
+            invoice_date=repair["invoice_date"],
+            force=repair["force"])
+        # A master already in S3 only needs its URL written back
+        self.zoho.limiter.acquire()
+        body, status_code = get_invoice_function(get_event, read_through=True)
+        if status_code != 200:
+            raise RuntimeError(body.get("error"))
+        call_dependency(DYNAMODB, self.invoice_table.update_item, Key={"Invoice_Number": repair["invoice_number"]},
+            UpdateExpression="SET Invoice_URL = :url, Reconciled_At = :now REMOVE Pending_Stages",
+            ExpressionAttributeValues={":url": body["s3_location"], ":now": int(time.time())})
+        return {"Invoice_URL": body["s3_location"]}
+
+    def republish_invoice(self, repair, url=None):
+        sf_invoice_id = repair["sf_invoice_id"]
+        if url is None or not sf_invoice_id:
+            stored_url, metadata = self._stored_url(repair["invoice_number"], repair["invoice_date"])
+            url = url or stored_url
+            sf_invoice_id = sf_invoice_id or metadata.get("sf-invoice-id")
+        if not sf_invoice_id:
+            raise RuntimeError("Salesforce invoice id unknown, no pending stage or stored PDF records it")
+        salesforce_payload = {
+            "Status__c": "Zoho_Invoice_Created",
+            "ZohoInvoiceId__c": repair["zoho_invoice_id"],
+            "InvoiceURL__c": url,
+            "SFInvoiceRecordId__c": sf_invoice_id
+        }
+        self._publish({"Source": "zoho-invoice", "DetailType": "zoho-invoice", "Detail": json.dumps(salesforce_payload),
+                       "EventBusName": self.options.event_bus})
+        call_dependency(DYNAMODB, self.invoice_table.update_item, Key={"Invoice_Number": repair["invoice_number"]},
+            UpdateExpression="SET Salesforce = :published, Reconciled_At = :now",
+            ExpressionAttributeValues={":published": "Published", ":now": int(time.time())})
+        return {"Salesforce": "Published"}
+
+    def republish_account(self, repair):
+        self._publish(salesforce_account_entry(self.options.event_bus, repair["account_id"], repair["zoho_customer_id"], repair["zoho_vendor_id"]))
+        call_dependency(DYNAMODB, self.account_table.update_item, Key={"Account_ID": repair["account_id"]},
+            UpdateExpression="SET Salesforce = :published, Reconciled_At = :now",
+            ExpressionAttributeValues={":published": "Published", ":now": int(time.time())})
+        return {"Salesforce": "Published"}
+
+    def _publish(self, entry):
+        response = call_dependency(EVENTBRIDGE, self.eventbridge.put_events, Entries=[entry])
+        if response.get("FailedEntryCount"):
+            result = response["Entries"][0]
+            raise RuntimeError(result.get("ErrorMessage") or result.get("ErrorCode"))
+
+    # Repairs of one record run in order, so a republished invoice carries its regenerated URL
+    def run_group(self, group):
+        url = None
+        for repair in group:
+            try:
+                if repair["action"] == "republish_invoice":
+                    repair["result"] = self.republish_invoice(repair, url)
+                else:
+                    repair["result"] = getattr(self, repair["action"])(repair)
+                    url = repair["result"].get("Invoice_URL") or url
+                repair["status"] = "Repaired"
+            except Exception as e:
+                repair["status"] = "Failed"
+                repair["error"] = str(e)
+
+    def run(self, repairs, concurrency):
+        groups = {}
+        for repair in repairs:
+            groups.setdefault(repair.get("invoice_number") or repair.get("account_id"), []).append(repair)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self.run_group, group) for group in groups.values()]
+            for future in futures:
+                future.result()
+
+
+def reconcile(options):
+    zoho = ZohoClient(options.client_id, options.client_secret, options.refresh_token, options.org_id)
+
+    # Both tables and both Zoho lists are read at the same time
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        invoices_future = executor.submit(scan_table, options.invoice_table, INVOICE_ATTRIBUTES, _invoice_record, options.segments)
+        accounts_future = executor.submit(scan_table, options.account_table, ACCOUNT_ATTRIBUTES, _account_record, options.segments)
+        zoho_invoices_future = executor.submit(zoho.list_all, "invoices", options.concurrency)
+        contacts_future = executor.submit(zoho.list_all, "contacts", options.concurrency)
+        invoices = invoices_future.result()
+        accounts = accounts_future.result()
+        zoho_invoices = {row["invoice_number"]: ZohoInvoice(row["invoice_id"], row.get("customer_id"), row.get("date"), row.get("last_modified_time"))
+                         for row in zoho_invoices_future.result()}
+        zoho_contact_ids = {row["contact_id"] for row in contacts_future.result()}
+
+    drift, repairs = find_drift(invoices, zoho_invoices, accounts, zoho_contact_ids)
+    if options.apply:
+        Repairer(options, zoho).run(repairs, options.concurrency)
+
+    return {
+        "generated_at": str(datetime.now()),
+        "scanned": {"dynamodb_invoices": len(invoices), "dynamodb_accounts": len(accounts),
+                    "zoho_invoices": len(zoho_invoices), "zoho_contacts": len(zoho_contact_ids)},
+        "counts": {name: len(entries) for name, entries in drift.items()},
+        "drift": drift,
+        "repairs": repairs,
+        "applied": options.apply
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoice-table", required=True)
+    parser.add_argument("--account-table", required=True)
+    parser.add_argument("--client-id", default=os.environ.get("ZOHO_CLIENT_ID"))
+    parser.add_argument("--client-secret", default=os.environ.get("ZOHO_CLIENT_SECRET"))
+    parser.add_argument("--refresh-token", default=os.environ.get("ZOHO_REFRESH_TOKEN"))
+    parser.add_argument("--org-id", default=os.environ.get("ZOHO_ORG_ID"))
+    parser.add_argument("--bucket", help="invoice PDF bucket, needed to repair PDFs")
+    parser.add_argument("--invoice-url-prefix", help="prefix of the stored Invoice_URL values")
+    parser.add_argument("--event-bus", help="EventBridge bus of the Salesforce events, needed to republish")
+    parser.add_argument("--segments", type=int, default=8, help="parallel Scan segments per table (default 8)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Zoho pages and repairs in flight at once (default 8)")
+    parser.add_argument("--output", help="file for the JSON report (default stdout)")
+    parser.add_argument("--apply", action="store_true", help="run the repair actions instead of only listing them")
+    options = parser.parse_args(argv)
+
+    missing = [name for name in ("client_id", "client_secret", "refresh_token", "org_id") if not getattr(options, name)]
+    if missing:
+        parser.error("missing Zoho credentials: " + ", ".join(missing))
+    if options.apply and not (options.bucket and options.event_bus):
+        parser.error("--apply needs --bucket and --event-bus")
+
+    report = reconcile(options)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    else:
+        json.dump(report, sys.stdout, indent=2, default=str)
+        print()
+    print(json.dumps(report["counts"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
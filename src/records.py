@@ -0,0 +1,124 @@
+"""
+Compact schema of the invoice and account table items.
+
+Items keep only the fields lookups, reconciliation and status checks read:
+
+    invoice  Invoice_Number, Customer_ID, Zoho_Invoice_ID, Invoice_Date, Invoice_URL,
+             Salesforce, Pending_Stages, Billing_Address_Hash, Shipping_Address_Hash,
+             Zoho_Status, PDF_Status, Billing_Status, Shipping_Status, Updated_At,
+             Reconciled_At
+    account  Account_ID, Company_Name, Account_Type, Zoho_Customer_ID, Zoho_Vendor_ID,
+             Salesforce, Customer_Status, Vendor_Status, Updated_At, Reconciled_At
+
+The *_Status fields are the HTTP status of the last Zoho call of that kind (a
+skipped call leaves the previous one); Updated_At and Reconciled_At (written by
+src/reconcile.py) are epoch seconds. The handlers still describe their calls
+with the nested response maps (Create_Invoice, Update_Address_Response,
+Update_Invoice, Customer_API_Response, Vendor_API_Response) and string
+timestamps; `compact_invoice`/`compact_account`
+turn such an item into the compact one and send the maps to the audit store
+(src/audit.py). `python -m src.migrate_records` does the same for the items
+already in the tables. The compact schema needs a durable audit store
+(AUDIT_BUCKET): until there is one the items are written in the legacy shape,
+unchanged.
+"""
+
+import time
+from datetime import datetime
+from src import audit
+
+INVOICE = "invoice"
+ACCOUNT = "account"
+
+# Legacy string timestamps, replaced by Updated_At
+TIMESTAMP_FIELDS = ("Created_At", "Last_Updated_Timestamp")
+
+
+def _status(response):
+    if not isinstance(response, dict) or response.get("API_Status") is None:
+        return None
+    return int(response["API_Status"])
+
+
+# Compact status fields of each legacy map, in the order the calls happen
+INVOICE_LEGACY_FIELDS = {
+    "Create_Invoice": lambda value: {
+        "Zoho_Status": _status(value.get("CREATE_Invoice_Response")),
+        "PDF_Status": _status(value.get("GET_Invoice_Response")),
+    },
+    "Update_Invoice": lambda value: {
+        "Shipping_Status": _status(value.get("Update_Invoice_Shipping_Response")),
+        "PDF_Status": _status(value.get("GET_Invoice_Response")),
+    },
+    "Update_Address_Response": lambda value: {
+        "Billing_Status": _status(value.get("Billing_Address_Update_Response")),
+        "Shipping_Status": _status(value.get("Shipping_Address_Update_Response")),
+        "PDF_Status": _status(value.get("Get_Invoice_Response")),
+    },
+}
+
+ACCOUNT_LEGACY_FIELDS = {
+    "Customer_API_Response": lambda value: {"Customer_Status": int(value["Customer_API"]) if value.get("Customer_API") is not None else None},
+    "Vendor_API_Response": lambda value: {"Vendor_Status": int(value["Vendor_API"]) if value.get("Vendor_API") is not None else None},
+}
+
+LEGACY_FIELDS = {INVOICE: INVOICE_LEGACY_FIELDS, ACCOUNT: ACCOUNT_LEGACY_FIELDS}
+KEY_FIELDS = {INVOICE: "Invoice_Number", ACCOUNT: "Account_ID"}
+
+
+def _epoch(timestamp):
+    try:
+        return int(datetime.fromisoformat(str(timestamp)).timestamp())
+    except ValueError:
+        return None
+
+
+# Epoch seconds of the latest timestamp in the legacy fields (top level or inside the maps)
+def _latest(history):
+    times = []
+    for field, value in history.items():
+        if isinstance(value, dict):
+            times.append(_latest(value))
+        elif "timestamp" in field.lower() or field in TIMESTAMP_FIELDS:
+            times.append(_epoch(value))
+    return max(filter(None, times), default=None)
+
+
+def legacy_fields(table, item):
+    return [field for field in tuple(LEGACY_FIELDS[table]) + TIMESTAMP_FIELDS if field in item]
+
+
+# (compact item, legacy fields) of `item`. Updated_At is now, or for a migrated item
+# the time of its latest legacy timestamp
+def split(table, item, migrating=False):
+    history = {field: item[field] for field in legacy_fields(table, item)}
+    compacted = {field: value for field, value in item.items() if field not in history}
+    for field, statuses in LEGACY_FIELDS[table].items():
+        if isinstance(item.get(field), dict):
+            # A call that did not happen (a skipped PDF stage) leaves the stored status alone
+            compacted.update((k, v) for k, v in statuses(item[field]).items() if v is not None)
+
+    if migrating:
+        # An item a handler has updated since the schema change has a newer Updated_At already
+        compacted["Updated_At"] = max(filter(None, (item.get("Updated_At"), _latest(history))), default=None) or int(time.time())
+    else:
+        compacted["Updated_At"] = int(time.time())
+    return compacted, history
+
+
+# `item` with its legacy maps replaced by status fields; the maps go to the audit store
+def compact(table, item):
+    if not audit.durable():
+        # Only on this host's disk the maps would be lost on the next deploy: keep the legacy item
+        return item
+    compacted, history = split(table, item)
+    audit.record(table, item.get(KEY_FIELDS[table]), history)
+    return compacted
+
+
+def compact_invoice(item):
+    return compact(INVOICE, item)
+
+
+def compact_account(item):
+    return compact(ACCOUNT, item)
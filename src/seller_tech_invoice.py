@@ -1,27 +1,54 @@
-import requests
-from src.get_invoice import get_invoice_function
+from src.get_invoice import get_invoice_function, pdf_stage_event, pdf_stage_fits, skipped_pdf_stage, record_pdf_stage
+from src.create_invoice import invoice_created_entry
 import boto3
-import json
 from datetime import datetime
 from src.email import send_failure_email
+from src.event_model import parse_event
+from src import deadline, taxes
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, ZOHO, zoho_http, DYNAMODB, EVENTBRIDGE
+from src.records import compact_invoice
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+dynamodb = boto3.resource('dynamodb', config=AWS_CLIENT_CONFIG)
+eventbridge = boto3.client('events', config=AWS_CLIENT_CONFIG)
+
+# Zoho Books payload of the invoice of a Seller Technology Fee event
+def build_invoice_payload(event, model):
+    payload_model = model.payload
+    account = payload_model.account
+    payload = {
+        "invoice_number" : event.get("InvoiceNumber__c"),
+        "customer_id": account.zoho_account_id,
+        "template_id": event.get("seller_tech_invoice_template_id"),
+        "terms": event.get("seller_tech_terms"),
+        "notes": event.get("seller_tech_notes")
+    }
 
-dynamodb = boto3.resource('dynamodb')
-eventbridge = boto3.client('events')
+    #  Set line item details
+    zoho_line_items = [{}] * 1
+    zoho_item = {
+        "rate": payload_model.invoice.tech_fee_amount,
+        "quantity": 1,
+        "name": event.get("Product_Details__c")
+    }
 
-tax_map = {
-    "18.00" : "1743550000000023299",
-    "5.00" : "1743550000000023295",
-    "0.00" : "1743550000000023293",
-    "40.00" : "1743550000000901046"
-}
+    # Set line item details based on product flag
+    if event.get("prod_flag") == "1":
+        if event.get("TechFeeHSN"):
+            zoho_item["hsn_or_sac"] = event.get("seller_tech_hsn")
+        if event.get("TechFeeGST"):
+            zoho_item["tax_id"] = taxes.tax_id(event, float(event.get("seller_tech_gst", 18.0)))
+    zoho_line_items[0] = zoho_item
+    
+    payload["line_items"] = zoho_line_items
 
-def tax_id(val):
-    formatted = f"{val:.2f}"
-    tax_id_map = tax_map[formatted]
-    return tax_id_map
+    return payload
 
 # Seller Technology Fee invoice creation function
-def seller_tech_invoice_function(event):
+def seller_tech_invoice_function(event, model=None):
     client_id = event.get("client_id")
     client_secret = event.get("client_secret")
     refresh_token = event.get("refresh_token")
@@ -35,22 +62,26 @@ def seller_tech_invoice_function(event):
     if not all([client_id, client_secret, refresh_token, org_id]):
         return {"error": "Missing required fields: client_id, client_secret, refresh_token, org_id"}
 
-    inside_payload = json.loads(event.get("Payload__c"))
+    # Parse the payload from the event, unless the caller already did
+    if model is None:
+        model = parse_event("Seller_Technology_Fee", event)
+    payload_model = model.payload
+    account = payload_model.account
     invoice_number = event.get("InvoiceNumber__c")
 
     # Check for Overseas GST Treatment
-    if event.get("overseas_flag") == "0" and inside_payload.get("account").get("GSTTreatment") == "Overseas":
+    if event.get("overseas_flag") == "0" and account.gst_treatment == "Overseas":
         send_failure_email("Invalid GST Treatment for Seller Tech Invoice", f"Cannot create invoice for Overseas GST Treatment when overseas_flag is 0 for Invoice_Number {invoice_number}.", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
         return {"error": "Cannot create invoice for Overseas GST Treatment when overseas_flag is 0"}
 
     # Prepare DynamoDB payload
     dynamodb_payload = {
         "Invoice_Number": event.get("InvoiceNumber__c"),
-        "Customer_ID": inside_payload.get("account").get("zohoAccountId"),
+        "Customer_ID": account.zoho_account_id,
     }
 
     # Check for duplicate invoice
-    if 'Item' in table.get_item(Key={'Invoice_Number': event.get("InvoiceNumber__c")}):
+    if 'Item' in call_dependency(DYNAMODB, table.get_item, Key={'Invoice_Number': event.get("InvoiceNumber__c")}):
         send_failure_email("Duplicate Invoice Creation Attempt", f"Invoice with Invoice_Number {invoice_number} already exists in Zoho for seller tech, and Salesforce is sending playload with null Zoho invoice ID.", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
         return {"error": "Invoice with this Invoice_Number already exists in Zoho, and Salesforce is sending playload with null Zoho invoice ID."}
     
@@ -64,7 +95,7 @@ def seller_tech_invoice_function(event):
         "grant_type": "refresh_token"
     }
     
-    token_response = requests.post(generate_access_token_url, data=data)
+    token_response = call_dependency(ZOHO, zoho_http.post, generate_access_token_url, data=data)
     # print("Zoho token response:", token_response.text)
 
     # Handle token generation failure
@@ -82,33 +113,9 @@ def seller_tech_invoice_function(event):
     }
 
     # Prepare invoice payload
-    payload = {
-        "invoice_number" : event.get("InvoiceNumber__c"),
-        "customer_id": inside_payload.get("account").get("zohoAccountId"),
-        "template_id": event.get("seller_tech_invoice_template_id"),
-        "terms": event.get("seller_tech_terms"),
-        "notes": event.get("seller_tech_notes")
-    }
+    payload = build_invoice_payload(event, model)
 
-    #  Set line item details
-    zoho_line_items = [{}] * 1
-    zoho_item = {
-        "rate": inside_payload.get("invoice").get("techFeeAmount"),
-        "quantity": 1,
-        "name": event.get("Product_Details__c")
-    }
-
-    # Set line item details based on product flag
-    if event.get("prod_flag") == "1":
-        if event.get("TechFeeHSN"):
-            zoho_item["hsn_or_sac"] = event.get("seller_tech_hsn")
-        if event.get("TechFeeGST"):
-            zoho_item["tax_id"] = tax_id(float(event.get("seller_tech_gst", 18.0)))
-    zoho_line_items[0] = zoho_item
-    
-    payload["line_items"] = zoho_line_items
-
-    response = requests.post(create_invoice_url, headers=headers, json=payload)
+    response = call_dependency(ZOHO, zoho_http.post, create_invoice_url, headers=headers, json=payload)
     # print("Zoho create invoice response:", response.text)
     # print("Response status code:", response.status_code)
 
@@ -120,58 +127,27 @@ def seller_tech_invoice_function(event):
     
     # dynamodb_payload["CREATE_Invoice_Response"] = create_invoice_response
     if response.status_code == 201:
-        resp_json = response.json()
-        invoice_id = resp_json.get("invoice", {}).get("invoice_id")
-        
-        dynamodb_payload["Zoho_Invoice_ID"] = invoice_id
-        # After creating invoice, call get_invoice_function to fetch PDF (and handle copies/upload)
-        # determine copies safely: account may be missing or have invoiceCopies=None
-        account_obj = inside_payload.get("account") or {}
-        copies_value = account_obj.get("invoiceCopies")
-        if copies_value is None:
-            copies_value = 1
-
-        # Prepare event for get_invoice_function
-        get_event = {
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "refresh_token": refresh_token,
-            "org_id": org_id,
-            "invoice_number": event.get("InvoiceNumber__c"),
-            "sf_invoice_id": inside_payload["invoice"]["invoiceId"],
-            "invoice_id": invoice_id,
-            "bucket_name": event.get("bucket_name"),
-            "invoice_url_prefix": event.get("invoice_url_prefix"),
-            "copies": copies_value,
-            "annexure_data": inside_payload.get("shipments", []),
-        }
-        # print(f"Calling get_invoice_function for invoice_id: {invoice_id}")
-        get_result = get_invoice_function(get_event)
-        body, status_code = get_result
+        # The invoice exists in Zoho now, the bookkeeping below must run to completion
+        deadline.commit()
+        invoice = response.json().get("invoice", {})
 
-        get_invoice_response = {
-            "API_Status": status_code,
-            "API_Timestamp" : str(datetime.now())
-        }
+        dynamodb_payload["Zoho_Invoice_ID"] = invoice.get("invoice_id")
+
+        # After creating invoice, call get_invoice_function to fetch PDF (and handle copies/upload)
+        get_event = pdf_stage_event(event, payload_model.invoice.sf_invoice_id, account.invoice_copies, invoice, payload_model.shipments)
+        body, status_code = get_invoice_function(get_event) if pdf_stage_fits() else skipped_pdf_stage()
 
-        # Handle get_invoice_function response 
-        if status_code == 200:
-            invoice_url = body.get("s3_location")
-        else:
+        # Handle get_invoice_function response
+        get_invoice_response, failed = record_pdf_stage(get_event, body, status_code, dynamodb_payload, cloudwatch_payload)
+        if failed:
             send_failure_email("Get TInvoice Function Failed", "Either Failed to get seller tech invoice of Id " + event.get("InvoiceNumber__c") + " or failed to store in S3. No Invoice URL on Salesforce. Error: "+ str(body.get("error")), event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
-            invoice_url = None
-            cloudwatch_payload["Get_Invoice_Error"] = body.get("error")
-            get_invoice_response["Error_Details"] = body.get("error")
-        
+
         # dynamodb_payload["GET_Invoice_Response"] = get_invoice_response
         final_api_response = {
             "CREATE_Invoice_Response": create_invoice_response,
             "GET_Invoice_Response": get_invoice_response
         }
         dynamodb_payload["Create_Invoice"] = final_api_response
-        
-        dynamodb_payload["Invoice_URL"] = invoice_url
-        # dynamodb_payload["API_Response"] = body
 
     else:
         dynamodb_payload["Zoho_Invoice_ID"] = None
@@ -181,32 +157,19 @@ def seller_tech_invoice_function(event):
     
     # Salesforce payload via EventBridge
     try:
-        salesforce_payload = {
-            "Status__c" : "Zoho_Invoice_Created",
-            "ZohoInvoiceId__c": dynamodb_payload["Zoho_Invoice_ID"],
-            "InvoiceURL__c": dynamodb_payload["Invoice_URL"],
-            "SFInvoiceRecordId__c" : inside_payload["invoice"]["invoiceId"]
-        }
-        eventbridge.put_events(
-            Entries=[
-                {
-                    "Source": "zoho-invoice",
-                    "DetailType": "zoho-invoice",
-                    "Detail": json.dumps(salesforce_payload),
-                    "EventBusName": event.get("event_bus_name")
-                }
-            ]
+        call_dependency(EVENTBRIDGE, eventbridge.put_events,
+            Entries=[invoice_created_entry(event, dynamodb_payload, payload_model.invoice.sf_invoice_id)]
         )
         dynamodb_payload["Salesforce"] = "Published"
     except Exception as e:
         send_failure_email("AWS Salesforce EventBridge Failed", f"Failed to send event to Salesforce via EventBridge for seller techinvoice: {event.get('InvoiceNumber__c')}. Error: {str(e)}", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
-        print(f"Warning: Failed to create Salesforce payload: {str(e)}")
+        logger.warning("Failed to publish Salesforce event", error=str(e))
         cloudwatch_payload["Salesforce_EventBridge_Error"] = str(e)
         dynamodb_payload["Salesforce"] = "Failed"
     
     # Store invoice details in DynamoDB
     try:
-        table.put_item(Item=dynamodb_payload)
+        call_dependency(DYNAMODB, table.put_item, Item=compact_invoice(dynamodb_payload))
         cloudwatch_payload["DynamoDB_Insertion"] = "Success"
         return cloudwatch_payload
     except Exception as e:
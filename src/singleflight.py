@@ -0,0 +1,245 @@
+"""
+Single-flight coalescing of concurrent duplicate events.
+
+Salesforce retries often deliver the same event again while the first delivery is
+still running. Events are keyed by action and business key (InvoiceNumber__c,
+RecordID__c, ...): while one event for a key is in flight, an identical duplicate
+waits for it and receives its result instead of repeating the Zoho, PDF and S3
+work. A different event for the same key (e.g. an address update arriving during
+the invoice create) waits for the in-flight one to finish and then runs itself.
+
+Optionally a DynamoDB lock table serialises the same keys across workers
+(containers). A worker that cannot get the lock within its wait budget rejects
+the event as a retryable duplicate.
+
+`do_async` coalesces the events of the async pipeline the same way, waiting on
+the event loop instead of blocking a thread.
+
+Configuration (environment variables):
+    SINGLEFLIGHT_LOCK_TABLE   DynamoDB table (partition key `Lock_Key`) for the
+                              cross-worker lock; unset disables it
+    SINGLEFLIGHT_LOCK_TTL     seconds after which an abandoned lock expires (default 120)
+"""
+
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import boto3
+from botocore.exceptions import ClientError
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, DYNAMODB
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+LOCK_TABLE = os.environ.get("SINGLEFLIGHT_LOCK_TABLE")
+LOCK_TTL = int(os.environ.get("SINGLEFLIGHT_LOCK_TTL", "120"))
+LOCK_POLL_INTERVAL = 0.25
+
+# Business key field per action
+ACTION_KEY_FIELDS = {
+    "CreateZohoAccount": "RecordID__c",
+    "Buyer": "InvoiceNumber__c",
+    "Seller_Technology_Fee": "InvoiceNumber__c",
+    "X1VP_Subscription": "InvoiceNumber__c",
+    "get_invoice": "invoice_number",
+}
+
+
+class DuplicateInFlight(Exception):
+    """Raised when a duplicate could not wait for the in-flight event to finish."""
+
+    def __init__(self, key, retry_after):
+        super().__init__(f"An event for {key} is already in progress")
+        self.key = key
+        self.retry_after = retry_after
+
+
+# Coalescing key for an event, or None when it has no business key
+def key_for(action, event):
+    field = ACTION_KEY_FIELDS.get(action)
+    value = event.get(field) if field else None
+    return f"{action}:{value}" if value else None
+
+
+# Hash identifying identical deliveries of the same event
+def fingerprint(event):
+    return hashlib.sha256(json.dumps(event, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _Call:
+    __slots__ = ("fingerprint", "done", "result", "error")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DynamoDBLock:
+    """Cross-worker lock on a key, held in a DynamoDB table with a TTL."""
+
+    def __init__(self, table_name, ttl):
+        self.table = boto3.resource("dynamodb", config=AWS_CLIENT_CONFIG).Table(table_name)
+        self.ttl = ttl
+        self.owner = str(uuid.uuid4())
+
+    def acquire(self, key):
+        now = int(time.time())
+        try:
+            call_dependency(DYNAMODB, self.table.put_item,
+                Item={"Lock_Key": key, "Owner": self.owner, "Expires_At": now + self.ttl},
+                ConditionExpression="attribute_not_exists(Lock_Key) OR Expires_At < :now",
+                ExpressionAttributeValues={":now": now}
+            )
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def release(self, key):
+        try:
+            call_dependency(DYNAMODB, self.table.delete_item,
+                Key={"Lock_Key": key},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "Owner"},
+                ExpressionAttributeValues={":owner": self.owner}
+            )
+        except Exception as e:
+            # The lock expires on its own through the TTL
+            logger.warning("Failed to release single-flight lock", key=key, error=str(e))
+
+
+class SingleFlight:
+    def __init__(self, lock=None):
+        self.lock = lock
+        self._mutex = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, event_fingerprint, fn, wait_timeout):
+        """Run fn() unless an identical event for `key` is in flight, then share its result."""
+        if key is None:
+            return fn()
+
+        give_up_at = time.monotonic() + wait_timeout
+        while True:
+            with self._mutex:
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = _Call(event_fingerprint)
+                    break
+
+            # Another event for this key is in flight: wait for it to finish
+            if not call.done.wait(max(give_up_at - time.monotonic(), 0)):
+                raise DuplicateInFlight(key, max(1, int(wait_timeout)))
+            if call.fingerprint == event_fingerprint:
+                if call.error is not None:
+                    raise call.error
+                return call.result
+
+        try:
+            call.result = self._run_locked(key, fn, give_up_at)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._mutex:
+                del self._calls[key]
+            call.done.set()
+
+    # Run fn() holding the cross-worker lock, when one is configured
+    def _run_locked(self, key, fn, give_up_at):
+        if self.lock is None:
+            return fn()
+        while not self.lock.acquire(key):
+            if time.monotonic() + LOCK_POLL_INTERVAL > give_up_at:
+                raise DuplicateInFlight(key, 1)
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            return fn()
+        finally:
+            self.lock.release(key)
+
+
+class _AsyncCall:
+    __slots__ = ("fingerprint", "done", "result", "error")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = asyncio.Event()
+        self.result = None
+        self.error = None
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines; every caller runs on the same event loop."""
+
+    def __init__(self, lock=None):
+        self.lock = lock
+        self._calls = {}
+
+    async def do(self, key, event_fingerprint, fn, wait_timeout):
+        """Await fn() unless an identical event for `key` is in flight, then share its result."""
+        if key is None:
+            return await fn()
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + wait_timeout
+        while True:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _AsyncCall(event_fingerprint)
+                break
+            # Another event for this key is in flight: wait for it to finish
+            try:
+                await asyncio.wait_for(call.done.wait(), max(give_up_at - loop.time(), 0))
+            except asyncio.TimeoutError:
+                raise DuplicateInFlight(key, max(1, int(wait_timeout)))
+            if call.fingerprint == event_fingerprint:
+                if call.error is not None:
+                    raise call.error
+                return call.result
+        try:
+            call.result = await self._run_locked(key, fn, give_up_at)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            del self._calls[key]
+            call.done.set()
+
+    async def _run_locked(self, key, fn, give_up_at):
+        if self.lock is None:
+            return await fn()
+        loop = asyncio.get_running_loop()
+        # The DynamoDB lock is synchronous, its calls run in the default executor
+        while not await loop.run_in_executor(None, contextvars.copy_context().run, self.lock.acquire, key):
+            if loop.time() + LOCK_POLL_INTERVAL > give_up_at:
+                raise DuplicateInFlight(key, 1)
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            return await fn()
+        finally:
+            await loop.run_in_executor(None, contextvars.copy_context().run, self.lock.release, key)
+
+
+_lock = DynamoDBLock(LOCK_TABLE, LOCK_TTL) if LOCK_TABLE else None
+coalescer = SingleFlight(_lock)
+async_coalescer = AsyncSingleFlight(_lock)
+
+
+def do(action, event, fn, wait_timeout):
+    return coalescer.do(key_for(action, event), fingerprint(event), fn, wait_timeout)
+
+
+# `fn` returns an awaitable
+async def do_async(action, event, fn, wait_timeout):
+    return await async_coalescer.do(key_for(action, event), fingerprint(event), fn, wait_timeout)
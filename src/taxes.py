@@ -0,0 +1,167 @@
+"""
+Zoho tax ids by GST rate.
+
+The invoice handlers used to map a GST rate to a Zoho tax id through a table
+hard-coded for one organization, in three modules, and failed with a KeyError on
+any other rate. `tax_id(event, rate)` looks the rate up in, in order:
+
+    1. the `tax_ids` of the event's tenant (src/tenants.py), to pin an id
+    2. the taxes of the event's organization, read from Zoho Books
+       (GET /settings/taxes) and cached per organization for TAX_TABLE_TTL_SECONDS
+    3. DEFAULT_TAX_IDS, only while the organization's taxes cannot be read
+
+A rate still unknown raises UnknownTaxRate, a 400 for the event. Before that the
+organization's taxes are read again (at most every TAX_RESYNC_SECONDS), so a tax
+just added in Zoho is found without waiting for the TTL. When an organization has
+several taxes of one rate (IGST18 and the GST18 group, say), the tenant's
+`tax_name_prefix` picks among them, then the one Zoho marks as default, then the
+first by name.
+
+Reading the taxes takes a Zoho token of its own, once per organization and TTL.
+The async pipeline calls `table_for` in its thread pool before building a
+payload, so the lookups it makes on the event loop never wait on Zoho.
+
+Configuration (environment variables):
+    TAX_TABLE_TTL_SECONDS  how long an organization's taxes are cached (default 3600)
+    TAX_RESYNC_SECONDS     shortest interval between reads of an organization's taxes (default 60)
+"""
+
+import os
+import threading
+import time
+from src import tenants
+from src.dependencies import call_dependency, ZOHO, zoho_http
+from src.event_model import EventValidationError
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+TABLE_TTL = float(os.environ.get("TAX_TABLE_TTL_SECONDS", "3600"))
+RESYNC_SECONDS = float(os.environ.get("TAX_RESYNC_SECONDS", "60"))
+
+TOKEN_URL = "https://accounts.zoho.in/oauth/v2/token"
+
+# Tax ids of the organization this service was first built for
+DEFAULT_TAX_IDS = {
+    "18.00": "1743550000000023299",
+    "5.00": "1743550000000023295",
+    "0.00": "1743550000000023293",
+    "40.00": "1743550000000901046",
+}
+
+
+class UnknownTaxRate(EventValidationError):
+    """Raised when no Zoho tax of an organization has the requested rate."""
+
+
+def _rate_key(rate):
+    return f"{float(rate):.2f}"
+
+
+# Rate -> tax id of one organization's Zoho taxes
+def _table(taxes, name_prefix=None):
+    by_rate = {}
+    for tax in taxes:
+        if tax.get("tax_percentage") is None or tax.get("status", "active") != "active":
+            continue
+        by_rate.setdefault(_rate_key(tax["tax_percentage"]), []).append(tax)
+    table = {}
+    for rate, candidates in by_rate.items():
+        if name_prefix:
+            candidates = [tax for tax in candidates if str(tax.get("tax_name", "")).startswith(name_prefix)] or candidates
+        candidates.sort(key=lambda tax: (not tax.get("is_default_tax"), str(tax.get("tax_name", ""))))
+        table[rate] = candidates[0]["tax_id"]
+    return table
+
+
+def _fetch(event):
+    token_response = call_dependency(ZOHO, zoho_http.post, TOKEN_URL, data={
+        "refresh_token": event.get("refresh_token"),
+        "client_id": event.get("client_id"),
+        "client_secret": event.get("client_secret"),
+        "redirect_uri": "http://www.zoho.in/books",
+        "grant_type": "refresh_token"
+    })
+    if token_response.status_code != 200:
+        raise RuntimeError(f"token request failed with {token_response.status_code}")
+    response = call_dependency(ZOHO, zoho_http.get, "https://www.zohoapis.in/books/v3/settings/taxes",
+        params={"organization_id": event.get("org_id")},
+        headers={"Authorization": f"Zoho-oauthtoken {token_response.json().get('access_token')}"})
+    if response.status_code != 200:
+        raise RuntimeError(f"taxes request failed with {response.status_code}")
+    return response.json().get("taxes", [])
+
+
+class TaxTables:
+    """Zoho tax tables per organization, read on first use and after the TTL."""
+
+    def __init__(self, ttl, resync_seconds):
+        self.ttl = ttl
+        self.resync_seconds = resync_seconds
+        self._tables = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _org_lock(self, org_id):
+        with self._lock:
+            return self._locks.setdefault(org_id, threading.Lock())
+
+    def _fresh(self, entry, max_age):
+        if entry is None:
+            return False
+        # A failed read is retried after resync_seconds, not on every event
+        return time.time() - entry[1] < (self.resync_seconds if entry[0] is None else max_age)
+
+    # (table, read at) of the organization, reading it when missing or older than `max_age`;
+    # table is None while the taxes cannot be read
+    def get(self, event, max_age=None):
+        org_id = event.get("org_id")
+        max_age = self.ttl if max_age is None else max_age
+        entry = self._tables.get(org_id)
+        if self._fresh(entry, max_age):
+            return entry
+        # One read per organization at a time; the others wait for it
+        with self._org_lock(org_id):
+            entry = self._tables.get(org_id)
+            if self._fresh(entry, max_age):
+                return entry
+            try:
+                table = _table(_fetch(event), tenants.tenant_config(event).get("tax_name_prefix"))
+                logger.info("Zoho taxes read", org_id=org_id, rates=sorted(table))
+            except Exception as e:
+                logger.warning("Failed to read Zoho taxes", org_id=org_id, error=str(e))
+                if entry is not None and entry[0] is not None:
+                    # Keep serving the last table read, and try again after resync_seconds
+                    entry = (entry[0], time.time() - self.ttl + self.resync_seconds)
+                    self._tables[org_id] = entry
+                    return entry
+                table = None
+            entry = (table, time.time())
+            self._tables[org_id] = entry
+            return entry
+
+
+tables = TaxTables(TABLE_TTL, RESYNC_SECONDS)
+
+
+# Read (or refresh) the event's organization's taxes ahead of the lookups
+def table_for(event):
+    return tables.get(event)[0]
+
+
+# Zoho tax id of `rate` (a GST percentage) in the event's organization; raises UnknownTaxRate
+def tax_id(event, rate):
+    key = _rate_key(rate)
+    pinned = {_rate_key(r): value for r, value in tenants.tenant_config(event).get("tax_ids", {}).items()}
+    if key in pinned:
+        return pinned[key]
+
+    table, read_at = tables.get(event)
+    if table is None:
+        table = DEFAULT_TAX_IDS
+    elif key not in table and time.time() - read_at >= RESYNC_SECONDS:
+        # The tax may have been added in Zoho since the last read
+        table = tables.get(event, max_age=RESYNC_SECONDS)[0] or table
+    if key not in table:
+        raise UnknownTaxRate(f"No Zoho tax with a rate of {key}% in organization {event.get('org_id')}")
+    return table[key]
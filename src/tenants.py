@@ -0,0 +1,174 @@
+"""
+Per-tenant configuration registry.
+
+Events used to carry the Zoho credentials (client_id, client_secret,
+refresh_token, org_id) and the service configuration (table names, bucket, URL
+prefix, event bus, template ids, SAC/GST defaults, failure mail addresses). An
+event may name its tenant instead and carry only the Salesforce fields:
+
+    {"Action__c": "Buyer", "tenant": "acme", "InvoiceNumber__c": "...", "Payload__c": "..."}
+
+`resolve` fills in the other fields from the tenant's registry entry before the
+event is parsed. A field the event carries itself wins, so events that carry
+everything keep working unchanged.
+
+The registry is one JSON document mapping tenant names to their fields:
+
+    {"tenants": {"acme": {"client_id": "...", "client_secret": "...", "refresh_token": "...",
+                          "org_id": "...", "invoice_table": "...", "bucket_name": "...",
+                          "tax_ids": {"18": "1743550000000023299"}, "tax_name_prefix": "IGST"}}}
+
+It is read from TENANT_CONFIG_FILE, or from the SecretString of the Secrets
+Manager secret TENANT_CONFIG_SECRET, once at start-up (an invalid document
+stops the app from starting). A background thread checks the source every
+TENANT_RELOAD_SECONDS and swaps in a changed document; one that fails to load
+is logged and the previous one stays in use. `tax_ids` and `tax_name_prefix`
+configure the tenant's tax lookups (src/taxes.py) and are not copied into events.
+
+Configuration (environment variables):
+    TENANT_CONFIG_FILE     JSON file of the registry (default unset: no tenants)
+    TENANT_CONFIG_SECRET   Secrets Manager secret holding the registry, instead of the file
+    TENANT_RELOAD_SECONDS  how often the source is checked for changes (default 30)
+"""
+
+import json
+import os
+import threading
+import time
+import boto3
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, SECRETS_MANAGER
+from src.event_model import EventValidationError
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+TENANT_CONFIG_FILE = os.environ.get("TENANT_CONFIG_FILE")
+TENANT_CONFIG_SECRET = os.environ.get("TENANT_CONFIG_SECRET")
+RELOAD_SECONDS = float(os.environ.get("TENANT_RELOAD_SECONDS", "30"))
+
+TENANT_FIELD = "tenant"
+# Registry fields read by the service itself, never copied into events
+SETTINGS_FIELDS = ("tax_ids", "tax_name_prefix")
+
+
+class UnknownTenant(EventValidationError):
+    """Raised when an event names a tenant the registry does not have."""
+
+
+class FileSource:
+    def __init__(self, path):
+        self.path = path
+        self._version = None
+
+    def __str__(self):
+        return self.path
+
+    # Text of the file, or None when it has not changed since the last read
+    def read(self):
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == self._version:
+            return None
+        with open(self.path) as f:
+            text = f.read()
+        self._version = version
+        return text
+
+
+class SecretSource:
+    def __init__(self, secret_id):
+        self.secret_id = secret_id
+        self._client = boto3.client("secretsmanager", config=AWS_CLIENT_CONFIG)
+        self._version = None
+
+    def __str__(self):
+        return f"secret {self.secret_id}"
+
+    # SecretString of the secret, or None when its version has not changed since the last read
+    def read(self):
+        response = call_dependency(SECRETS_MANAGER, self._client.get_secret_value, SecretId=self.secret_id)
+        if response.get("VersionId") == self._version:
+            return None
+        self._version = response.get("VersionId")
+        return response["SecretString"]
+
+
+def _parse(text):
+    document = json.loads(text)
+    tenants = document.get("tenants") if isinstance(document, dict) else None
+    if not isinstance(tenants, dict):
+        raise ValueError('the registry must be an object with a "tenants" object')
+    for name, config in tenants.items():
+        if not isinstance(config, dict):
+            raise ValueError(f"tenant {name} must be an object")
+        if not isinstance(config.get("tax_ids", {}), dict):
+            raise ValueError(f"tax_ids of tenant {name} must be an object")
+    return tenants
+
+
+class Registry:
+    def __init__(self, source=None, reload_seconds=RELOAD_SECONDS):
+        self.source = source
+        self.reload_seconds = reload_seconds
+        self.tenants = {}
+        self.loaded_at = None
+        if source is not None:
+            # Nothing to fall back on at start-up: a bad registry is a deployment error
+            self.reload()
+            threading.Thread(target=self._watch, daemon=True, name="tenant-registry").start()
+
+    # Load the source if it changed; returns whether it did
+    def reload(self):
+        text = self.source.read()
+        if text is None:
+            return False
+        # Swapped in one assignment: readers see the old registry or the new one, never a mix
+        self.tenants = _parse(text)
+        self.loaded_at = time.time()
+        logger.info("Tenant registry loaded", source=str(self.source), tenants=len(self.tenants))
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.reload_seconds)
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error("Failed to reload the tenant registry, keeping the previous one", source=str(self.source), error=str(e))
+
+    def get(self, name):
+        return self.tenants.get(name)
+
+    # The event with its tenant's fields filled in
+    def resolve(self, event):
+        name = event.get(TENANT_FIELD)
+        if not name:
+            return event
+        config = self.tenants.get(name)
+        if config is None:
+            raise UnknownTenant(f"Unknown tenant: {name}")
+        resolved = {field: value for field, value in config.items() if field not in SETTINGS_FIELDS}
+        resolved.update(event)
+        return resolved
+
+
+def create_registry():
+    if TENANT_CONFIG_SECRET:
+        return Registry(SecretSource(TENANT_CONFIG_SECRET))
+    if TENANT_CONFIG_FILE:
+        return Registry(FileSource(TENANT_CONFIG_FILE))
+    return Registry()
+
+
+registry = create_registry()
+
+
+# The event with the fields of the tenant it names filled in; raises UnknownTenant
+def resolve(event):
+    return registry.resolve(event)
+
+
+# Registry entry of the event's tenant, or an empty one
+def tenant_config(event):
+    return registry.get(event.get(TENANT_FIELD)) or {}
@@ -0,0 +1,275 @@
+"""
+Lightweight request tracing.
+
+handle_event opens one root span per event; `call_dependency` opens a child span
+for every Zoho, S3, DynamoDB, EventBridge and SES call, and the PDF steps (merge,
+annexure, copies) open their own. Spans record the action, invoice number, bytes
+and status as attributes, so a slow event shows which call made it slow.
+
+A trace is sampled when its root span starts (TRACE_SAMPLE_RATE, or the sampled
+flag of an incoming W3C `traceparent` header, whose trace it then joins). Spans
+of an unsampled event are not created at all. Finished spans are queued and
+written by a background thread, either as JSON lines to a file or in batches to
+an OTLP/HTTP collector (JSON encoding), so exporting never blocks a request.
+
+Configuration (environment variables):
+    TRACE_EXPORTER        none, file or otlp (default none: tracing off)
+    TRACE_FILE            file of the file exporter (default /tmp/traces.jsonl)
+    TRACE_OTLP_ENDPOINT   OTLP/HTTP traces URL (default http://localhost:4318/v1/traces)
+    TRACE_SAMPLE_RATE     fraction of events traced (default 0.1)
+    TRACE_SERVICE_NAME    service.name resource attribute (default zoho-integration)
+    TRACE_QUEUE_SIZE      finished spans buffered for export before dropping (default 10000)
+"""
+
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+EXPORTER = os.environ.get("TRACE_EXPORTER", "none")
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/traces.jsonl")
+OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "zoho-integration")
+QUEUE_SIZE = int(os.environ.get("TRACE_QUEUE_SIZE", "10000"))
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL = 2.0
+
+TRACEPARENT_HEADER = "traceparent"
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+def _random_id(hex_digits):
+    return f"{random.getrandbits(hex_digits * 4):0{hex_digits}x}"
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns", "status", "status_message")
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.trace_id = trace_id
+        self.span_id = _random_id(16)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_OK
+        self.status_message = None
+
+    def set(self, **attributes):
+        self.attributes.update((k, v) for k, v in attributes.items() if v is not None)
+
+    def fail(self, exc):
+        self.status = STATUS_ERROR
+        self.status_message = f"{type(exc).__name__}: {exc}"
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    # The span in OTLP JSON encoding
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1 if self.parent_id is None else 3,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class _NoopSpan:
+    """Stands in for a span when the event is not traced."""
+
+    def set(self, **attributes):
+        pass
+
+    def fail(self, exc):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+# version-traceid-parentid-flags, lowercase hex (W3C Trace Context)
+TRACEPARENT_PATTERN = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+# (trace id, parent span id, sampled) of a traceparent header; None when it is absent or
+# invalid, which starts a new trace
+def _parse_traceparent(header):
+    match = TRACEPARENT_PATTERN.match(header.strip()) if isinstance(header, str) else None
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, int(flags, 16) & 1 == 1
+
+
+def _run_span(span):
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.fail(e)
+        raise
+    finally:
+        _current.reset(token)
+        span.end_ns = time.time_ns()
+        exporter.export(span)
+
+
+# Root span of an event, joining the trace of an incoming `traceparent` header
+@contextmanager
+def trace(name, traceparent=None, **attributes):
+    if exporter is None:
+        yield NOOP_SPAN
+        return
+    parent = _parse_traceparent(traceparent)
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id, sampled = _random_id(32), None, random.random() < SAMPLE_RATE
+    if not sampled:
+        # Child spans of an unsampled event are not created
+        token = _current.set(None)
+        try:
+            yield NOOP_SPAN
+        finally:
+            _current.reset(token)
+        return
+    yield from _run_span(Span(name, trace_id, parent_id, attributes))
+
+
+# Child span of the current span; a no-op outside a sampled trace
+@contextmanager
+def span(name, **attributes):
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    yield from _run_span(Span(name, parent.trace_id, parent.span_id, attributes))
+
+
+def current_span():
+    return _current.get() or NOOP_SPAN
+
+
+# Whether spans opened now are recorded
+def active():
+    return _current.get() is not None
+
+
+class _Exporter:
+    """Writes finished spans from a background thread, in batches."""
+
+    def __init__(self, write):
+        self.write = write
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        threading.Thread(target=self._worker, daemon=True).start()
+        atexit.register(self.flush)
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _drain(self):
+        batch = []
+        while len(batch) < EXPORT_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.write([span.to_otlp() for span in batch])
+        except Exception as e:
+            logger.warning("Failed to export spans", count=len(batch), error=str(e))
+
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            # Collect what arrives in the next moment into the same batch
+            time.sleep(EXPORT_INTERVAL if self._queue.qsize() < EXPORT_BATCH_SIZE else 0)
+            batch.extend(self._drain())
+            self._write(batch)
+
+    # Export what is still queued, at exit
+    def flush(self):
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
+
+
+def _write_file(spans):
+    with open(TRACE_FILE, "a") as f:
+        f.write("".join(json.dumps(span) + "\n" for span in spans))
+
+
+def _write_otlp(spans):
+    body = {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "zoho-integration"}, "spans": spans}]
+    }]}
+    # Not a call_dependency call: the collector is not a dependency of the events
+    response = requests.post(OTLP_ENDPOINT, json=body, timeout=5)
+    response.raise_for_status()
+
+
+def create_exporter(kind=EXPORTER):
+    if kind == "none":
+        return None
+    if kind == "file":
+        return _Exporter(_write_file)
+    if kind == "otlp":
+        return _Exporter(_write_otlp)
+    raise ValueError(f"Unknown TRACE_EXPORTER: {kind}")
+
+
+exporter = create_exporter()
+
+
+# Spans dropped because the exporter fell behind
+def dropped_spans():
+    return exporter.dropped if exporter is not None else 0
@@ -1,18 +1,33 @@
 """
 Update invoice address in Zoho Books and handle related operations.
 This module defines the `update_invoice_address_function` which updates the billing and shipping
+addresses of an invoice. A normalized hash of each address is stored on the invoice record, and
+only an address whose hash changed is sent to Zoho; when neither changed the event is a no-op.
 """
-from flask import json
-import requests
-from src.get_invoice import get_invoice_function
+import hashlib
+import json
+from src.get_invoice import get_invoice_function, pending_pdf_stage, pdf_stage_fits, skipped_pdf_stage
 import boto3
 from datetime import datetime
 from src.email import send_failure_email
+from src.event_model import parse_event
+from src import deadline
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, ZOHO, zoho_http, DYNAMODB
+from src.records import compact_invoice
+from src.log import get_logger
 
-dynamodb = boto3.resource('dynamodb')
+logger = get_logger(__name__)
+
+dynamodb = boto3.resource('dynamodb', config=AWS_CLIENT_CONFIG)
+
+# Hash of an address as sent to Zoho, ignoring case and whitespace differences
+def address_hash(address_payload):
+    normalized = {k: " ".join(str(v).split()).lower() for k, v in address_payload.items()}
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
 
 # Function to update invoice address in Zoho Books
-def update_invoice_address_function(event):
+def update_invoice_address_function(event, model=None):
     client_id = event.get("client_id")
     client_secret = event.get("client_secret")
     refresh_token = event.get("refresh_token")
@@ -37,10 +52,51 @@ def update_invoice_address_function(event):
 
     country_map = {"IN": "India"}
     
-    # Parse payload
-    inside_payload = json.loads(event.get("Payload__c"))
-    zoho_invoice_id = inside_payload.get("invoice").get("ZohoInvoiceId")
+    # Parse payload, unless the caller already did
+    if model is None:
+        model = parse_event("Buyer", event)
+    payload_model = model.payload
+    zoho_invoice_id = payload_model.invoice.zoho_invoice_id
+
+
+    # Prepare billing address payload
+    billing = payload_model.shipment.billing_address
+    billing_payload = {
+        "address": billing.street or "",
+        "city": billing.city or "",
+        "state": state_map[billing.state_code] if billing.state_code else "",
+        "zip": billing.postal_code or "",
+        "country": country_map[billing.country_code] if billing.country_code else ""
+    }
+    # Prepare shipping address payload
+    shipping = payload_model.shipment.shipping_address
+    shipping_payload = {
+        "address": shipping.street or "",
+        "city": shipping.city or "",
+        "state": state_map[shipping.state_code] if shipping.state_code else "",
+        "zip": shipping.postal_code or "",
+        "country": country_map[shipping.country_code] if shipping.country_code else ""
+    }
+    billing_hash = address_hash(billing_payload)
+    shipping_hash = address_hash(shipping_payload)
+
+    # Compare with the addresses last sent to Zoho for this invoice
+    try:
+        stored = call_dependency(DYNAMODB, table.get_item,
+            Key={"Invoice_Number": invoice_number},
+            ProjectionExpression="Billing_Address_Hash, Shipping_Address_Hash, Invoice_Date"
+        ).get("Item") or {}
+    except Exception as e:
+        # Without the stored hashes both addresses are sent, as before
+        logger.warning("Failed to read address hashes", invoice_number=invoice_number, error=str(e))
+        stored = {}
+    billing_changed = stored.get("Billing_Address_Hash") != billing_hash
+    shipping_changed = stored.get("Shipping_Address_Hash") != shipping_hash
 
+    # Nothing changed: no Zoho calls, no PDF regeneration
+    if not billing_changed and not shipping_changed:
+        cloudwatch_payload["Address_Update"] = "Skipped, addresses unchanged"
+        return cloudwatch_payload
 
     # Generate access token
     generate_access_token_url = "https://accounts.zoho.in/oauth/v2/token"
@@ -52,7 +108,7 @@ def update_invoice_address_function(event):
         "grant_type": "refresh_token"
     }
     
-    token_response = requests.post(generate_access_token_url, data=data)
+    token_response = call_dependency(ZOHO, zoho_http.post, generate_access_token_url, data=data)
     # print("Zoho token response:", token_response.text)
     
     # Handle token generation failure
@@ -73,87 +129,97 @@ def update_invoice_address_function(event):
         "Authorization": f"Zoho-oauthtoken {access_token}",
         "Content-Type": "application/json"
     }
-    
-    # Prepare billing address payload
-    billing_payload = {
-        "address": inside_payload.get("shipment").get("Bill_To_Address__Street__s") if inside_payload.get("shipment").get("Bill_To_Address__Street__s") else "",
-        "city": inside_payload.get("shipment").get("Bill_To_Address__City__s") if inside_payload.get("shipment").get("Bill_To_Address__City__s") else "",
-        "state": state_map[inside_payload.get("shipment").get("Bill_To_Address__StateCode__s")] if inside_payload.get("shipment").get("Bill_To_Address__StateCode__s") else "",
-        "zip": inside_payload.get("shipment").get("Bill_To_Address__PostalCode__s") if inside_payload.get("shipment").get("Bill_To_Address__PostalCode__s") else "",
-        "country": country_map[inside_payload.get("shipment").get("Bill_To_Address__CountryCode__s")] if inside_payload.get("shipment").get("Bill_To_Address__CountryCode__s") else ""
+
+    dynamodb_payload = {
+        "Invoice_Number": event.get("InvoiceNumber__c")
     }
-    
-    # Update billing address
-    response_billing = requests.put(update_billing_url, headers=headers, json=billing_payload)
 
+    # Update billing address, only when it changed
+    billing_response = "Skipped, unchanged"
+    if billing_changed:
+        response_billing = call_dependency(ZOHO, zoho_http.put, update_billing_url, headers=headers, json=billing_payload)
 
-    # Handle billing address update response
-    if response_billing.status_code == 200:
+        # Handle billing address update failure
+        if response_billing.status_code != 200:
+            send_failure_email("Zoho Update Billing Address Failed", f"Failed to update billing address for Zoho Invoice. Error: {response_billing.text}", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
+            cloudwatch_payload["Billing_Address_Update_Error"] = response_billing.text
+            return cloudwatch_payload
+
+        # The invoice has changed in Zoho now, the bookkeeping below must run to completion
+        deadline.commit()
         billing_response = {
             "API_Status": response_billing.status_code,
             "API_Timestamp" : str(datetime.now())
         }
-        # Prepare shipping address payload
-        shipping_payload = {
-            "address": inside_payload.get("shipment").get("Ship_To_Address__Street__s") if inside_payload.get("shipment").get("Ship_To_Address__Street__s") else "",
-            "city": inside_payload.get("shipment").get("Ship_To_Address__City__s") if inside_payload.get("shipment").get("Ship_To_Address__City__s") else "",
-            "state": state_map[inside_payload.get("shipment").get("Ship_To_Address__StateCode__s")] if inside_payload.get("shipment").get("Ship_To_Address__StateCode__s") else "",
-            "zip": inside_payload.get("shipment").get("Ship_To_Address__PostalCode__s") if inside_payload.get("shipment").get("Ship_To_Address__PostalCode__s") else "",
-            "country": country_map[inside_payload.get("shipment").get("Ship_To_Address__CountryCode__s")] if inside_payload.get("shipment").get("Ship_To_Address__CountryCode__s") else ""
-        }
-        # Update shipping address
-        response_shipping = requests.put(update_shipping_url, headers=headers, json=shipping_payload)
-        
-        # Get copies value
-        account_obj = inside_payload.get("account") or {}
-        copies_value = account_obj.get("invoiceCopies")
-        if copies_value is None:
-            copies_value = 1
-
-        # Handle shipping address update response
-        if response_shipping.status_code == 200:
-
-            get_event = {
-                "client_id": client_id,
-                "client_secret": client_secret,
-                "refresh_token": refresh_token,
-                "org_id": org_id,
-                "invoice_number": event.get("InvoiceNumber__c"),
-                "invoice_id": zoho_invoice_id,
-                "bucket_name": event.get("bucket_name"),
-                "invoice_url_prefix": event.get("invoice_url_prefix"),
-                "copies": copies_value
-            }
-            get_result = get_invoice_function(get_event)
-            body, status_code = get_result
-
-            # Handle get_invoice_function failure
-            if status_code != 200:
-                send_failure_email("Zoho Get Invoice Failed", f"Failed to get updated invoice after address update. Error: {body.get('error')}", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
-                # return {"error": "Failed to get updated invoice", "details": body}
-
-            # Prepare get_invoice_response
-            get_invoice_response = {
-                "API_Status": status_code,
-                "API_Timestamp" : str(datetime.now())
-            }
+        dynamodb_payload["Billing_Address_Hash"] = billing_hash
 
+    # Update shipping address, only when it changed
+    shipping_response = "Skipped, unchanged"
+    shipping_updated = True
+    if shipping_changed:
+        response_shipping = call_dependency(ZOHO, zoho_http.put, update_shipping_url, headers=headers, json=shipping_payload)
+        shipping_updated = response_shipping.status_code == 200
+        if shipping_updated:
+            deadline.commit()
+            dynamodb_payload["Shipping_Address_Hash"] = shipping_hash
         else:
             cloudwatch_payload["Shipping_Address_Update_Error"] = response_shipping.text
             send_failure_email("Zoho Update Shipping Address Failed", f"Failed to update shipping address for Zoho Invoice. Error: {response_shipping.text}", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
             # return {"error": "Failed to update shipping address", "details": response_shipping.json()}
-        
+
         # Prepare shipping_response
         shipping_response = {
             "API_Status": response_shipping.status_code,
             "API_Timestamp" : str(datetime.now())
         }
 
-    # Handle billing address update failure
-    else:
-        send_failure_email("Zoho Update Billing Address Failed", f"Failed to update billing address for Zoho Invoice. Error: {response_billing.text}", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
-        cloudwatch_payload["Billing_Address_Update_Error"] = response_billing.text
-        return cloudwatch_payload
+    get_invoice_response = None
+    pending_stages = None
+
+    # Get copies value
+    copies_value = payload_model.account.invoice_copies
+
+    # Regenerate the PDF once every changed address is in Zoho
+    if shipping_updated:
+
+        get_event = {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "refresh_token": refresh_token,
+            "org_id": org_id,
+            "invoice_number": event.get("InvoiceNumber__c"),
+            "sf_invoice_id": payload_model.invoice.sf_invoice_id,
+            "invoice_id": zoho_invoice_id,
+            "bucket_name": event.get("bucket_name"),
+            "invoice_url_prefix": event.get("invoice_url_prefix"),
+            "copies": copies_value,
+            "invoice_date": stored.get("Invoice_Date")
+        }
+        # The stored PDF still shows the old address, so completing the stage must regenerate it
+        pdf_stage = pending_pdf_stage(get_event, force=True)
+        # Regenerating the PDF is optional: when the event is short on budget, skip it
+        # and record it as a pending stage on the invoice so it can be completed later
+        if pdf_stage_fits():
+            get_result = get_invoice_function(get_event)
+            body, status_code = get_result
+        else:
+            body, status_code = skipped_pdf_stage()
+            pending_stages = pdf_stage
+            cloudwatch_payload["Skipped_Stages"] = ["Invoice_PDF"]
+
+        # Handle get_invoice_function failure
+        if status_code != 200 and not body.get("skipped"):
+            # The address hashes are stored below, so a retried event would find the addresses
+            # unchanged and never regenerate: leave the PDF as a pending stage instead
+            pending_stages = pdf_stage
+            send_failure_email("Zoho Get Invoice Failed", f"Failed to get updated invoice after address update. Error: {body.get('error')}", event.get("failure_mail_sender"), event.get("failure_mail_reciever"))
+            # return {"error": "Failed to get updated invoice", "details": body}
+
+        # Prepare get_invoice_response
+        get_invoice_response = {
+            "API_Status": status_code,
+            "API_Timestamp" : str(datetime.now())
+        }
 
     # Prepare final response
     final_response = {
@@ -163,22 +229,21 @@ def update_invoice_address_function(event):
     }
 
     # Update DynamoDB
-    dynamodb_payload = {
-        "Invoice_Number": event.get("InvoiceNumber__c"),
-        "Update_Address_Response": final_response
-    }
+    dynamodb_payload["Update_Address_Response"] = final_response
+    if pending_stages:
+        dynamodb_payload["Pending_Stages"] = pending_stages
 
 
     # Perform DynamoDB update
     try:
         dynamodb_payload["Last_Updated_Timestamp"] = str(datetime.now())
-        update_fields = {k: v for k, v in dynamodb_payload.items() if k not in ["Invoice_Number"]}
+        update_fields = {k: v for k, v in compact_invoice(dynamodb_payload).items() if k not in ["Invoice_Number"]}
         expression_attribute_names = {f"#{k.replace(' ', '_')}": k for k in update_fields.keys()}
         expression_attribute_values = {f":{k.replace(' ', '_')}": v for k, v in update_fields.items()}
             # Build the UpdateExpression dynamically
         update_expr = "SET " + ", ".join(f"#{k.replace(' ', '_')} = :{k.replace(' ', '_')}" for k in update_fields.keys())
 
-        table.update_item(
+        call_dependency(DYNAMODB, table.update_item,
             Key={
                 "Invoice_Number": event.get("InvoiceNumber__c")
             },
@@ -1,9 +1,14 @@
-import requests
 from src.get_invoice import get_invoice_function
 import boto3
 from datetime import datetime
+from src.deadline import AWS_CLIENT_CONFIG
+from src.dependencies import call_dependency, ZOHO, zoho_http, DYNAMODB
+from src.records import compact_invoice
+from src.log import get_logger
 
-dynamodb = boto3.resource('dynamodb')
+logger = get_logger(__name__)
+
+dynamodb = boto3.resource('dynamodb', config=AWS_CLIENT_CONFIG)
 
 """
 Do any response in need to send to salesforce?
@@ -30,8 +35,8 @@ def update_invoice_shipping_function(event):
         "grant_type": "refresh_token"
     }
     
-    token_response = requests.post(generate_access_token_url, data=data)
-    print("Zoho token response:", token_response.text)
+    token_response = call_dependency(ZOHO, zoho_http.post, generate_access_token_url, data=data)
+    logger.debug("Zoho token response", status=token_response.status_code)
     
     if token_response.status_code != 200:
         return {"error": "Failed to generate access token"}
@@ -55,10 +60,9 @@ def update_invoice_shipping_function(event):
         "country": event.get("ShippingAddressCountry__c")
     }
     
-    response = requests.put(update_invoice_url, headers=headers, json=payload)
+    response = call_dependency(ZOHO, zoho_http.put, update_invoice_url, headers=headers, json=payload)
     
-    print("Zoho update invoice Shipping response:", response.json())
-    print("Response status code:", response.status_code)
+    logger.debug("Zoho update invoice shipping response", status=response.status_code, response=response.text)
 
     update_invoice_response = {
             "API_Status": response.status_code,
@@ -103,12 +107,12 @@ def update_invoice_shipping_function(event):
     #     "get_invoice_result": get_result
     # }
     try:
-        table.update_item(
+        # Statuses on the item, the responses themselves in the audit store
+        update_fields = {k: v for k, v in compact_invoice({"Invoice_Number": event.get("invoice_number"), "Update_Invoice": final_api_response}).items() if k != "Invoice_Number"}
+        call_dependency(DYNAMODB, table.update_item,
             Key={'Invoice_Number': event.get("invoice_number")},
-            UpdateExpression="SET Update_Invoice = :u",
-            ExpressionAttributeValues={
-                ':u': final_api_response
-            }
+            UpdateExpression="SET " + ", ".join(f"{k} = :{k}" for k in update_fields),
+            ExpressionAttributeValues={f":{k}": v for k, v in update_fields.items()}
         )
         return {
             "message": "Shipping address updated and DynamoDB updated successfully",
@@ -0,0 +1,114 @@
+"""
+How much of a handler's result /event sends back.
+
+The handlers return everything they know: the invoice actions include the Zoho
+payload with every line item (`zoho_payload`) and CreateZohoAccount the full
+Zoho contact of the customer and the vendor. Salesforce needs little of it, so
+the response is cut down to one of three levels:
+
+    minimal   top-level statuses, ids and errors only (long strings truncated);
+              bulk results keep their counts but not the per-account list
+    standard  everything but the bulky fields: the Zoho payload is left out and
+              Zoho responses are reduced to their code, message and id (default)
+    debug     the result as the handler returned it
+
+What is left out is not lost: it is logged at info level (not subject to the
+debug sampling of src/log.py) and attached to the event's root span when the
+event is traced.
+A request picks its level with the X-Response-Verbosity header.
+
+Configuration (environment variables):
+    RESPONSE_VERBOSITY  default level: minimal, standard or debug (default standard)
+"""
+
+import json
+import os
+from src import tracing
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+MINIMAL = "minimal"
+STANDARD = "standard"
+DEBUG = "debug"
+LEVELS = (MINIMAL, STANDARD, DEBUG)
+
+DEFAULT_LEVEL = os.environ.get("RESPONSE_VERBOSITY", STANDARD).lower()
+if DEFAULT_LEVEL not in LEVELS:
+    raise ValueError(f"Unknown RESPONSE_VERBOSITY: {DEFAULT_LEVEL}")
+
+VERBOSITY_HEADER = "X-Response-Verbosity"
+
+# Request payloads sent to Zoho: left out of standard responses
+PAYLOAD_FIELDS = {"zoho_payload"}
+# Zoho responses: reduced to code, message and the id they carry
+ZOHO_RESPONSE_FIELDS = {"Customer API Response", "Vendor API Response", "details"}
+ZOHO_ID_FIELDS = (("contact", "contact_id"), ("invoice", "invoice_id"))
+
+MINIMAL_STRING_LENGTH = 256
+
+
+# The level a request asks for; unknown values fall back to the default
+def level_for(header_value):
+    level = (header_value or "").strip().lower()
+    return level if level in LEVELS else DEFAULT_LEVEL
+
+
+def _zoho_summary(body):
+    if not isinstance(body, dict):
+        return body
+    summary = {key: body[key] for key in ("code", "message", "error") if key in body}
+    for resource, id_field in ZOHO_ID_FIELDS:
+        if isinstance(body.get(resource), dict) and body[resource].get(id_field):
+            summary[id_field] = body[resource][id_field]
+    return summary
+
+
+# (kept, left out) of one result dict
+def _shape_dict(result, level):
+    kept, left_out = {}, {}
+    for key, value in result.items():
+        if key in PAYLOAD_FIELDS:
+            left_out[key] = value
+        elif key in ZOHO_RESPONSE_FIELDS:
+            kept[key] = _zoho_summary(value)
+            if kept[key] != value:
+                left_out[key] = value
+        else:
+            kept[key] = value
+
+    if level == MINIMAL:
+        for key, value in list(kept.items()):
+            if isinstance(value, (dict, list, tuple)):
+                left_out.setdefault(key, value)
+                del kept[key]
+            elif isinstance(value, str) and len(value) > MINIMAL_STRING_LENGTH:
+                left_out.setdefault(key, value)
+                kept[key] = value[:MINIMAL_STRING_LENGTH] + "..."
+    return kept, left_out
+
+
+def _shape(result, level):
+    if isinstance(result, dict):
+        return _shape_dict(result, level)
+    # get_invoice returns (body, status code)
+    if isinstance(result, (list, tuple)):
+        kept, left_out = [], {}
+        for item in result:
+            item, item_left_out = _shape(item, level)
+            kept.append(item)
+            left_out.update(item_left_out)
+        return type(result)(kept), left_out
+    return result, {}
+
+
+# The result of `action` as a response at `level`; what is left out goes to the log and the trace
+def shape(action, result, level=DEFAULT_LEVEL):
+    if level == DEBUG:
+        return result
+    kept, left_out = _shape(result, level)
+    if left_out:
+        logger.info("Result fields left out of the response", action=action, verbosity=level, left_out=left_out)
+        if tracing.active():
+            tracing.current_span().set(**{f"result.{key}": json.dumps(value, default=str) for key, value in left_out.items()})
+    return kept